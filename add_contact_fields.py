@@ -9,6 +9,8 @@ import csv
 
 from simple_salesforce import Salesforce
 
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 from salesforce_fields import contact as contact_fields
 import salesforce_secrets as sf_secrets
 
@@ -41,11 +43,11 @@ def add_alumni_data(sf_con):
     :param sf_con: ``simple_salesforce.Salesforce`` connection
     """
 
-    with open(INPUT_FILENAME) as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(INPUT_FILENAME) as csvfile:
+        reader = CompactDictReader(csvfile)
 
         outfile_name = "supplemented_{}".format(INPUT_FILENAME)
-        with open(outfile_name, "w") as outfile:
+        with open_file(outfile_name, "w") as outfile:
             fieldnames = reader.fieldnames
             fieldnames.extend(FIELDS_TO_ADD)
             fieldnames.append(CAREER_OFFICE_R)
@@ -5,7 +5,6 @@ Query Elasticsearch using Safe ID and campus to write back out with OwnerId.
 """
 
 import argparse
-import csv
 
 import sys
 from os import pardir, path
@@ -19,7 +18,13 @@ from elasticsearch_dsl.connections import connections as es_connections
 import requests
 
 from salesforce_fields import contact_note as cn_fields
+from salesforce_ids import (
+    CONTACT_KEY_PREFIX,
+    InvalidSalesforceId,
+    normalize_sf_id,
+)
 from secrets.elastic_secrets import ES_CONNECTION_KEY
+from staging import open_reader, open_writer
 
 CONTACT_UNKNOWN_STRING = "StillNotFound"
 
@@ -29,19 +34,23 @@ def write_owner_ids(csv_filename, campus):
     Query Elasticsearch using Safe ID and campus to write back out with OwnerId.
     """
 
-    with open(csv_filename) as csvfile:
-        reader = csv.DictReader(csvfile)
-
+    with open_reader(csv_filename) as reader:
         outfile_name = "ownerids_{}".format(csv_filename)
-        with open(outfile_name, 'w') as outfile:
-            fieldnames = reader.fieldnames
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        with open_writer(outfile_name, reader.fieldnames) as writer:
             writer.writeheader()
 
             for row in reader:
                 if row[cn_fields.CONTACT] != CONTACT_UNKNOWN_STRING:
-                    ac_safe_id = get_owner_id(campus, row[cn_fields.CONTACT])
-                    row["OwnerId"] = ac_safe_id
+                    try:
+                        safe_id = normalize_sf_id(
+                            row[cn_fields.CONTACT] or "", CONTACT_KEY_PREFIX
+                        )
+                    except InvalidSalesforceId as e:
+                        # no point querying for it
+                        print(f"WARNING: {e}")
+                        row["OwnerId"] = "Unknown"
+                    else:
+                        row["OwnerId"] = get_owner_id(campus, safe_id)
                 writer.writerow(row)
 
 
@@ -15,12 +15,26 @@ then this would result in an output file with:
     Bob, ABC123, Outreach A, Comments A
     Bob, ABC123, Outreach B, Comments B
 
+A file can contain several independent groups of repeated columns, eg.
+    Name, Call Date, Call Notes, Call Date, Call Notes, Email, Email
+Each repetition of each group becomes its own row, with the columns of
+the other groups left blank. Repetitions that are entirely empty are skipped
+rather than written out as blank notes.
+
 This script is mainly meant for spreadsheets that have mutliple
 Contact Notes on each row.
 """
 import argparse
+from collections import namedtuple
 import csv
 
+from compressed_files import open_file
+
+# start: index of the group's first column in the input header row
+# width: number of columns in one repetition of the group
+# repeats: number of times the group is repeated side by side
+ColumnGroup = namedtuple("ColumnGroup", ["start", "width", "repeats"])
+
 
 def handle_args():
     parser = argparse.ArgumentParser()
@@ -39,134 +53,217 @@ def break_notes(filename):
     documentation at the beginning of the file. In the end a new file
     is created using the filename of the input file as a base.
 
+    The input is read once and the output written once; only a single row
+    is held in memory at a time. Output rows are counted as they are
+    written, and checked against a count of the non-empty repetitions made
+    separately from each input row, rather than by re-reading the output
+    file.
+
     Args:
         filename: the name of the file to be used in the script.
     """
     output_filename = "merged_" + filename
-    input_row_count = 0
-    with open(filename, "r") as csv_file:
+    input_row_count = output_row_count = skipped_count = expected_count = 0
+
+    with open_file(filename, "r", newline="") as csv_file, open_file(
+        output_filename, "w", newline=""
+    ) as csv_w_file:
         csv_reader = csv.reader(csv_file)
-        csv_w_file = open(output_filename, "w", newline="")
         csv_writer = csv.writer(csv_w_file)
+
         header_row_list = next(csv_reader)
-        duplicate_col_start, duplicate_col_end = get_endpoints_of_duplicate_columns(
-            header_row_list
+        groups = get_duplicate_column_groups(header_row_list)
+        if not groups:
+            raise ValueError(f"No repeated columns found in {filename}.")
+
+        common_indices = get_common_column_indices(len(header_row_list), groups)
+        csv_writer.writerow(
+            make_output_headers(header_row_list, common_indices, groups)
         )
-        header_row_list = remove_duplicate_list_items(header_row_list)
-        csv_writer.writerow(header_row_list)
         for row in csv_reader:
-            write_rows(row, csv_writer, duplicate_col_start, duplicate_col_end)
             input_row_count += 1
-        csv_w_file.close()
-        dup_col_num = len(header_row_list) - duplicate_col_start
-        check_that_output_rows_are_correct(
-            input_row_count, output_filename, dup_col_num
-        )
-        print(f"Success! Your new file is called {output_filename}.")
+            expected_count += count_filled_repetitions(row, groups)
+            for output_row in break_row(
+                row, len(header_row_list), common_indices, groups
+            ):
+                if output_row is None:
+                    skipped_count += 1
+                    continue
+                csv_writer.writerow(output_row)
+                output_row_count += 1
+
+    check_that_output_rows_are_correct(expected_count, output_row_count)
+    print(
+        f"Success! Your new file is called {output_filename}. "
+        f"({input_row_count} rows read, {output_row_count} rows written, "
+        f"{skipped_count} empty skipped)"
+    )
+
+
+def break_notes_stage(headers):
+    """Pipeline stage (see pipeline.py): break each row into one row per
+    non-empty repetition of each repeated column group.
+    """
+    groups = get_duplicate_column_groups(headers)
+    if not groups:
+        raise ValueError("No repeated columns found in headers.")
+    header_length = len(headers)
+    common_indices = get_common_column_indices(header_length, groups)
+
+    def break_stage_row(row):
+        return [
+            output_row
+            for output_row in break_row(row, header_length, common_indices, groups)
+            if output_row is not None
+        ]
 
+    return make_output_headers(headers, common_indices, groups), break_stage_row
 
-def get_endpoints_of_duplicate_columns(header_row_list):
-    """Gets the endpoints of the first set of duplicate columns.
 
-    The positions of the first set of duplicate columns in the input file
-    will be used while iterating through the output file, as well as to
-    judge how long each row will be. Therefore it's important that these
-    endpoints are calculated early.
+def get_duplicate_column_groups(header_row_list):
+    """Find every set of columns that is repeated side by side in the header.
+
+    A group is the shortest run of distinct headers that is immediately
+    followed by at least one exact copy of itself, eg. 'Subject, Comments'
+    in 'Name, Subject, Comments, Subject, Comments'. Columns that aren't
+    part of a group are common to every output row.
 
     Args:
         header_row_list: A list of strings that are the names of the
         header rows in the input file.
 
     Returns:
-        duplicate_col_start and duplicate_col_end, two integers
-        that represent both the start and end of the first set of duplicate columns
-        in the input file.
+        A list of ColumnGroup namedtuples, in the order they appear in
+        the header row.
     """
+    groups = []
+    column_count = len(header_row_list)
     column_index = 0
-    duplicate_col_start = 0
-    duplicate_col_end = 0
-    duplicate_col_dict = {}
-    for header in header_row_list:
-        if header not in duplicate_col_dict:
-            duplicate_col_dict[header] = column_index
+    while column_index < column_count:
+        group = _find_group_at(header_row_list, column_index)
+        if group is None:
             column_index += 1
-        else:
-            duplicate_col_start = duplicate_col_dict[header]
-            duplicate_col_end = column_index - 1
+            continue
+        groups.append(group)
+        column_index += group.width * group.repeats
+    return groups
+
+
+def _find_group_at(header_row_list, start):
+    """Return the ColumnGroup starting at `start`, or None if the columns
+    there aren't repeated.
+    """
+    column_count = len(header_row_list)
+    for width in range(1, (column_count - start) // 2 + 1):
+        block = header_row_list[start:start + width]
+        if len(set(block)) != width:
+            # a repetition can't contain the same header twice
             break
-    return duplicate_col_start, duplicate_col_end
+        if header_row_list[start + width:start + 2 * width] != block:
+            continue
+        repeats = 2
+        next_start = start + 2 * width
+        while header_row_list[next_start:next_start + width] == block:
+            repeats += 1
+            next_start += width
+        return ColumnGroup(start=start, width=width, repeats=repeats)
+    return None
 
 
-def write_rows(row, csv_writer, duplicate_col_start, duplicate_col_end):
-    """Write rows to the output file.
+def get_common_column_indices(header_length, groups):
+    """Indices of the columns that aren't part of any repeated group."""
+    grouped = set()
+    for group in groups:
+        grouped.update(
+            range(group.start, group.start + group.width * group.repeats)
+        )
+    return [i for i in range(header_length) if i not in grouped]
+
+
+def make_output_headers(header_row_list, common_indices, groups):
+    """Common columns in their original order, followed by one copy of
+    each group's columns.
+    """
+    common_headers = [header_row_list[i] for i in common_indices]
+    for group in groups:
+        common_headers.extend(
+            header_row_list[group.start:group.start + group.width]
+        )
+    return common_headers
 
-    This function will write a variable amount of rows to an output file for
-    each singular row in the input. The number of rows written is dependent
-    on the amount of duplicate columns in the input. The amount of columns in each
-    row is dependent on the duplicate column endpoints that were calculated earlier.
+
+def break_row(row, header_length, common_indices, groups):
+    """Yield the output rows for a single input row.
+
+    Ragged rows are padded with empty cells (or trimmed) to the length of
+    the header row. For each repetition that is entirely empty, yields None
+    in place of a row so the caller can count what was skipped.
 
     Args:
         row: A row of data taken from the input file.
-        csv_writer: The CSV object representing the output file to be written to.
-        duplicate_col_start: The starting point of the duplicate columns
-        in the input file.
-        duplicate_col_end: The ending point of the duplicate columns in the input file.
-    """
-    column_index = 0
-    common_col_list = []
-    duplicate_col_list = []
-    for row_item in row:
-        if column_index < duplicate_col_start:
-            common_col_list.append(row_item)
-            column_index += 1
-        elif column_index <= duplicate_col_end:
-            duplicate_col_list.append(row_item)
-            column_index += 1
-        else:
-            csv_writer.writerow(common_col_list + duplicate_col_list)
-            duplicate_col_list = []
-            duplicate_col_list.append(row_item)
-            column_index = duplicate_col_start + 1
-    csv_writer.writerow(common_col_list + duplicate_col_list)
-
-
-def remove_duplicate_list_items(dup_list):
-    """Creating a dictionary made of keys from a list and then converting those keys back
-    to a list will remove any duplicate elements from a list
-    while keeping the elements in the same order.
+        header_length: The number of columns in the input header row.
+        common_indices: Indices of the columns copied onto every output row.
+        groups: ColumnGroup namedtuples from get_duplicate_column_groups.
     """
+    if len(row) < header_length:
+        row = row + [""] * (header_length - len(row))
+    common_col_list = [row[i] for i in common_indices]
+
+    offset = 0
+    output_width = sum(group.width for group in groups)
+    for group in groups:
+        for repeat in range(group.repeats):
+            repeat_start = group.start + repeat * group.width
+            duplicate_col_list = row[repeat_start:repeat_start + group.width]
+            if not any(item.strip() for item in duplicate_col_list):
+                yield None
+                continue
+            group_cols = [""] * output_width
+            group_cols[offset:offset + group.width] = duplicate_col_list
+            yield common_col_list + group_cols
+        offset += group.width
+
+
+def count_filled_repetitions(row, groups):
+    """The number of repetitions of every group in row that have any
+    non-empty cell, ie. the number of output rows row should become.
 
-    dup_list = list(dict.fromkeys(dup_list))
-    return dup_list
+    Counted straight from the input row, apart from break_row, so that
+    check_that_output_rows_are_correct has something independent to
+    compare against.
+
+    Args:
+        row: A row of data taken from the input file.
+        groups: ColumnGroup namedtuples from get_duplicate_column_groups.
+    """
+    count = 0
+    for group in groups:
+        for repeat in range(group.repeats):
+            repeat_start = group.start + repeat * group.width
+            cells = row[repeat_start:repeat_start + group.width]
+            if any(cell.strip() for cell in cells):
+                count += 1
+    return count
 
 
-def check_that_output_rows_are_correct(input_rows, output_filename, dup_col_num):
+def check_that_output_rows_are_correct(expected_rows, output_rows):
     """Checks to make sure that the output file has the correct
     number of rows based on the input.
 
-    The output file should have a row number equal to the number of rows in
-    the input file multiplied by the number of times the duplicate columns
-    were repeated. (So in the example at the top of this file, this number
-    would be two since the Subject and Comments columns were repeated twice.)
-    This function will check to see if the output file has a number of rows
-    that meets this criteria, and will throw an error if it doesn't.
+    There should be one output row per non-empty repetition of every group
+    in every input row. (So in the example at the top of this file, this
+    number would be at most two per input row since the Subject and
+    Comments columns were repeated twice.) This function will throw an error
+    if that isn't the case.
 
     Args:
-        input_rows: The number of rows in the input file.
-        output_filename: The filename of the output file.
-        dup_col_num: The number of times the duplicate
-        columns in the input file were repeated.
+        expected_rows: The number of non-empty repetitions in the input
+            file, from count_filled_repetitions.
+        output_rows: The number of rows written to the output file.
     """
-    output_rows = -1  # starts at -1 to account for the header row
-    output = open(output_filename, "r")
-    output_check = csv.reader(output)
-    for row in output_check:
-        output_rows += 1
-    assert output_rows == (
-        input_rows * dup_col_num
-    ), f"""Error! The number of rows in the output file
-    should be {input_rows * dup_col_num}, but it is {output_rows} instead."""
-    output.close()
+    assert output_rows == expected_rows, f"""Error! The number of
+    rows in the output file should be {expected_rows}, but it is
+    {output_rows} instead."""
 
 
 if __name__ == "__main__":
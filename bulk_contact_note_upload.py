@@ -22,7 +22,6 @@ and checks for duplicates using Date_of_Contact__c, etc.
 """
 
 import argparse
-import csv
 from datetime import datetime
 import sys
 from os import pardir, path
@@ -36,6 +35,8 @@ from elasticsearch_dsl import Search
 from simple_salesforce import Salesforce
 
 from common_date_formats import COMMON_DATE_FORMATS
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 from constants import (
     CAMPUS_SF_IDS,
     SALESFORCE_DATESTRING_FORMAT,
@@ -73,8 +74,8 @@ def upload_contact_notes(input_file, campus, source_date_format):
 
     skipped_count = created_count = 0
 
-    with open(input_file, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(input_file, 'r') as csvfile:
+        reader = CompactDictReader(csvfile)
 
         for row in reader:
             # Date_of_Contact__c
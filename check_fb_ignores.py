@@ -2,7 +2,6 @@
 """
 
 import argparse
-import csv
 
 import sys
 from os import pardir, path
@@ -17,6 +16,7 @@ import requests
 
 from salesforce_fields import contact_note as cn_fields
 from secrets.elastic_secrets import ES_CONNECTION_KEY
+from staging import open_reader, open_writer
 
 CONTACT_UNKNOWN_STRING = "StillNotFound"
 FB_IGNORES_INDEX = "fb-ignore"
@@ -25,13 +25,9 @@ FB_IGNORES_INDEX = "fb-ignore"
 def write_fb_ignores(csv_filename):
     """
     """
-    with open(csv_filename) as csvfile:
-        reader = csv.DictReader(csvfile)
-
+    with open_reader(csv_filename) as reader:
         outfile_name = "fbignores_{}".format(csv_filename)
-        with open(outfile_name, 'w') as outfile:
-            fieldnames = reader.fieldnames
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        with open_writer(outfile_name, reader.fieldnames) as writer:
             writer.writeheader()
 
             for row in reader:
@@ -1,13 +1,33 @@
 """
 combine_prs_for_contact_notes.py
 
-Combine *_Details csv worksheets from the Persistence Reports into one file
+Combine *_Details worksheets from the Persistence Reports into one file
 containing all relevant Contact Note information.
+
+Takes the Persistence Report workbooks (.xlsx) themselves, reading every
+sheet whose name matches DETAILS_SHEET_PATTERN, or worksheets already
+exported to csv.
+
+Worksheets are parsed in parallel and merged in the order given; each worker
+spools its sheet's rows to a temporary csv file that's streamed back in and
+deleted, so no process holds a whole worksheet in memory. Notes that
+appear in more than one worksheet (same SFID, date, subject and comments)
+are only written once.
 """
 
 import argparse
 import csv
 from datetime import datetime
+from fnmatch import fnmatchcase
+import hashlib
+from multiprocessing import Pool
+import os
+import tempfile
+
+from openpyxl import load_workbook
+
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 
 FIELDS_TO_KEEP = (
     "Campus",
@@ -22,43 +42,222 @@ FIELDS_TO_KEEP = (
     "CN: Communication Status",
     "CN: Mode of Communication",
 )
+MISSING_VALUE = "MISSING"
+DETAILS_SHEET_PATTERN = "*_Details"
+WORKBOOK_EXTENSIONS = (".xlsx", ".xlsm")
+WORKBOOK_DATE_FORMAT = "%m/%d/%Y" # see common_date_formats
+
+NETWORK_ID_I = FIELDS_TO_KEEP.index("Network ID")
+SFID_I = FIELDS_TO_KEEP.index("SFID")
+SALESFORCE_ID_I = FIELDS_TO_KEEP.index("Salesforce ID")
+LAST_I = FIELDS_TO_KEEP.index("Last")
+FIRST_I = FIELDS_TO_KEEP.index("First")
+SUBJECT_I = FIELDS_TO_KEEP.index("CN: Subject")
+COMMENTS_I = FIELDS_TO_KEEP.index("CN: Comments")
+DATE_I = FIELDS_TO_KEEP.index("CN: Date of Communication")
+
 
-def combine_files(input_files):
+def combine_files(input_files, processes=None):
     """Pull FIELDS_TO_KEEP columns from each file and save to one combined
-    for upload_contact_notes.py
+    for upload_contact_notes.py, dropping duplicate notes across files.
+
+    With processes=1 rows are streamed straight through without a pool;
+    otherwise each worker spools its rows to a temporary file (see
+    spool_details_rows). Either way only a row of the input is in memory at
+    a time.
     """
     today = datetime.today()
     output_filename = f"contactnotes_{today.year}{today.month}{today.day}.csv"
-    with open(output_filename, "w") as outhand:
-        outfile_writer = csv.DictWriter(
-            outhand, FIELDS_TO_KEEP, restval="MISSING", extrasaction="ignore"
-        )
-        outfile_writer.writeheader()
+    seen_notes = set()
+    sources = list(find_details_sources(input_files))
 
-        for source_file in input_files:
-            with open(source_file, "r") as inhand:
-                reader = csv.DictReader(inhand)
-                # strip byte-order marking
-                reader.fieldnames[0] = reader.fieldnames[0].strip("\ufeff")
-                print(reader.fieldnames)
+    with open_file(output_filename, "w", newline="") as outhand:
+        outfile_writer = csv.writer(outhand)
+        outfile_writer.writerow(FIELDS_TO_KEEP)
 
-                for row in reader:
-                    outfile_writer.writerow(row)
+        if processes == 1:
+            _write_sources(
+                sources, map(iter_details_rows, sources), outfile_writer,
+                seen_notes,
+            )
+        else:
+            with Pool(processes) as pool:
+                # imap yields in input order, as soon as each sheet is ready
+                spool_files = pool.imap(spool_details_rows, sources)
+                _write_sources(
+                    sources, map(_iter_spooled_rows, spool_files),
+                    outfile_writer, seen_notes,
+                )
 
     print(f"Saved to {output_filename}")
 
 
+def _write_sources(sources, source_rows, outfile_writer, seen_notes):
+    """Write the rows of each source that haven't been seen before."""
+    for (source_file, sheet_name), rows in zip(sources, source_rows):
+        written_count = duplicate_count = 0
+        for row in rows:
+            key = note_key(row)
+            if key in seen_notes:
+                duplicate_count += 1
+                continue
+            seen_notes.add(key)
+            outfile_writer.writerow(row)
+            written_count += 1
+        label = f"{source_file} [{sheet_name}]" if sheet_name else source_file
+        print(
+            f"{label}: {written_count} notes written, "
+            f"{duplicate_count} duplicates dropped"
+        )
+
+
+def find_details_sources(input_files):
+    """Yield a (filename, sheet name) tuple for each *_Details sheet in the
+    workbooks in input_files, or (filename, None) for csv files.
+    """
+    for source_file in input_files:
+        if not _is_workbook(source_file):
+            yield source_file, None
+            continue
+        workbook = load_workbook(source_file, read_only=True)
+        try:
+            sheet_names = [
+                name for name in workbook.sheetnames
+                if fnmatchcase(name, DETAILS_SHEET_PATTERN)
+            ]
+        finally:
+            workbook.close()
+        if not sheet_names:
+            print(f"WARNING: no {DETAILS_SHEET_PATTERN} sheets in {source_file}")
+        for sheet_name in sheet_names:
+            yield source_file, sheet_name
+
+
+def spool_details_rows(source):
+    """Write iter_details_rows to a temporary csv file, for a pool worker to
+    hand back without holding the sheet in memory.
+
+    :return: name of the file, for _iter_spooled_rows to read and delete
+    """
+    fd, spool_filename = tempfile.mkstemp(suffix=".csv")
+    with open(fd, "w", encoding="utf-8", newline="") as spool:
+        csv.writer(spool).writerows(iter_details_rows(source))
+    return spool_filename
+
+
+def _iter_spooled_rows(spool_filename):
+    """Yield the rows spool_details_rows wrote as tuples, then delete the
+    file.
+    """
+    try:
+        with open(spool_filename, encoding="utf-8", newline="") as spool:
+            for row in csv.reader(spool):
+                yield tuple(row)
+    finally:
+        os.remove(spool_filename)
+
+
+def iter_details_rows(source):
+    """Yield a tuple of the FIELDS_TO_KEEP values in each row of the source,
+    with MISSING_VALUE for any column it doesn't have.
+
+    :param source: (filename, sheet name) tuple; sheet name is None for csv
+    """
+    source_file, sheet_name = source
+    if sheet_name is None:
+        yield from _iter_csv_rows(source_file)
+    else:
+        yield from _iter_sheet_rows(source_file, sheet_name)
+
+
+def _iter_csv_rows(source_file):
+    with open_file(source_file, "r", newline="") as inhand:
+        # short rows get "" for their missing trailing columns, like a
+        # blank cell
+        reader = CompactDictReader(inhand, restval="")
+        # strip byte-order marking
+        reader.fieldnames[0] = reader.fieldnames[0].strip("\ufeff")
+
+        for row in reader:
+            yield tuple(row.get(field, MISSING_VALUE) for field in FIELDS_TO_KEEP)
+
+
+def _iter_sheet_rows(source_file, sheet_name):
+    """Stream rows from a worksheet in read-only mode, only converting the
+    FIELDS_TO_KEEP cells.
+    """
+    workbook = load_workbook(source_file, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        headers = [_cell_to_str(h).strip() for h in next(rows, ())]
+        header_positions = {h: i for i, h in enumerate(headers)}
+        positions = [header_positions.get(f) for f in FIELDS_TO_KEEP]
+
+        for values in rows:
+            if not any(v is not None for v in values):
+                continue # blank row
+            yield tuple(
+                MISSING_VALUE if i is None
+                else _cell_to_str(values[i] if i < len(values) else None)
+                for i in positions
+            )
+    finally:
+        workbook.close()
+
+
+def _cell_to_str(value):
+    """Format a cell value the way it'd appear in a csv export."""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime(WORKBOOK_DATE_FORMAT)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _is_workbook(filename):
+    return filename.lower().endswith(WORKBOOK_EXTENSIONS)
+
+
+def note_key(row):
+    """(alum, date, subject, hash of comments) identifying a note across
+    worksheets. Hashing keeps the set of seen notes small.
+
+    The alum is their SFID (or Salesforce ID); a row with neither is
+    identified by its Network ID and name instead, so notes for different
+    alumni without IDs aren't taken as duplicates of one another.
+    """
+    alum = row[SFID_I]
+    if alum in ("", MISSING_VALUE):
+        alum = row[SALESFORCE_ID_I]
+    if alum in ("", MISSING_VALUE):
+        alum = (row[NETWORK_ID_I], row[LAST_I], row[FIRST_I])
+    comments_hash = hashlib.blake2b(
+        row[COMMENTS_I].encode(), digest_size=16
+    ).digest()
+    return (alum, row[DATE_I], row[SUBJECT_I], comments_hash)
+
+
 def parse_args():
     """
-    infiles: input csv files, in the format of *_Details worksheets
-             from the Persistence Reports
+    infiles: Persistence Report workbooks (.xlsx), or csv files in the
+             format of their *_Details worksheets
+    --processes: number of worksheets to parse at once. Defaults to cpu
+                 count; 1 streams without a pool
     """
 
     parser = argparse.ArgumentParser(description="Specify input csv files")
     parser.add_argument(
         "infiles",
         nargs="+",
-        help="Input file (in csv format)"
+        help="Input file (.xlsx workbook or csv)"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worksheets to parse at once. Defaults to cpu count"
     )
     return parser.parse_args()
 
@@ -66,5 +265,4 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
 
-    combine_files(args.infiles)
-
+    combine_files(args.infiles, args.processes)
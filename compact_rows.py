@@ -0,0 +1,163 @@
+"""
+compact_rows.py
+
+A lighter-weight stand-in for csv.DictReader.
+
+csv.DictReader builds a new dict for every row, repeating every header as a
+key. CompactDictReader instead yields Row objects that share one
+header-to-index lookup and hold only a list of values, and interns values
+that repeat across rows (Safe IDs, subjects, modes, etc.) so each distinct
+string is stored once.
+
+Rows behave like the dicts DictReader yields (row[header], .get, .items,
+**row, csv.DictWriter.writerow), so they can be swapped in directly.
+"""
+
+from collections.abc import MutableMapping
+import csv
+import sys
+
+from salesforce_fields import contact_note as cn_fields
+
+# columns whose values repeat from row to row, and so are worth interning
+INTERNED_FIELDS = frozenset((
+    cn_fields.CONTACT,
+    cn_fields.SUBJECT,
+    cn_fields.MODE_OF_COMMUNICATION,
+    cn_fields.COMMUNICATION_STATUS,
+    cn_fields.INITIATED_BY_ALUM,
+    cn_fields.DATE_OF_CONTACT,
+    "OwnerId",
+    "Salesforce Name",
+    "alum_fb_name",
+    "Campus",
+))
+
+
+class Row(MutableMapping):
+    """A csv row, backed by a list of values and a shared header index.
+
+    Keys that aren't in the header (eg. set after reading) are kept in a
+    separate dict, only created when needed.
+    """
+
+    __slots__ = ("_index", "_values", "_extra")
+
+    def __init__(self, index, values):
+        self._index = index # header: position, shared by all rows
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._index[key]]
+        except KeyError:
+            if self._extra is None:
+                raise
+            return self._extra[key]
+
+    def __setitem__(self, key, value):
+        try:
+            self._values[self._index[key]] = value
+        except KeyError:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._index:
+            raise TypeError(f"Can't delete header column {key!r} from a Row")
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __iter__(self):
+        yield from self._index
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return len(self._index) + (len(self._extra) if self._extra else 0)
+
+    def __contains__(self, key):
+        return key in self._index or bool(self._extra and key in self._extra)
+
+    def __repr__(self):
+        return f"Row({dict(self.items())!r})"
+
+
+class CompactDictReader:
+    """Drop-in for csv.DictReader that yields Row objects.
+
+    Like DictReader, missing trailing values are filled with `restval` and
+    surplus values are kept in a list under `restkey`. Values in columns
+    named in `intern_fields` are interned.
+    """
+
+    def __init__(self, f, fieldnames=None, restkey=None, restval=None,
+                 intern_fields=INTERNED_FIELDS, *args, **kwargs):
+        self.reader = csv.reader(f, *args, **kwargs)
+        self._fieldnames = fieldnames
+        self.restkey = restkey
+        self.restval = restval
+        self.intern_fields = intern_fields
+        self._index = None
+        self._intern_positions = ()
+        self.line_num = 0
+
+    def __iter__(self):
+        return self
+
+    @property
+    def fieldnames(self):
+        if self._fieldnames is None:
+            try:
+                self._fieldnames = next(self.reader)
+            except StopIteration:
+                pass
+        self.line_num = self.reader.line_num
+        return self._fieldnames
+
+    @fieldnames.setter
+    def fieldnames(self, value):
+        self._fieldnames = value
+        self._index = None
+
+    def _build_index(self):
+        # built on the first row rather than with the header, since callers
+        # may edit fieldnames in place before reading (eg. to strip a BOM)
+        fieldnames = self.fieldnames
+        self._index = {name: i for i, name in enumerate(fieldnames)}
+        self._intern_positions = tuple(
+            i for i, name in enumerate(fieldnames) if name in self.intern_fields
+        )
+
+    def __next__(self):
+        if self._index is None:
+            if self.fieldnames is None: # empty file, as DictReader allows
+                raise StopIteration
+            self._build_index()
+        row = next(self.reader)
+        self.line_num = self.reader.line_num
+
+        # skip blank rows, as DictReader does
+        while row == []:
+            row = next(self.reader)
+
+        width = len(self._index)
+        surplus = None
+        if len(row) > width:
+            surplus = row[width:]
+            del row[width:]
+        elif len(row) < width:
+            row.extend([self.restval] * (width - len(row)))
+
+        for i in self._intern_positions:
+            value = row[i]
+            if value:
+                row[i] = sys.intern(value)
+
+        compact_row = Row(self._index, row)
+        if surplus is not None:
+            compact_row[self.restkey] = surplus
+        return compact_row
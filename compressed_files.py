@@ -0,0 +1,115 @@
+"""
+compressed_files.py
+
+open() for csv files that may be compressed.
+
+Archived notes and exports are kept as .csv.gz, .bz2, .xz or .zip. open_file
+picks the format from the filename and streams through the (de)compression,
+so nothing has to be unpacked to disk first. Writing to a filename with one
+of these extensions writes compressed output; eg. prepping
+'notes.csv.gz' writes 'prepped_notes.csv.gz'.
+
+Zip archives are read only if they contain a single file. When writing a
+.zip, the archive holds one file named after the archive, minus '.zip'.
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+from os import path
+import zipfile
+
+COMPRESSED_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+ZIP_EXTENSION = ".zip"
+
+
+def open_file(filename, mode="r", encoding=None, newline=None):
+    """Open filename like the builtin open(), (de)compressing by extension.
+
+    Only the args the csv scripts use are supported. Text mode unless mode
+    includes 'b'.
+    """
+    extension = path.splitext(filename)[1].lower()
+    binary = "b" in mode
+    if not binary and "t" not in mode:
+        mode += "t"
+
+    if extension in COMPRESSED_OPENERS:
+        opener = COMPRESSED_OPENERS[extension]
+        if binary:
+            return opener(filename, mode)
+        return opener(filename, mode, encoding=encoding, newline=newline)
+
+    if extension == ZIP_EXTENSION:
+        return _open_zip(filename, mode.replace("t", ""), binary, encoding, newline)
+
+    return open(filename, mode, encoding=encoding, newline=newline)
+
+
+def is_compressed(filename):
+    extension = path.splitext(filename)[1].lower()
+    return extension in COMPRESSED_OPENERS or extension == ZIP_EXTENSION
+
+
+def _open_zip(filename, mode, binary, encoding, newline):
+    if mode.startswith("r"):
+        archive = zipfile.ZipFile(filename, "r")
+        members = [m for m in archive.infolist() if not m.filename.endswith("/")]
+        if len(members) != 1:
+            archive.close()
+            raise ValueError(
+                f"{filename} should contain exactly one file, "
+                f"not {len(members)}"
+            )
+        member = members[0].filename
+    elif mode.startswith("w"):
+        archive = zipfile.ZipFile(filename, "w", compression=zipfile.ZIP_DEFLATED)
+        member = path.basename(filename)[:-len(ZIP_EXTENSION)]
+    else:
+        raise ValueError(f"Unsupported mode for zip files: {mode!r}")
+
+    member_file = _ZipMember(archive, archive.open(member, mode[0]))
+    if binary:
+        return member_file
+    return io.TextIOWrapper(member_file, encoding=encoding, newline=newline)
+
+
+class _ZipMember(io.BufferedIOBase):
+    """A file inside a zip archive that also closes the archive."""
+
+    def __init__(self, archive, member_file):
+        self._archive = archive
+        self._member_file = member_file
+
+    def readable(self):
+        return self._member_file.readable()
+
+    def writable(self):
+        return self._member_file.writable()
+
+    def read(self, size=-1):
+        return self._member_file.read(size)
+
+    def read1(self, size=-1):
+        return self._member_file.read1(size)
+
+    def readinto(self, buffer):
+        data = self._member_file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        return self._member_file.write(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._member_file.close()
+            finally:
+                self._archive.close()
+        super().close()
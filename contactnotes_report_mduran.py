@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 
 import pytz
 
+from compressed_files import open_file
 from salesforce_fields import contact_note as cn_fields
 from salesforce_utils import (
     get_salesforce_connection,
@@ -142,7 +143,7 @@ def generate_report():
 
         report_row.contacts_total += 1
 
-    with open("mduran_contactnotes_report.csv", "w") as fhand:
+    with open_file("mduran_contactnotes_report.csv", "w") as fhand:
         writer = csv.DictWriter(fhand, fieldnames=REPORT_HEADERS)
         writer.writeheader()
         for report_row in report_rows_lookup.values():
@@ -2,27 +2,160 @@
 extract_names_numbers.py
 
 Extract names and phone numbers from a Facebook dump of contact info.
+
+The dump is parsed incrementally, a chunk at a time, and rows of the contacts
+table are written out as soon as they're complete, so the whole page is
+never held in memory. Rows without a name and '+<digits>' number are written
+to a separate rejects file rather than stopping the run.
 """
+import argparse
 import csv
+from html.parser import HTMLParser
 import re
 
-from bs4 import BeautifulSoup as bs
+from compressed_files import open_file
 
 INPUT_FILENAME = "contact_info.htm"
+OUTPUT_FILENAME = "names_numbers.csv"
+REJECTS_FILENAME = "names_numbers_rejects.csv"
+CONTACTS_TABLE_INDEX = 1 # 0-indexed; the contacts are in the second table
+READ_SIZE = 64 * 1024
+
+NUMBER_RE = re.compile(r"\+(\d+)")
+
+
+class ContactTableParser(HTMLParser):
+    """Collect the rows (lists of cell text) of one table in the page.
+
+    Completed rows are appended to `rows`, to be drained by the caller
+    between calls to feed().
+    """
+
+    def __init__(self, table_index=CONTACTS_TABLE_INDEX):
+        super().__init__()
+        self.table_index = table_index
+        self.rows = []
+        self._tables_seen = 0
+        self._table_depth = 0 # nesting depth within the target table
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            if self._table_depth:
+                self._table_depth += 1
+            elif self._tables_seen == self.table_index:
+                self._table_depth = 1
+            self._tables_seen += 1
+        elif self._table_depth != 1:
+            return
+        elif tag == "tr":
+            self._end_row()
+            self._row = []
+        elif tag in ("td", "th"):
+            self._end_cell()
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag == "table" and self._table_depth:
+            if self._table_depth == 1:
+                self._end_row()
+            self._table_depth -= 1
+        elif self._table_depth != 1:
+            return
+        elif tag == "tr":
+            self._end_row()
+        elif tag in ("td", "th"):
+            self._end_cell()
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def _end_cell(self):
+        if self._cell is not None and self._row is not None:
+            self._row.append("".join(self._cell).strip())
+        self._cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self._row is not None:
+            self.rows.append(self._row)
+        self._row = None
+
+
+def extract_names_numbers(input_filename=INPUT_FILENAME,
+                          output_filename=OUTPUT_FILENAME,
+                          rejects_filename=REJECTS_FILENAME):
+    """Write (name, blank Safe ID, number) for each contact to
+    output_filename, and rows that couldn't be parsed to rejects_filename.
+    """
+    written_count = rejected_count = 0
+
+    with open_file(output_filename, "w", newline="") as outhand, \
+            open_file(rejects_filename, "w", newline="") as rejecthand:
+        writer = csv.writer(outhand)
+        # add a row for adding Safe ID later
+        writer.writerow(("Name", "Contact__c", "Mobile"))
+        reject_writer = csv.writer(rejecthand)
+        reject_writer.writerow(("Row", "Cells", "Reason"))
+
+        for row_number, cells in enumerate(_iter_table_rows(input_filename)):
+            if row_number == 0:
+                continue # first is header
+            try:
+                name, number = parse_contact_row(cells)
+            except ValueError as e:
+                reject_writer.writerow((row_number, " | ".join(cells), str(e)))
+                rejected_count += 1
+                continue
+            writer.writerow((name, "", number))
+            written_count += 1
+
+    print(f"Saved {written_count} contacts to {output_filename}")
+    if rejected_count:
+        print(f"Couldn't parse {rejected_count} rows; see {rejects_filename}")
+
+
+def parse_contact_row(cells):
+    """Return (name, number) from a row's cells, or raise ValueError."""
+    if len(cells) < 2:
+        raise ValueError(f"Expected 2 cells, found {len(cells)}")
+    name = cells[0]
+    if not name:
+        raise ValueError("No name")
+    number_match = NUMBER_RE.search(cells[1])
+    if number_match is None:
+        raise ValueError("No +<digits> number")
+    return name, number_match.group(1)
+
+
+def _iter_table_rows(input_filename):
+    """Yield the rows of the contacts table as they're parsed."""
+    parser = ContactTableParser()
+    with open_file(input_filename, "r") as fhand:
+        for chunk in iter(lambda: fhand.read(READ_SIZE), ""):
+            parser.feed(chunk)
+            yield from parser.rows
+            parser.rows.clear()
+    parser.close()
+    yield from parser.rows
+
 
-with open(INPUT_FILENAME, "r") as fhand:
-    contact_soup = bs(fhand.read(), "html.parser")
+def parse_args():
+    """
+    * --infile: Facebook contact info page. Defaults to contact_info.htm
+    """
 
-contact_soup = contact_soup.select("table")[1]
-number_re = re.compile("\+(\d+)")
+    parser = argparse.ArgumentParser(description="Specify input file")
+    parser.add_argument(
+        "--infile",
+        default=INPUT_FILENAME,
+        help=f"Facebook contact info (.htm) file. Defaults to {INPUT_FILENAME}"
+    )
+    return parser.parse_args()
 
-with open("names_numbers.csv", "w") as fhand:
-    writer = csv.writer(fhand)
-    # add a row for adding Safe ID later
-    writer.writerow(("Name", "Contact__c", "Mobile"))
-    for row in contact_soup.select("tr")[1:]: # first is header
-        cells = row.select("td")
-        name = cells[0].text.strip()
-        number = number_re.search(cells[1].text.strip()).groups()[0]
-        writer.writerow((name, "", number))
 
+if __name__ == "__main__":
+    args = parse_args()
+    extract_names_numbers(args.infile)
@@ -1,8 +1,9 @@
 """
 fb_messages_to_csv.py
 
-Process a directory (of directories) of json files of Facebook messages,
-saving them out to a csv to be uploaded by upload_contact_notes.py.
+Process a directory (of directories) of json files of Facebook messages, or
+the downloaded zip archive of them, saving them out to a csv to be uploaded
+by upload_contact_notes.py.
 Works for Facebook message dump format as of October 2018.
 
 TODO: tests, ignore blank exchanges, tweak output for compatability with
@@ -11,33 +12,58 @@ fb_names_to_sf_ids script, fb_utils repo?, etc.
 
 import argparse
 from collections import namedtuple
-import csv
-from datetime import datetime
+from contextlib import nullcontext
+import hashlib
+import heapq
+import io
+from itertools import islice, starmap
 import json
+from multiprocessing import Pool
+from operator import attrgetter
 import os
+import posixpath
+import re
+import sys
+import zipfile
 
 from salesforce_utils.constants import SALESFORCE_DATESTRING_FORMAT
+from json_stream import iter_object_items
+from local_days import (
+    day_boundaries,
+    day_keys,
+    day_to_date,
+    format_local,
+    LocalDays,
+    SECONDS_PER_DAY,
+)
+from phrase_matcher import compile_phrases, load_phrases
 from salesforce_fields import contact_note as cn_fields
+from staging import open_writer
 
 
-MESSAGES_FILENAME = "message.json"
+# a conversation's messages are in message.json, or split across
+# message_1.json, message_2.json, ... in newer downloads
+MESSAGES_FILENAME_RE = re.compile(r"message(?:_(\d+))?\.json")
+ZIP_EXTENSION = ".zip"
+ZIP_MESSAGES_FOLDER = "messages" # message files are somewhere under here
+OUTPUT_FILENAME = "fb_messages.csv"
+CONVERSATIONS_PER_TASK = 8 # folders sent to a pool worker at a time
 MESSAGES_ENCODING = "latin_1"
+MESSAGE_FILES_ENCODING = "utf-8" # json; the same read from a dir or a zip
+HASH_BLOCK_SIZE = 1 << 20
+PARTICIPANTS = "participants"
+MESSAGES = "messages"
 SENDER_NAME = "sender_name"
 TIMESTAMP_MS = "timestamp_ms"
 CONTENT = "content"
 
-# Lowercase versions of meta facebook messages that appear in conversation history.
-# These are just the irrelevant ones to ignore. There are others that we'll
-# ignore for now (eg. "You sent a photo", "You created the reminder Meetup")
-# as they may provide context to the conversation, or they're too general to
-# filter out (eg. "say hello to")
-LOWERCASE_FB_META_MESSAGES = (
-    "you can now call each other and see information like active status and when you've read messages",
-    "say hi to your new facebook friend,", # {first name}
-    "sent you an invite to join messenger",
-    "sent an attachment", # anecdotally, seen with the 'invite to join messenger' message
-    "is waving at you!",
+# Meta facebook messages to ignore, one per line; see the file for details
+META_MESSAGES_FILENAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fb_meta_messages.txt"
 )
+_meta_message_re = None # compiled from META_MESSAGES_FILENAME on first use
+_local_days = LocalDays() # see set_timezone
+DAY_KEY_CHUNK_SIZE = 4096 # messages converted to local days at a time
 
 # Mode of Communication for all Facebook exchanges
 SOCIAL_NETWORKING_MOC = "Social Networking"
@@ -52,76 +78,410 @@ facebook_note_keys = [
     "initiated_by_alum",
     "subject",
 ]
-Message = namedtuple("Message", ["participant", "datetime", "content"])
 FacebookNote = namedtuple("FacebookNote", facebook_note_keys)
 
-def process_fb_dump(messages_dir):
-    """Create a csv of Facebook messages from json files in messages_dir,
-    grouped by alum by day.
+
+class Message(namedtuple("Message", ["participant", "timestamp_ms", "content"])):
+    """A single Facebook message. Keeps the raw millisecond timestamp rather
+    than a datetime per message; see local_days.py for converting them.
     """
-    with open("fb_messages.csv", "w", encoding=MESSAGES_ENCODING) as fhand:
-        writer = csv.DictWriter(fhand, fieldnames=facebook_note_keys)
+    __slots__ = ()
+
+
+def process_fb_dump(messages_dir, output_filename=OUTPUT_FILENAME,
+                    processes=None, meta_messages_filename=META_MESSAGES_FILENAME,
+                    manifest_filename=None, timezone_name=None):
+    """Create a csv (or staging file; see staging.py) of Facebook messages
+    from json files in messages_dir, grouped by alum by day.
+
+    messages_dir may also be the downloaded .zip archive, which is read in
+    place; see find_zip_conversations.
+
+    Conversation folders are parsed on a pool of `processes` worker
+    processes (defaults to cpu count; 1 parses in this process) and written
+    out in sorted folder order, so the output is the same either way.
+
+    Messages containing any of the phrases in meta_messages_filename are
+    left out.
+
+    With a manifest_filename, only what's new since the last run with that
+    manifest is written out; see load_manifest. The manifest is updated once
+    the output has been written.
+
+    Days and times are in timezone_name (eg. 'America/Chicago'), or this
+    machine's local time by default.
+    """
+    meta_messages = load_phrases(meta_messages_filename)
+    set_timezone(timezone_name)
+    manifest = None
+    if manifest_filename is not None:
+        manifest = load_manifest(manifest_filename)
+    tasks, updated_entries = plan_fb_dump(messages_dir, manifest)
+
+    with open_writer(
+        output_filename, facebook_note_keys, encoding=MESSAGES_ENCODING
+    ) as writer:
         writer.writeheader()
+        for facebook_note in iter_fb_dump_notes(
+            tasks, processes, meta_messages, timezone_name
+        ):
+            writer.writerow(facebook_note._asdict())
+
+    if manifest is not None:
+        update_manifest(manifest, updated_entries)
+        save_manifest(manifest_filename, manifest)
 
-        for conversation_folder in os.listdir(messages_dir):
-            msgs_filepath = os.path.abspath(os.path.join(
-                messages_dir, conversation_folder, MESSAGES_FILENAME
-            ))
-            alum_fb_name, messages = parse_messages(msgs_filepath)
 
-            if not messages:
+def plan_fb_dump(messages_dir, manifest=None):
+    """Find the conversations in messages_dir (a directory or .zip) to parse.
+
+    :param manifest: optional dict from load_manifest; if given, unchanged
+        conversations are left out, and the rest are only read from their
+        watermark's day
+    :return: list of (msgs_filepaths, since_ms) tasks for
+        iter_fb_dump_notes, and a dict of conversation folder to
+        (msgs_filepaths, new manifest entry) for update_manifest
+    :rtype: tuple
+    """
+    if messages_dir.lower().endswith(ZIP_EXTENSION):
+        conversations = find_zip_conversations(messages_dir)
+    else:
+        conversations = [
+            (conversation_folder, find_message_files(os.path.abspath(
+                os.path.join(messages_dir, conversation_folder)
+            )))
+            for conversation_folder in sorted(os.listdir(messages_dir))
+        ]
+
+    tasks = [] # (msgs_filepaths, since_ms)
+    updated_entries = {}
+    for conversation_folder, msgs_filepaths in conversations:
+        if not msgs_filepaths:
+            print(f"WARNING: No message files in {conversation_folder}")
+            continue
+        if manifest is None:
+            tasks.append((msgs_filepaths, None))
+            continue
+
+        entry = manifest.get(conversation_folder)
+        new_entry = _changed_manifest_entry(msgs_filepaths, entry)
+        if new_entry is None:
+            continue
+        since_ms = None
+        if entry is not None and entry.get("watermark_ms") is not None:
+            since_ms = _day_start_ms(entry["watermark_ms"])
+        tasks.append((msgs_filepaths, since_ms))
+        updated_entries[conversation_folder] = (msgs_filepaths, new_entry)
+
+    if manifest is not None:
+        print(f"{len(tasks)} of {len(conversations)} conversations "
+              "changed since the last run")
+    return tasks, updated_entries
+
+
+def iter_fb_dump_notes(tasks, processes=None, meta_messages=None,
+                       timezone_name=None, pool=None):
+    """Yield the FacebookNotes for tasks (see plan_fb_dump), in task order.
+
+    :param processes: number of worker processes to parse on (defaults to
+        cpu count; 1 parses in this process)
+    :param meta_messages: optional tuple of meta message phrases to leave
+        out; defaults to those in META_MESSAGES_FILENAME
+    :param timezone_name: optional timezone for days and times; defaults to
+        this machine's local time
+    :param pool: optional pool from open_parse_pool to parse on, instead of
+        starting one here. Pass one when this generator is run from a
+        thread other than the main one: forking while other threads are
+        running can deadlock the workers.
+    """
+    if meta_messages is None:
+        meta_messages = load_phrases(META_MESSAGES_FILENAME)
+    _init_worker(meta_messages, timezone_name)
+
+    try:
+        if processes == 1:
+            for facebook_notes in starmap(iter_conversation_notes, tasks):
+                yield from facebook_notes
+            return
+        if pool is not None:
+            yield from _iter_pool_notes(pool, tasks)
+            return
+        with open_parse_pool(processes, meta_messages, timezone_name) as pool:
+            yield from _iter_pool_notes(pool, tasks)
+    finally:
+        close_archives()
+
+
+def open_parse_pool(processes=None, meta_messages=None, timezone_name=None):
+    """Pool of worker processes for iter_fb_dump_notes, with its settings;
+    or, with processes=1, an empty context (None), since that parses in
+    this process. Use as a context manager.
+    """
+    if processes == 1:
+        return nullcontext()
+    if meta_messages is None:
+        meta_messages = load_phrases(META_MESSAGES_FILENAME)
+    return Pool(
+        processes, initializer=_init_worker,
+        initargs=(meta_messages, timezone_name),
+    )
+
+
+def _iter_pool_notes(pool, tasks):
+    for facebook_notes in pool.imap(
+        _conversation_task, tasks, chunksize=CONVERSATIONS_PER_TASK
+    ):
+        yield from facebook_notes
+
+
+def update_manifest(manifest, updated_entries):
+    """Record the conversations parsed (see plan_fb_dump) in manifest, with
+    their new watermarks. Call once their notes are safely written out.
+    """
+    try:
+        for conversation_folder, (msgs_filepaths, new_entry) in \
+                updated_entries.items():
+            old_watermark = \
+                manifest.get(conversation_folder, {}).get("watermark_ms")
+            newest = read_newest_timestamp(msgs_filepaths)
+            new_entry["watermark_ms"] = max(
+                (ms for ms in (old_watermark, newest) if ms is not None),
+                default=None,
+            )
+            manifest[conversation_folder] = new_entry
+    finally:
+        close_archives()
+
+
+def _conversation_task(task):
+    return conversation_to_notes(*task)
+
+
+def find_message_files(conversation_dir):
+    """Paths of the message files in conversation_dir, in part order
+    (message.json or message_1.json first).
+    """
+    parts = []
+    for filename in os.listdir(conversation_dir):
+        match = MESSAGES_FILENAME_RE.fullmatch(filename)
+        if match:
+            parts.append((int(match.group(1) or 0), filename))
+    return [
+        os.path.join(conversation_dir, filename)
+        for _, filename in sorted(parts)
+    ]
+
+
+def find_zip_conversations(archive_filename):
+    """Find the conversations in a downloaded Facebook zip archive.
+
+    Only the archive's directory is read; nothing is extracted. Message
+    files are the messages/**/message*.json members, grouped into
+    conversations by the folder they're in.
+
+    Conversations are named by their folder's path under messages/ (eg.
+    inbox/alum_abc123), since the same folder name can be under both inbox/
+    and archived_threads/.
+
+    :return: list of (conversation folder path, list of ZipMessageFile in
+        part order), sorted by folder
+    :rtype: list
+    """
+    conversations = {}
+    with zipfile.ZipFile(archive_filename) as archive:
+        for info in archive.infolist():
+            folder, _, filename = info.filename.rpartition("/")
+            match = MESSAGES_FILENAME_RE.fullmatch(filename)
+            if not match or not _in_messages_folder(folder):
                 continue
-            for facebook_note in group_messages_into_notes(messages, alum_fb_name):
-                writer.writerow(facebook_note._asdict())
+            conversations.setdefault(folder, []).append((
+                int(match.group(1) or 0),
+                ZipMessageFile(
+                    archive_filename=os.path.abspath(archive_filename),
+                    member=info.filename, size=info.file_size, crc=info.CRC,
+                ),
+            ))
+    return [
+        (_path_under_messages(folder), [part for _, part in sorted(parts)])
+        for folder, parts in sorted(conversations.items())
+    ]
+
+
+def _in_messages_folder(folder):
+    return ZIP_MESSAGES_FOLDER in folder.split("/")
+
+
+def _path_under_messages(folder):
+    """folder's path relative to its ZIP_MESSAGES_FOLDER."""
+    parts = folder.split("/")
+    return "/".join(parts[parts.index(ZIP_MESSAGES_FOLDER) + 1:])
+
+
+class ZipMessageFile(namedtuple(
+        "ZipMessageFile", ["archive_filename", "member", "size", "crc"])):
+    """A message file inside a downloaded zip archive. Just names and the
+    member's size and CRC from the archive's directory, so it can be sent to
+    pool workers.
+    """
+    __slots__ = ()
+
+    def open(self):
+        """Open the member as text, decompressing as it's read."""
+        archive = _open_archives.get(self.archive_filename)
+        if archive is None:
+            archive = zipfile.ZipFile(self.archive_filename)
+            _open_archives[self.archive_filename] = archive
+        return io.TextIOWrapper(
+            archive.open(self.member), encoding=MESSAGE_FILES_ENCODING
+        )
+
+
+# archives opened by this process, so the directory of each is only read
+# once; closed at the end of each run by close_archives
+_open_archives = {}
+
+
+def close_archives():
+    """Close the archives ZipMessageFile.open has opened in this process."""
+    while _open_archives:
+        _, archive = _open_archives.popitem()
+        archive.close()
+
+
+def _open_message_file(message_json_file):
+    """Open a message file path or ZipMessageFile for reading."""
+    if isinstance(message_json_file, ZipMessageFile):
+        return message_json_file.open()
+    return open(message_json_file, "r", encoding=MESSAGE_FILES_ENCODING)
+
+
+def conversation_to_notes(msgs_filepaths, since_ms=None):
+    """List of the FacebookNotes from one conversation's message files.
+
+    Module-level (and taking only paths) so pool workers can run it.
+    """
+    return list(iter_conversation_notes(msgs_filepaths, since_ms))
+
+
+def iter_conversation_notes(msgs_filepaths, since_ms=None):
+    """Yield FacebookNotes from one conversation's message files, reading
+    one day of messages at a time. With since_ms, only messages from then on
+    are read.
+    """
+    alum_fb_name, messages = parse_conversation(msgs_filepaths, since_ms)
+    yield from group_messages_into_notes(messages, alum_fb_name)
 
 
 def group_messages_into_notes(messages, alum_fb_name):
     """Group messages into facebook contact notes by date of message.
 
-    :param messages: list of Message namedtuples
+    Messages come newest first (see parse_conversation), so each day's
+    messages are already together; only one day's batch is held at a time,
+    and it's just reversed, not sorted.
+
+    Messages are converted to local days DAY_KEY_CHUNK_SIZE at a time (see
+    local_days.py), and days are split where neighbouring messages' days
+    differ. Messages that aren't from the current year get one warning for
+    the conversation.
+
+    :param messages: iterable of Message namedtuples, newest first
     :param alum_fb_name: 
-    :return: list of Contact Note namedtuples, to be written to output file
-    :rtype: list
+    :return: generator of Contact Note namedtuples, to be written to output
+        file
+    :rtype: generator
     """
-    messages = sorted(messages, key=lambda x: x.datetime)
-    contact_notes = []
+    this_year = _local_days.current_year()
+    year_start, year_end = _local_days.year_bounds(this_year)
+    other_year_seconds = [] # (min, max, count) of each chunk's
+
     same_day_batch = []
-    last_seen_msg_date = messages[0].datetime.date()
-    for message in messages:
-        if message.datetime.date() == last_seen_msg_date:
-            same_day_batch.append(message)
-            continue
-        contact_notes.append(make_contact_note(same_day_batch, alum_fb_name))
-        same_day_batch = [message]
-        last_seen_msg_date = message.datetime.date()
+    same_day_seconds = []
+    last_seen_day = None
+    seen_days = set()
+    messages = iter(messages)
+    while True:
+        chunk = list(islice(messages, DAY_KEY_CHUNK_SIZE))
+        if not chunk:
+            break
+        seconds = _local_days.local_seconds(
+            [message.timestamp_ms for message in chunk]
+        )
+        outside = [s for s in seconds if not year_start <= s < year_end]
+        if outside:
+            other_year_seconds.append((min(outside), max(outside), len(outside)))
+
+        keys = day_keys(seconds)
+        starts = [0] + day_boundaries(keys)
+        ends = starts[1:] + [len(chunk)]
+        for start, end in zip(starts, ends):
+            day = keys[start]
+            if day == last_seen_day:
+                same_day_batch.extend(chunk[start:end])
+                same_day_seconds.extend(seconds[start:end])
+                continue
+            if same_day_batch:
+                yield _make_day_note(same_day_batch, same_day_seconds, alum_fb_name)
+            if day in seen_days:
+                print(
+                    f"WARNING: messages with {alum_fb_name} from "
+                    f"{day_to_date(day)} aren't together; that day will have "
+                    "more than one note"
+                )
+            seen_days.add(day)
+            same_day_batch = chunk[start:end]
+            same_day_seconds = list(seconds[start:end])
+            last_seen_day = day
 
     # flush remaining
-    contact_notes.append(make_contact_note(same_day_batch, alum_fb_name))
+    if same_day_batch:
+        yield _make_day_note(same_day_batch, same_day_seconds, alum_fb_name)
+
+    if other_year_seconds:
+        earliest = min(bounds[0] for bounds in other_year_seconds)
+        latest = max(bounds[1] for bounds in other_year_seconds)
+        count = sum(bounds[2] for bounds in other_year_seconds)
+        print(
+            f"WARNING: {count} FB messages with {alum_fb_name} aren't from "
+            f"{this_year}: {format_local(earliest)} to {format_local(latest)}"
+        )
 
-    return contact_notes
+
+def _make_day_note(newest_first_batch, newest_first_seconds, alum_fb_name):
+    newest_first_batch.reverse()
+    newest_first_seconds.reverse()
+    return make_contact_note(
+        newest_first_batch, alum_fb_name, newest_first_seconds
+    )
 
 
-def make_contact_note(messages, alum_fb_name):
+def make_contact_note(messages, alum_fb_name, local_seconds=None):
     """Make a single FacebookNote namedtuple from messages.
 
-    :param messages: list of Message namedtuples (all from the same day)
+    :param messages: list of Message namedtuples (all from the same day),
+        oldest first
     :param alum_fb_name: 
+    :param local_seconds: optional list of the messages' local times (see
+        local_days.py), if they've already been converted
     :return: FacebookNote namedtuple
     :rtype: FacebookNote
     """
-    messages = sorted(messages, key=lambda x: x.datetime)
+    if local_seconds is None:
+        local_seconds = _local_days.local_seconds(
+            [message.timestamp_ms for message in messages]
+        )
     message_lines = []
-    for message in messages:
+    for message, local_second in zip(messages, local_seconds):
         message_lines.append(
-            f"{message.participant}@{message.datetime}: {message.content}"
+            f"{message.participant}@{format_local(local_second)}: {message.content}"
         )
     initiated_by_alum, comm_status, subject = \
         get_nature_of_exchange(messages, alum_fb_name)
+    day = day_to_date(local_seconds[0] // SECONDS_PER_DAY)
     note = FacebookNote(
         alum_fb_name=alum_fb_name,
         contact="", # to be queried for later, from alum name
         comments="\n".join(message_lines),
-        date_of_contact=messages[0].datetime.strftime(SALESFORCE_DATESTRING_FORMAT),
+        date_of_contact=day.strftime(SALESFORCE_DATESTRING_FORMAT),
         mode_of_communication=SOCIAL_NETWORKING_MOC,
         communication_status=comm_status,
         initiated_by_alum=initiated_by_alum,
@@ -131,49 +491,228 @@ def make_contact_note(messages, alum_fb_name):
     return note
 
 
-def parse_messages(message_json_file):
-    """Open message_json_file and parse out messages.
+def parse_conversation(msgs_filepaths, since_ms=None):
+    """Parse a conversation's message files into the alum's name and a
+    single stream of their messages, newest first.
 
-    Filters out LOWERCASE_FB_META_MESSAGES that aren't relevant to the
-    interaction. Others that could provide context will be kept
-    (eg. "You sent a photo", "You created the reminder Meetup", etc.).
+    Each part file lists its messages newest first, so the parts are merged
+    on a heap by timestamp_ms, holding one message per part at a time.
 
-    :param message_json_file: str abs path to an json message file
-    :return: str (presumed alumni's) name on Facebook, list of Message namedtuples
+    :param msgs_filepaths: list of str paths (or ZipMessageFiles) of the
+        conversation's message files, in part order (see find_message_files)
+    :param since_ms: optional ms timestamp; older messages are left out
+    :return: str (presumed alumni's) name on Facebook, iterator of Message
+        namedtuples
     :rtype: tuple
     """
-    messages = []
+    alum_fb_name, messages = parse_messages(msgs_filepaths[0], since_ms)
+    if len(msgs_filepaths) == 1:
+        return alum_fb_name, messages
+
+    parts = [messages] + [
+        iter_messages(msgs_filepath, since_ms)
+        for msgs_filepath in msgs_filepaths[1:]
+    ]
+    return alum_fb_name, heapq.merge(
+        *parts, key=attrgetter("timestamp_ms"), reverse=True
+    )
+
 
-    with open(message_json_file, "r") as fhand:
-        msgs_dict = json.loads(fhand.read())
+def parse_messages(message_json_file, since_ms=None):
+    """Parse message_json_file into the alum's name and their messages.
 
-    num_participants = len(msgs_dict["participants"])
+    The file is read incrementally (see json_stream.py), so only one message
+    at a time is decoded, rather than loading the whole conversation.
+
+    Filters out meta messages (see META_MESSAGES_FILENAME) that aren't
+    relevant to the interaction. Others that could provide context will be kept
+    (eg. "You sent a photo", "You created the reminder Meetup", etc.).
+
+    :param message_json_file: str abs path to an json message file, or a
+        ZipMessageFile
+    :param since_ms: optional ms timestamp; older messages are left out
+    :return: str (presumed alumni's) name on Facebook, generator of Message
+        namedtuples
+    :rtype: tuple
+    """
+    participants = read_participants(message_json_file)
+
+    num_participants = len(participants)
     if num_participants != 2:
         # haven't seen this yet but it was possible in previous formats...
-        print(f"WARNING: More than two participants found in a conversation: {msgs_dict['participants']}")
+        print(f"WARNING: More than two participants found in a conversation: {participants}")
 
     # seems reliable that first participant is the 'other'; ie. not the account
     # that generated the messages download. Meaning that the second should
     # always be the AC
-    alum_fb_name = msgs_dict["participants"][0]["name"]
-
-    for message in msgs_dict["messages"]:
-        message_sender = message[SENDER_NAME]
-        msg_datetime = convert_fb_time(message[TIMESTAMP_MS])
-
-        msg_content = message[CONTENT]
-        is_meta_message = False
-        for message_to_ignore in LOWERCASE_FB_META_MESSAGES:
-            if message_to_ignore in msg_content.lower():
-                is_meta_message = True
-
-        if not is_meta_message:
-            messages.append(Message(
-                participant=message_sender, datetime=msg_datetime,
-                content=msg_content
-            ))
+    alum_fb_name = participants[0]["name"]
+
+    return alum_fb_name, iter_messages(message_json_file, since_ms)
+
+
+def read_participants(message_json_file):
+    """Return the list of participants from the head of message_json_file,
+    without reading the messages.
+    """
+    with _open_message_file(message_json_file) as fhand:
+        for key, value in iter_object_items(fhand, streamed_keys=(MESSAGES,)):
+            if key == PARTICIPANTS:
+                return value
+    raise ValueError(f"No {PARTICIPANTS} in {message_json_file}")
+
+
+def iter_messages(message_json_file, since_ms=None):
+    """Yield Message namedtuples from message_json_file, one at a time,
+    skipping meta messages.
+
+    Facebook lists messages newest first, so with since_ms, reading stops at
+    the first message older than since_ms.
+    """
+    with _open_message_file(message_json_file) as fhand:
+        for key, value in iter_object_items(fhand, streamed_keys=(MESSAGES,)):
+            if key != MESSAGES:
+                continue
+            for message in value:
+                # names repeat on every message; keep one copy of each
+                message_sender = sys.intern(message[SENDER_NAME])
+                msg_timestamp = message[TIMESTAMP_MS]
+                if since_ms is not None and msg_timestamp < since_ms:
+                    return
+
+                msg_content = message[CONTENT]
+                if not is_meta_message(msg_content.lower()):
+                    yield Message(
+                        participant=message_sender, timestamp_ms=msg_timestamp,
+                        content=msg_content
+                    )
+
+
+def read_newest_timestamp(msgs_filepaths):
+    """ms timestamp of the newest message in a conversation's message files
+    (the first in each), or None if they have no messages.
+    """
+    newest = None
+    for msgs_filepath in msgs_filepaths:
+        with _open_message_file(msgs_filepath) as fhand:
+            for key, value in iter_object_items(
+                fhand, streamed_keys=(MESSAGES,)
+            ):
+                if key != MESSAGES:
+                    continue
+                for message in value:
+                    if newest is None or message[TIMESTAMP_MS] > newest:
+                        newest = message[TIMESTAMP_MS]
+                    break
+                break
+    return newest
+
 
-    return alum_fb_name, messages
+def load_manifest(manifest_filename):
+    """Load the manifest of conversations processed by earlier runs, or an
+    empty one if manifest_filename doesn't exist yet.
+
+    Each Facebook download has the full history of every conversation, so
+    the manifest records, per conversation folder, its message files' mtimes
+    and sizes, a hash of them, and a watermark: the newest message timestamp
+    already written out. Conversations whose files haven't changed are
+    skipped; the rest are read back to the start of the watermark's day.
+    That day is written out again in full, since messages may have been
+    added to it after the last run (unchanged days are caught by the
+    duplicate check in upload_contact_notes).
+
+    :return: dict of conversation folder name to entry dict
+    :rtype: dict
+    """
+    if not os.path.exists(manifest_filename):
+        return {}
+    with open(manifest_filename, "r") as fhand:
+        return json.load(fhand)["conversations"]
+
+
+def save_manifest(manifest_filename, manifest):
+    """Write manifest out, replacing manifest_filename only once it's whole."""
+    temp_filename = manifest_filename + ".tmp"
+    with open(temp_filename, "w") as fhand:
+        json.dump({"conversations": manifest}, fhand, indent=2, sort_keys=True)
+    os.replace(temp_filename, manifest_filename)
+
+
+def _changed_manifest_entry(msgs_filepaths, entry):
+    """New manifest entry (without a watermark) for a conversation's message
+    files, or None if they're unchanged since entry was recorded.
+
+    Matching mtimes and sizes are taken as unchanged without reading the
+    files; otherwise the files are hashed, so re-extracted but identical
+    files are still skipped. Files in a zip archive are compared by the size
+    and CRC in the archive's directory instead.
+    """
+    if isinstance(msgs_filepaths[0], ZipMessageFile):
+        files = {
+            posixpath.basename(msgs_file.member): {
+                "size": msgs_file.size,
+                "crc": msgs_file.crc,
+            }
+            for msgs_file in msgs_filepaths
+        }
+        if entry is not None and entry.get("files") == files:
+            return None
+        return {"files": files}
+
+    files = {}
+    for msgs_filepath in msgs_filepaths:
+        stat = os.stat(msgs_filepath)
+        files[os.path.basename(msgs_filepath)] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+        }
+    if entry is not None and entry.get("files") == files:
+        return None
+
+    digest = hashlib.sha256()
+    for msgs_filepath in msgs_filepaths:
+        digest.update(os.path.basename(msgs_filepath).encode())
+        with open(msgs_filepath, "rb") as fhand:
+            for block in iter(lambda: fhand.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    sha256 = digest.hexdigest()
+    if entry is not None and entry.get("sha256") == sha256:
+        entry["files"] = files
+        return None
+    return {"files": files, "sha256": sha256}
+
+
+def _day_start_ms(ms_timestamp):
+    """ms timestamp of the (local) midnight starting ms_timestamp's day."""
+    local_second = _local_days.local_seconds([ms_timestamp])[0]
+    midnight = local_second - local_second % SECONDS_PER_DAY
+    return _local_days.to_utc_seconds(midnight) * 1000
+
+
+def set_meta_messages(phrases):
+    """Compile the phrases that mark a message as a meta message."""
+    global _meta_message_re
+    _meta_message_re = compile_phrases(phrases)
+
+
+def set_timezone(timezone_name=None):
+    """Use timezone_name (eg. 'America/Chicago') for message days and
+    times, rather than this machine's local time.
+    """
+    global _local_days
+    _local_days = LocalDays(timezone_name)
+
+
+def _init_worker(meta_messages, timezone_name):
+    """Pool initializer, so workers share the parent's settings."""
+    set_meta_messages(meta_messages)
+    set_timezone(timezone_name)
+
+
+def is_meta_message(lowercase_content):
+    """True if lowercase_content contains any of the meta message phrases."""
+    if _meta_message_re is None:
+        set_meta_messages(load_phrases(META_MESSAGES_FILENAME))
+    return _meta_message_re.search(lowercase_content) is not None
 
 
 def get_nature_of_exchange(messages, alum_fb_name):
@@ -216,19 +755,6 @@ def get_nature_of_exchange(messages, alum_fb_name):
     return (str(initiated_by_alum), communication_status, subject)
 
 
-def convert_fb_time(ms_timestamp):
-    """Converts the millisecond timestamp from facebook to a datetime object
-    after converting to POSIX seconds timestamp.
-    """
-    msg_datetime = datetime.fromtimestamp(ms_timestamp//1000)
-    # weak sanity check; this will happen after new years but I'd like to see
-    # if/when this occurs
-    if msg_datetime.year != datetime.today().year:
-        print(f"WARNING: FB message year doesn't match current year: {msg_datetime}")
-
-    return msg_datetime
-
-
 def parse_args():
     """
     """
@@ -236,11 +762,44 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Specify messages directory")
     parser.add_argument(
         "messages_dir",
-        help="Directory containing messages in .html files"
+        help="Directory of conversation folders, or the downloaded .zip"
+    )
+    parser.add_argument(
+        "--outfile",
+        default=OUTPUT_FILENAME,
+        help=f"Output file (csv, or .sqlite staging). Defaults to {OUTPUT_FILENAME}"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worker processes. Defaults to cpu count"
+    )
+    parser.add_argument(
+        "--meta-messages",
+        default=META_MESSAGES_FILENAME,
+        help="File of meta message phrases to ignore, one per line. Defaults"
+             " to fb_meta_messages.txt"
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help="Manifest (json) of conversations from earlier runs. If given,"
+             " only messages that are new since then are written out, and the"
+             " manifest is updated"
+    )
+    parser.add_argument(
+        "--timezone",
+        default=None,
+        help="Timezone for message days and times (eg. America/Chicago)."
+             " Defaults to this machine's local time"
     )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    process_fb_dump(args.messages_dir)
+    process_fb_dump(
+        args.messages_dir, args.outfile, args.processes, args.meta_messages,
+        args.manifest, args.timezone
+    )
@@ -6,17 +6,26 @@ for the (full) Facebook name. Write matches back out to csv.
 """
 
 import argparse
-import csv
 from collections import namedtuple
 
-from elasticsearch.helpers import scan as es_scan
 from elasticsearch_dsl.connections import connections as es_connections
 
+from match_cache import MATCH_CACHE_TTL_DAYS, open_match_cache
+from name_matching import (
+    choose_match,
+    LocalNameIndex,
+    MatchDeferred,
+    MatchReview,
+    MSEARCH_BATCH_SIZE,
+    MSEARCH_CONCURRENCY,
+    multi_search,
+    name_search,
+    search_name,
+    split_matches,
+)
 from salesforce_fields import contact_note as cn_fields
 from secrets.elastic_secrets import ES_CONNECTION_KEY
-
-ACCEPT_MATCH_SCORE = 7.5 # score at which matches are "blindly" accepted
-MIN_SCORE_THRESHOLD = 2 # only return results from ES with this score or higher
+from staging import open_reader, open_writer
 
 FACEBOOK_NAME_HEADER = "alum_fb_name"
 SALESFORCE_NAME_HEADER = "Salesforce Name"
@@ -24,18 +33,34 @@ SALESFORCE_NAME_HEADER = "Salesforce Name"
 AlumContact = namedtuple("AlumContact", ["sf_name", "sf_id"])
 
 
-def write_salesforce_ids(input_filename, output_filename, campus_index):
+def write_salesforce_ids(input_filename, output_filename, campus_index,
+                         local=False, batch_size=MSEARCH_BATCH_SIZE,
+                         concurrency=MSEARCH_CONCURRENCY, defer_filename=None,
+                         choices_filename=None, cache_filename=None,
+                         cache_ttl_days=MATCH_CACHE_TTL_DAYS):
     """
+    With local, names are matched against a LocalNameIndex of the campus.
+    Otherwise they're searched for in batches of batch_size, concurrency
+    batches at a time (see name_matching.multi_search).
+
+    Names with more than one likely match are asked about once the rest are
+    matched, or with defer_filename, saved there to choose for later (see
+    name_matching.MatchReview). choices_filename is such a file, chosen in
+    since, to take matches from.
+
+    With cache_filename, names matched in earlier runs (within
+    cache_ttl_days, and still on the roster) are taken from that
+    match_cache file rather than searched for, and new matches (and names
+    chosen none of the candidates for) are added.
     """
     fb_names = _get_fb_names_set(input_filename)
-    fb_name_to_alum_contact = _match_sf_ids(fb_names, campus_index)
-
-    with open(input_filename) as infile:
-        reader = csv.DictReader(infile)
+    fb_name_to_alum_contact = _match_sf_ids(
+        fb_names, campus_index, local, batch_size, concurrency,
+        defer_filename, choices_filename, cache_filename, cache_ttl_days,
+    )
 
-        with open(output_filename, "w") as outfile:
-            fieldnames = reader.fieldnames
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+    with open_reader(input_filename) as reader:
+        with open_writer(output_filename, reader.fieldnames) as writer:
             writer.writeheader()
 
             for row in reader:
@@ -53,8 +78,9 @@ def _get_fb_names_set(input_filename):
     """
     fb_names = set()
 
-    with open(input_filename) as infile:
-        reader = csv.DictReader(infile)
+    with open_reader(
+        input_filename, columns=(cn_fields.CONTACT, FACEBOOK_NAME_HEADER)
+    ) as reader:
         for row in reader:
             # 'N/A' are known ignores
             if not row[cn_fields.CONTACT]:
@@ -63,58 +89,126 @@ def _get_fb_names_set(input_filename):
     return fb_names
 
 
-def _match_sf_ids(fb_names_set, campus):
+def _match_sf_ids(fb_names_set, campus, local=False,
+                  batch_size=MSEARCH_BATCH_SIZE,
+                  concurrency=MSEARCH_CONCURRENCY, defer_filename=None,
+                  choices_filename=None, cache_filename=None,
+                  cache_ttl_days=MATCH_CACHE_TTL_DAYS):
     """Build a dict of facebook_name: AlumContact
+
+    Names in the match cache (with cache_filename) are taken from it. Of the
+    rest, names with one clear match (or none) are done first; the others
+    are set aside and asked about together at the end, or saved to
+    defer_filename.
     """
     es_connection = es_connections.create_connection(
         hosts=[ES_CONNECTION_KEY], timeout=20
     )
+    local_index = None
+    if local:
+        local_index = LocalNameIndex.from_elastic(es_connection, campus)
     fb_name_to_alum_contact = dict() # facebook name: AlumContact
 
-    for fb_name in fb_names_set:
-        alum_contact = _match_fb_name_to_sf_id(fb_name, campus, es_connection)
-        fb_name_to_alum_contact[fb_name] = alum_contact
+    match_cache = None
+    if cache_filename is not None:
+        match_cache = open_match_cache(
+            cache_filename, es_connection, campus, local_index, cache_ttl_days,
+        )
+        for fb_name, cached_match in match_cache.get_many(fb_names_set).items():
+            if not cached_match.safe_id: # chosen none of before
+                fb_name_to_alum_contact[fb_name] = AlumContact(
+                    sf_name="???", sf_id="StillNotFound"
+                )
+                continue
+            fb_name_to_alum_contact[fb_name] = AlumContact(
+                sf_name=cached_match.sf_name, sf_id=cached_match.safe_id
+            )
+        print(f"Found {len(fb_name_to_alum_contact)} of {len(fb_names_set)}"
+              f" names in {cache_filename}")
+    fb_names_to_search = [
+        fb_name for fb_name in fb_names_set
+        if fb_name not in fb_name_to_alum_contact
+    ]
+
+    if local_index is not None:
+        fb_name_to_hits = {
+            fb_name: local_index.search(fb_name)
+            for fb_name in fb_names_to_search
+        }
+    else:
+        fb_name_to_hits = multi_search(
+            es_connection,
+            {fb_name: name_search(fb_name) for fb_name in fb_names_to_search},
+            index=campus, batch_size=batch_size, concurrency=concurrency,
+        )
+    if choices_filename is not None:
+        match_review = MatchReview.load(choices_filename)
+    else:
+        match_review = MatchReview()
+    deferred_fb_names = []
+
+    for fb_name, hits in fb_name_to_hits.items():
+        try:
+            fb_name_to_alum_contact[fb_name] = _alum_contact_from_hits(
+                fb_name, hits, match_review
+            )
+        except MatchDeferred:
+            deferred_fb_names.append(fb_name)
+
+    match_review.finish(defer_filename)
+    for fb_name in deferred_fb_names:
+        fb_name_to_alum_contact[fb_name] = _alum_contact_from_hits(
+            fb_name, fb_name_to_hits[fb_name], match_review
+        )
+
+    if match_cache is not None:
+        with match_cache:
+            for fb_name, hits in fb_name_to_hits.items():
+                alum_contact = fb_name_to_alum_contact[fb_name]
+                if match_review.chose_none(fb_name):
+                    match_cache.put_no_match(fb_name)
+                elif alum_contact.sf_id != "StillNotFound":
+                    strong_matches, _ = split_matches(hits)
+                    match_cache.put(
+                        fb_name, alum_contact.sf_id, alum_contact.sf_name,
+                        confirmed=len(strong_matches) != 1,
+                    )
 
     return fb_name_to_alum_contact
 
 
-def _match_fb_name_to_sf_id(fb_name, campus, es_connection):
+def match_fb_name_to_sf_id(fb_name, campus, es_connection, local_index=None,
+                           match_review=None):
     """Search for salesforce id, salesforce name in Elastic by fb_name.
 
     :param fb_name: str name from facebook notes dump
     :param campus: str campus name ES index to search
     :param es_connection: elasticsearch_dsl.Connection
+    :param local_index: optional LocalNameIndex of the campus to search
+        instead of Elastic
+    :param match_review: optional name_matching.MatchReview to set unclear
+        matches aside in (or take their choices from), rather than asking
     :return: AlumContact namedtuple
+    :raises MatchDeferred: if fb_name was set aside in match_review
     """
-    full_name_search = {
-        "min_score": MIN_SCORE_THRESHOLD,
-        "query": {
-            "match": {
-                "full_name": {
-                    "query": fb_name,
-                    "fuzziness": 2,
-                    #"prefix_length": 2,
-                }
-            }
-        }
-    }
-    results = es_scan(es_connection, query=full_name_search,
-        scroll="1m", index=campus, preserve_order=True
-    )
+    if local_index is not None:
+        results = local_index.search(fb_name)
+    else:
+        results = search_name(es_connection, campus, fb_name)
+    return _alum_contact_from_hits(fb_name, results, match_review)
 
-    strong_matches = [] # most likely matches, occasionally multiple
-    weak_matches = [] # < ACCEPT_MATCH_SCORE
 
-    # split results into strong matches and weak matches
-    for hit in results:
-        if hit["_score"] >= ACCEPT_MATCH_SCORE:
-            strong_matches.append(hit)
-        else:
-            weak_matches.append(hit)
+def _alum_contact_from_hits(fb_name, hits, match_review=None):
+    """Choose fb_name's AlumContact from its search hits, asking (or, with
+    match_review, deferring) when it's not clear.
+    """
+    strong_matches, weak_matches = split_matches(hits)
 
     if len(strong_matches) > 1: # choose correct match
-        print("Multiple strong matches found for {}.".format(fb_name))
-        match_index = _elicit_match(strong_matches)
+        match_index = choose_match(
+            fb_name, strong_matches, match_review,
+            heading="Multiple strong matches found for {}.".format(fb_name),
+        )
         if match_index is not None: # could be 0th item
             match = strong_matches[match_index]
             matched_sf_id = match["_source"]["safe_id"]
@@ -139,8 +233,10 @@ def _match_fb_name_to_sf_id(fb_name, campus, es_connection):
         return AlumContact(sf_name=matched_sf_name, sf_id=matched_sf_id)
 
     elif weak_matches: # check weak matches
-        print("Multiple weak matches found for {}.".format(fb_name))
-        match_index = _elicit_match(weak_matches)
+        match_index = choose_match(
+            fb_name, weak_matches, match_review,
+            heading="Multiple weak matches found for {}.".format(fb_name),
+        )
         if match_index is not None: # could be 0th item
             match = weak_matches[match_index]
             matched_sf_id = match["_source"]["safe_id"]
@@ -159,30 +255,13 @@ def _match_fb_name_to_sf_id(fb_name, campus, es_connection):
         return AlumContact(sf_name="???", sf_id="StillNotFound")
 
 
-def _elicit_match(candidates):
-    """
-    Iterate through `candidates` and return the index in the iterable indicated
-    by the user, or an empty string if none indicated.
-
-    Each item in `candidates` should be a dictionary of search results, as
-    returned by elasticsearch query.
-    """
-    for i, candidate in enumerate(candidates):
-        print("{:>2}) {:<9} {:>15}, {:<15} ({}) {} ({})".format(
-            i, candidate["_score"], candidate["_source"]["last_name"],
-            candidate["_source"]["first_name"],
-            candidate["_source"]["class_year"], candidate["_id"],
-            candidate["_index"]
-        ))
-
-    match_index = input("Enter number of matched identity, or press Enter to pass on these options: ")
-    if match_index:
-        return int(match_index)
-
-
 def parse_args():
     """
     Get input and output file names, campus index to use for search.
+
+    Optionally --local, or --batch-size and --concurrency for the searches,
+    and --defer and --choices for names with more than one likely match,
+    and --match-cache and --match-cache-days to reuse earlier matches.
     """
 
     parser = argparse.ArgumentParser(description=\
@@ -200,8 +279,55 @@ def parse_args():
         "index",
         help="Name of campus index to use"
     )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        default=False,
+        help="Read the campus's alumni once and match names in memory"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=MSEARCH_BATCH_SIZE,
+        help=f"Names per search request. Defaults to {MSEARCH_BATCH_SIZE}"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=MSEARCH_CONCURRENCY,
+        help=f"Search requests at a time. Defaults to {MSEARCH_CONCURRENCY}"
+    )
+    parser.add_argument(
+        "--defer",
+        default=None,
+        help="Rather than asking about names with more than one likely"
+             " match, save them to this (json) file to choose for later with"
+             " name_matching.py"
+    )
+    parser.add_argument(
+        "--choices",
+        default=None,
+        help="File saved with --defer (and chosen in since) to take"
+             " matches from"
+    )
+    parser.add_argument(
+        "--match-cache",
+        default=None,
+        help="SQLite file of matches from earlier runs to reuse and add to"
+    )
+    parser.add_argument(
+        "--match-cache-days",
+        type=int,
+        default=MATCH_CACHE_TTL_DAYS,
+        help="Days to reuse a match for before searching again. Defaults"
+             f" to {MATCH_CACHE_TTL_DAYS}"
+    )
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    write_salesforce_ids(args.infile, args.outfile, args.index)
+    write_salesforce_ids(
+        args.infile, args.outfile, args.index, args.local, args.batch_size,
+        args.concurrency, args.defer, args.choices, args.match_cache,
+        args.match_cache_days,
+    )
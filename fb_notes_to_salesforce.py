@@ -0,0 +1,622 @@
+"""
+fb_notes_to_salesforce.py
+
+Take a Facebook messages download all the way to uploaded Contact Notes in
+one pass, rather than through a csv per script:
+
+    fb_messages_to_csv -> fb_names_to_sf_ids -> add_owner_ids
+        -> upload_contact_notes
+
+Each step runs in its own thread and hands notes to the next along a bounded
+queue, so Elasticsearch lookups and Salesforce calls overlap with parsing
+the download, and only QUEUE_SIZE notes wait between any two steps.
+
+Names are matched as in fb_names_to_sf_ids, once per name. Notes for names
+with more than one likely match are held back rather than stopping the
+upload to ask; once everything else is uploaded, they're asked about
+together and then uploaded, or with --defer, saved for choosing later (see
+name_matching.MatchReview) and left out. With --match-cache, names matched
+in earlier runs are taken from a match_cache file. Notes that can't be
+matched aren't uploaded; they're saved to a leftovers file in
+fb_messages_to_csv's format, to go through check_fb_ignores and the other
+scripts by hand. (The download has no Facebook IDs, so known ignores can't
+be checked here.)
+
+Duplicates are checked as in upload_contact_notes (Contact__c,
+Date_of_Contact__c and Subject__c), but with one query per UPLOAD_BATCH_SIZE
+notes. With --near-duplicates, notes are also checked against (and added
+to) a near_duplicates index.
+"""
+
+import argparse
+from os import path
+import queue
+import threading
+
+from elasticsearch_dsl.connections import connections as es_connections
+from noble_logging_utils.papertrail_struct_logger import (
+    get_logger,
+    SF_LOG_LIVE,
+    SF_LOG_SANDBOX,
+)
+from salesforce_utils import get_salesforce_connection
+
+from add_owner_ids import CONTACT_UNKNOWN_STRING, get_owner_id
+from fb_messages_to_csv import (
+    facebook_note_keys,
+    iter_fb_dump_notes,
+    load_manifest,
+    META_MESSAGES_FILENAME,
+    MESSAGES_ENCODING,
+    open_parse_pool,
+    plan_fb_dump,
+    save_manifest,
+    set_timezone,
+    update_manifest,
+)
+from fb_names_to_sf_ids import (
+    AlumContact,
+    match_fb_name_to_sf_id,
+    SALESFORCE_NAME_HEADER,
+)
+from header_mappings import HEADER_MAPPINGS
+from match_cache import MATCH_CACHE_TTL_DAYS, open_match_cache
+from name_matching import LocalNameIndex, MatchDeferred, MatchReview
+from near_duplicates import NearDuplicateIndex
+from phrase_matcher import load_phrases
+from salesforce_fields import contact_note as cn_fields
+from salesforce_ids import (
+    CONTACT_KEY_PREFIX,
+    InvalidSalesforceId,
+    normalize_sf_id,
+)
+from secrets.elastic_secrets import ES_CONNECTION_KEY
+from staging import open_writer
+
+SF_OBJECT_ACTION = "CREATE"
+LEFTOVERS_FILENAME = "fb_leftovers.csv"
+QUEUE_SIZE = 500 # notes waiting between any two steps
+UPLOAD_BATCH_SIZE = 100 # notes checked for duplicates per query
+POLL_SECONDS = 0.5 # how often a blocked step checks if another has failed
+
+FACEBOOK_NAME_HEADER = "Facebook Name"
+OWNER_ID_HEADER = "OwnerId"
+
+_DONE = object() # end of a queue
+
+
+class _Aborted(Exception):
+    """Raised in a step when another step has failed."""
+
+
+def fb_notes_to_salesforce(messages_dir, campus,
+                           leftovers_filename=LEFTOVERS_FILENAME,
+                           processes=None,
+                           meta_messages_filename=META_MESSAGES_FILENAME,
+                           manifest_filename=None,
+                           near_duplicates_filename=None,
+                           timezone_name=None,
+                           local_names=False,
+                           defer_filename=None,
+                           choices_filename=None,
+                           match_cache_filename=None,
+                           match_cache_days=MATCH_CACHE_TTL_DAYS):
+    """Upload Contact Notes from the Facebook download in messages_dir (a
+    directory or .zip; see fb_messages_to_csv.process_fb_dump).
+
+    :param campus: str campus (Elastic index) to match names against
+    :param leftovers_filename: file to save unmatched notes to
+    :param manifest_filename: optional manifest, as for process_fb_dump;
+        it's only updated once every note has been uploaded or saved
+    :param near_duplicates_filename: optional near_duplicates index file;
+        notes nearly the same as one in it are skipped, and uploaded notes
+        are added to it
+    :param timezone_name: optional timezone for message days and times;
+        defaults to this machine's local time
+    :param local_names: if True, read the campus's alumni from Elastic once
+        and match names against a name_matching.LocalNameIndex
+    :param defer_filename: optional file to save names with more than one
+        likely match to, rather than asking about them; their notes are
+        saved as leftovers
+    :param choices_filename: optional file saved with defer_filename (and
+        chosen in since) to take matches from
+    :param match_cache_filename: optional match_cache file to take names
+        matched in earlier runs (within match_cache_days) from, and add new
+        matches to
+    """
+    COUNT_CONTACT_NOTES_QUERY = "SELECT COUNT() FROM Contact_Note__c"
+    pre_uploads_count = \
+        sf_connection.query(COUNT_CONTACT_NOTES_QUERY)["totalSize"]
+
+    meta_messages = load_phrases(meta_messages_filename)
+    set_timezone(timezone_name)
+    manifest = None
+    if manifest_filename is not None:
+        manifest = load_manifest(manifest_filename)
+    tasks, updated_entries = plan_fb_dump(messages_dir, manifest)
+
+    es_connection = es_connections.create_connection(
+        hosts=[ES_CONNECTION_KEY], timeout=20
+    )
+    local_index = None
+    if local_names:
+        local_index = LocalNameIndex.from_elastic(es_connection, campus)
+
+    if choices_filename is not None:
+        match_review = MatchReview.load(choices_filename)
+    else:
+        match_review = MatchReview()
+    deferred_notes = []
+
+    match_cache = None
+    if match_cache_filename is not None:
+        match_cache = open_match_cache(
+            match_cache_filename, es_connection, campus, local_index,
+            match_cache_days,
+        )
+
+    near_duplicates = None
+    if near_duplicates_filename is not None:
+        near_duplicates = NearDuplicateIndex(near_duplicates_filename)
+
+    counts = {"created": 0, "skipped": 0, "failed": 0, "unmatched": 0}
+    with open_writer(
+        leftovers_filename, facebook_note_keys, encoding=MESSAGES_ENCODING
+    ) as leftovers_writer:
+        leftovers_writer.writeheader()
+
+        def save_leftover(facebook_note):
+            counts["unmatched"] += 1
+            leftovers_writer.writerow(facebook_note._asdict())
+
+        def upload(facebook_notes, defer):
+            outcomes = run_threaded(
+                facebook_notes,
+                lambda notes: match_contacts(
+                    notes, campus, es_connection, save_leftover, local_index,
+                    match_review, defer, match_cache,
+                ),
+                lambda rows: add_owners(rows, campus),
+                lambda rows: upload_notes(rows, near_duplicates),
+            )
+            for outcome in outcomes:
+                counts[outcome] += 1
+
+        try:
+            # the pool's forked here, before run_threaded starts any threads
+            with open_parse_pool(
+                processes, meta_messages, timezone_name
+            ) as pool:
+                upload(iter_fb_dump_notes(
+                    tasks, processes, meta_messages, timezone_name, pool
+                ), deferred_notes.append)
+            # everything else is uploaded, so nothing waits on the answers
+            match_review.finish(defer_filename)
+            if deferred_notes:
+                # a choice that's gone stale would be deferred again; save
+                # those as leftovers rather than going round again
+                upload(deferred_notes, save_leftover)
+        finally:
+            if near_duplicates is not None:
+                near_duplicates.close()
+            if match_cache is not None:
+                match_cache.close()
+
+    logger.info(
+        num_created=counts["created"], num_skipped=counts["skipped"],
+        num_failed=counts["failed"], num_unmatched=counts["unmatched"],
+    )
+    if counts["unmatched"]:
+        print(f"Saved {counts['unmatched']} unmatched notes to {leftovers_filename}")
+
+    if manifest is not None:
+        update_manifest(manifest, updated_entries)
+        save_manifest(manifest_filename, manifest)
+
+    post_uploads_count = \
+        sf_connection.query(COUNT_CONTACT_NOTES_QUERY)["totalSize"]
+    assert post_uploads_count == pre_uploads_count + counts["created"]
+
+
+def run_threaded(source, *steps):
+    """Yield the items from source, passed through each of steps, with the
+    source and each step running in its own thread.
+
+    Each step is a function taking an iterable of items and returning an
+    iterable of items for the next. Steps are connected by queues of
+    QUEUE_SIZE, so a fast step waits for a slow one rather than piling up
+    items. If any step raises, the others stop and the error is re-raised
+    here.
+    """
+    failed = threading.Event()
+    errors = []
+    queues = [queue.Queue(QUEUE_SIZE) for _ in range(len(steps) + 1)]
+
+    def feed(items, outbox):
+        try:
+            for item in items:
+                _put(outbox, item, failed)
+            _put(outbox, _DONE, failed)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            if hasattr(items, "close"): # eg. stop a generator's pool
+                items.close()
+
+    threads = [threading.Thread(target=feed, args=(source, queues[0]))]
+    for step, inbox, outbox in zip(steps, queues, queues[1:]):
+        threads.append(threading.Thread(
+            target=feed, args=(step(_drain(inbox, failed)), outbox)
+        ))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        yield from _drain(queues[-1], failed)
+    except _Aborted:
+        pass
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _put(outbox, item, failed):
+    while True:
+        try:
+            outbox.put(item, timeout=POLL_SECONDS)
+            return
+        except queue.Full:
+            if failed.is_set():
+                raise _Aborted()
+
+
+def _drain(inbox, failed):
+    while True:
+        try:
+            item = inbox.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            if failed.is_set():
+                raise _Aborted()
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+def match_contacts(facebook_notes, campus, es_connection, save_leftover,
+                   local_index=None, match_review=None, defer=None,
+                   match_cache=None):
+    """Step: match each note's Facebook name to an alum (once per name; see
+    fb_names_to_sf_ids) and yield it as a row dict with FB_NOTE_HEADERS-style
+    keys. Unmatched notes go to save_leftover instead.
+
+    :param local_index: optional LocalNameIndex to match names against
+        instead of searching Elastic
+    :param match_review: optional name_matching.MatchReview; notes whose
+        name it doesn't have a choice for yet go to defer instead of being
+        asked about
+    :param match_cache: optional match_cache.MatchCache to take matches
+        from and add new ones to
+    """
+    fb_name_to_alum_contact = {}
+    deferred_fb_names = set()
+    for facebook_note in facebook_notes:
+        fb_name = facebook_note.alum_fb_name
+        if fb_name in deferred_fb_names:
+            defer(facebook_note)
+            continue
+        alum_contact = fb_name_to_alum_contact.get(fb_name)
+        if alum_contact is None and match_cache is not None:
+            cached_match = match_cache.get(fb_name)
+            if cached_match is not None:
+                alum_contact = AlumContact(
+                    sf_name=cached_match.sf_name or "???",
+                    # chosen none of before
+                    sf_id=cached_match.safe_id or CONTACT_UNKNOWN_STRING,
+                )
+                fb_name_to_alum_contact[fb_name] = alum_contact
+        if alum_contact is None:
+            try:
+                alum_contact = match_fb_name_to_sf_id(
+                    fb_name, campus, es_connection, local_index, match_review
+                )
+            except MatchDeferred:
+                deferred_fb_names.add(fb_name)
+                defer(facebook_note)
+                continue
+            fb_name_to_alum_contact[fb_name] = alum_contact
+            if match_cache is not None:
+                _cache_match(match_cache, fb_name, alum_contact, match_review)
+
+        if alum_contact.sf_id == CONTACT_UNKNOWN_STRING:
+            save_leftover(facebook_note)
+            continue
+        try:
+            safe_id = normalize_sf_id(alum_contact.sf_id, CONTACT_KEY_PREFIX)
+        except InvalidSalesforceId as e:
+            print(f"WARNING: {e}")
+            save_leftover(facebook_note)
+            continue
+
+        yield {
+            FACEBOOK_NAME_HEADER: fb_name,
+            SALESFORCE_NAME_HEADER: alum_contact.sf_name,
+            cn_fields.CONTACT: safe_id,
+            cn_fields.DATE_OF_CONTACT: facebook_note.date_of_contact,
+            cn_fields.COMMENTS: facebook_note.comments,
+            cn_fields.COMMUNICATION_STATUS: facebook_note.communication_status,
+            cn_fields.MODE_OF_COMMUNICATION: facebook_note.mode_of_communication,
+            cn_fields.SUBJECT: facebook_note.subject,
+            cn_fields.INITIATED_BY_ALUM: facebook_note.initiated_by_alum == "True",
+        }
+
+
+def _cache_match(match_cache, fb_name, alum_contact, match_review=None):
+    """Add fb_name's match (or that someone chose none of its candidates)
+    to match_cache.
+    """
+    if match_review is not None and match_review.chose_none(fb_name):
+        match_cache.put_no_match(fb_name)
+    elif alum_contact.sf_id != CONTACT_UNKNOWN_STRING:
+        # only names that needed choosing for went through match_review;
+        # without one, nothing's known to be chosen
+        confirmed = (match_review is not None
+                     and fb_name in match_review.candidates)
+        match_cache.put(
+            fb_name, alum_contact.sf_id, alum_contact.sf_name, confirmed,
+        )
+
+
+def add_owners(rows, campus):
+    """Step: add the alum's OwnerId to each row (see add_owner_ids), looking
+    up each alum once.
+    """
+    safe_id_to_owner_id = {}
+    for row in rows:
+        safe_id = row[cn_fields.CONTACT]
+        if safe_id not in safe_id_to_owner_id:
+            safe_id_to_owner_id[safe_id] = get_owner_id(campus, safe_id)
+        row[OWNER_ID_HEADER] = safe_id_to_owner_id[safe_id]
+        yield row
+
+
+def upload_notes(rows, near_duplicates=None):
+    """Step: upload rows UPLOAD_BATCH_SIZE at a time, skipping duplicates
+    (and near duplicates, given a NearDuplicateIndex). Yields 'created',
+    'skipped' or 'failed' for each row.
+    """
+    seen_keys = set() # also catches duplicates within the download
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= UPLOAD_BATCH_SIZE:
+            yield from _upload_batch(batch, seen_keys, near_duplicates)
+            batch = []
+    if batch:
+        yield from _upload_batch(batch, seen_keys, near_duplicates)
+
+
+def _upload_batch(rows, seen_keys, near_duplicates):
+    existing = find_existing_contact_notes(rows)
+    for row in rows:
+        key = _note_key(row)
+        if key in seen_keys or key in existing:
+            logger.warn(
+                success=False, duplicate_id=existing.get(key, "this upload"),
+                **row
+            )
+            yield "skipped"
+            continue
+        seen_keys.add(key)
+
+        if near_duplicates is not None:
+            matches = near_duplicates.find(
+                row[cn_fields.CONTACT], row[cn_fields.DATE_OF_CONTACT],
+                row[cn_fields.COMMENTS],
+            )
+            if matches:
+                logger.warn(
+                    success=False, near_duplicate_id=matches[0][0], **row
+                )
+                yield "skipped"
+                continue
+
+        # grab only valid Contact Note fields
+        contact_note_data = {}
+        for field_name, value in row.items():
+            if field_name in HEADER_MAPPINGS.values():
+                contact_note_data[field_name] = value
+        response = sf_connection.Contact_Note__c.create(contact_note_data)
+        if response["success"]:
+            logger.info(success=True, object_id=response["id"])
+            if near_duplicates is not None:
+                near_duplicates.add(
+                    row[cn_fields.CONTACT], row[cn_fields.DATE_OF_CONTACT],
+                    row[cn_fields.COMMENTS], response["id"],
+                )
+            yield "created"
+        else:
+            logger.warn(
+                success=False, error=response["errors"],
+                attempted=contact_note_data
+            )
+            yield "failed"
+
+
+def find_existing_contact_notes(rows):
+    """Find Contact Notes that already exist for rows, in one query.
+
+    :return: dict of (Contact__c, Date_of_Contact__c, Subject__c) to the
+        existing note's Id
+    :rtype: dict
+    """
+    contact_note_query = (
+        "SELECT Id, Contact__c, Date_of_Contact__c, Subject__c "
+        "FROM Contact_Note__c "
+        "WHERE Contact__c IN ({}) "
+        "AND Date_of_Contact__c IN ({})"
+    )
+    safe_ids = sorted({row[cn_fields.CONTACT] for row in rows})
+    datestrings = sorted({row[cn_fields.DATE_OF_CONTACT] for row in rows})
+
+    results = sf_connection.query_all(contact_note_query.format(
+        ", ".join(f"'{safe_id}'" for safe_id in safe_ids),
+        ", ".join(datestrings),
+    ))
+    existing = {}
+    for record in results["records"]:
+        key = (
+            record[cn_fields.CONTACT],
+            record[cn_fields.DATE_OF_CONTACT],
+            record[cn_fields.SUBJECT],
+        )
+        existing.setdefault(key, record["Id"])
+    return existing
+
+
+def _note_key(row):
+    return (
+        row[cn_fields.CONTACT],
+        row[cn_fields.DATE_OF_CONTACT],
+        row[cn_fields.SUBJECT],
+    )
+
+
+def parse_args():
+    """
+    * messages_dir: Facebook download; directory of conversation folders, or
+                    the .zip
+    *       campus: campus (Elastic index) to match names against
+    *  --leftovers: file to save unmatched notes to
+    *  --processes: number of processes to parse the download on
+    *   --manifest: only upload what's new since the manifest was last updated
+    * --near-duplicates: near_duplicates index to skip near duplicates with
+    *   --timezone: timezone for message days and times
+    *      --local: match names in memory against the campus read once
+    *      --defer: save names with more than one likely match to choose for
+                    later, rather than asking
+    *    --choices: file saved with --defer (and chosen in) to match from
+    * --match-cache: SQLite file of matches from earlier runs to reuse
+    * --match-cache-days: days to reuse a match for
+    *    --sandbox: if present, connects to the sandbox Salesforce instance.
+                    Otherwise, connects to live
+    """
+    parser = argparse.ArgumentParser(
+        description="Upload Contact Notes from a Facebook messages download"
+    )
+    parser.add_argument(
+        "messages_dir",
+        help="Directory of conversation folders, or the downloaded .zip"
+    )
+    parser.add_argument(
+        "campus",
+        help="Campus (index) to match names against"
+    )
+    parser.add_argument(
+        "--leftovers",
+        default=LEFTOVERS_FILENAME,
+        help=f"File to save unmatched notes to. Defaults to {LEFTOVERS_FILENAME}"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes to parse with. Defaults to cpu count"
+    )
+    parser.add_argument(
+        "--meta-messages",
+        default=META_MESSAGES_FILENAME,
+        help="File of meta message phrases to ignore, one per line. Defaults"
+             " to fb_meta_messages.txt"
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help="Manifest (json) of conversations from earlier runs. If given,"
+             " only notes that are new since then are uploaded"
+    )
+    parser.add_argument(
+        "--near-duplicates",
+        default=None,
+        help="near_duplicates index (SQLite) file. If given, notes nearly the"
+             " same as one in it are skipped, and uploaded notes are added"
+    )
+    parser.add_argument(
+        "--timezone",
+        default=None,
+        help="Timezone for message days and times (eg. America/Chicago)."
+             " Defaults to this machine's local time"
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        default=False,
+        help="Read the campus's alumni once and match names in memory"
+    )
+    parser.add_argument(
+        "--defer",
+        default=None,
+        help="Rather than asking about names with more than one likely"
+             " match, save them to this (json) file to choose for later with"
+             " name_matching.py. Their notes are saved as leftovers"
+    )
+    parser.add_argument(
+        "--choices",
+        default=None,
+        help="File saved with --defer (and chosen in since) to take"
+             " matches from"
+    )
+    parser.add_argument(
+        "--match-cache",
+        default=None,
+        help="SQLite file of matches from earlier runs to reuse and add to"
+    )
+    parser.add_argument(
+        "--match-cache-days",
+        type=int,
+        default=MATCH_CACHE_TTL_DAYS,
+        help="Days to reuse a match for before searching again. Defaults"
+             f" to {MATCH_CACHE_TTL_DAYS}"
+    )
+    parser.add_argument(
+        "--sandbox",
+        action="store_true",
+        default=False,
+        help="If True, uses the sandbox Salesforce instance. Defaults to False"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    log_job_name = __file__.split(path.sep)[-1] # name of this file
+
+    if args.sandbox:
+        logger = get_logger(log_job_name, hostname=SF_LOG_SANDBOX)
+    else:
+        logger = get_logger(log_job_name, hostname=SF_LOG_LIVE)
+
+    logger = logger.bind(
+        event="fb_notes_to_salesforce",
+        sf_object=cn_fields.API_NAME,
+        action=SF_OBJECT_ACTION,
+    )
+    logger._logger.setLevel("INFO")
+
+    sf_connection = get_salesforce_connection(sandbox=args.sandbox)
+    fb_notes_to_salesforce(
+        args.messages_dir, args.campus, args.leftovers, args.processes,
+        args.meta_messages, args.manifest, args.near_duplicates,
+        args.timezone, args.local, args.defer, args.choices,
+        args.match_cache, args.match_cache_days,
+    )
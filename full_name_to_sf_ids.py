@@ -9,39 +9,203 @@ Write matches back out to csv. Expects a column headed by cn_fields.CONTACT
 import argparse
 import csv
 
-from elasticsearch.helpers import scan as es_scan
 from elasticsearch_dsl.connections import connections as es_connections
 
+from compact_rows import CompactDictReader
+from compressed_files import open_file
+from match_cache import MATCH_CACHE_TTL_DAYS, open_match_cache
+from name_matching import (
+    choose_match,
+    LocalNameIndex,
+    MatchDeferred,
+    MatchReview,
+    MSEARCH_BATCH_SIZE,
+    MSEARCH_CONCURRENCY,
+    multi_search,
+    name_search,
+    search_name,
+    split_matches,
+)
 from salesforce_fields import contact_note as cn_fields
+from salesforce_ids import (
+    CONTACT_KEY_PREFIX,
+    InvalidSalesforceId,
+    normalize_sf_id,
+)
 from secrets.elastic_secrets import ES_CONNECTION_KEY
 
-ACCEPT_MATCH_SCORE = 7.5 # score at which matches are "blindly" accepted
-MIN_SCORE_THRESHOLD = 2 # only return results from ES with this score or higher
 
+def write_salesforce_ids(input_filename, campus, name_headers, local=False,
+                         batch_size=MSEARCH_BATCH_SIZE,
+                         concurrency=MSEARCH_CONCURRENCY,
+                         defer_filename=None, choices_filename=None,
+                         cache_filename=None,
+                         cache_ttl_days=MATCH_CACHE_TTL_DAYS):
+    """
+    With local, names are matched against a LocalNameIndex of the campus's
+    alumni, read from Elastic once. Otherwise the names are searched for in
+    batches of batch_size, concurrency batches at a time (see
+    name_matching.multi_search).
+
+    Names with more than one likely match are asked about once the rest are
+    matched, or with defer_filename, saved there to choose for later (see
+    name_matching.MatchReview). choices_filename is such a file, chosen in
+    since, to take matches from.
 
-def write_salesforce_ids(input_filename, campus, name_headers):
+    With cache_filename, names matched in earlier runs (within
+    cache_ttl_days, and still on the roster) are taken from that
+    match_cache file rather than searched for, and new matches (and names
+    chosen none of the candidates for) are added.
+    """
+    full_names = _get_full_names_to_look_up(input_filename, name_headers)
+    es_connection = es_connections.create_connection(hosts=[ES_CONNECTION_KEY])
+    local_index = None
+    if local:
+        local_index = LocalNameIndex.from_elastic(es_connection, campus)
+
+    name_to_safe_id = {}
+    match_cache = None
+    if cache_filename is not None:
+        match_cache = open_match_cache(
+            cache_filename, es_connection, campus, local_index=local_index,
+            ttl_days=cache_ttl_days,
+        )
+        for full_name, cached_match in match_cache.get_many(full_names).items():
+            # chosen none of before
+            name_to_safe_id[full_name] = cached_match.safe_id or "None"
+        print(f"Found {len(name_to_safe_id)} of {len(full_names)} names in "
+              f"{cache_filename}")
+
+    name_to_hits = _search_full_names(
+        [name for name in full_names if name not in name_to_safe_id],
+        campus, es_connection, local_index, batch_size, concurrency,
+    )
+    if choices_filename is not None:
+        match_review = MatchReview.load(choices_filename)
+    else:
+        match_review = MatchReview()
+    name_to_safe_id.update(_choose_safe_ids(
+        name_to_hits, match_review, defer_filename
+    ))
+    if match_cache is not None:
+        with match_cache:
+            _cache_matches(
+                match_cache, name_to_hits, name_to_safe_id, match_review
+            )
 
     output_filename = "with_ids_{}".format(input_filename)
 
-    with open(input_filename) as infile:
-        reader = csv.DictReader(infile)
+    with open_file(input_filename) as infile:
+        reader = CompactDictReader(infile)
 
-        with open(output_filename, 'w') as outfile:
+        with open_file(output_filename, 'w') as outfile:
             fieldnames = reader.fieldnames
             writer = csv.DictWriter(outfile, fieldnames=fieldnames)
             writer.writeheader()
 
             for row in reader:
+                if row[cn_fields.CONTACT]:
+                    # look up any existing IDs that aren't valid, too
+                    try:
+                        row[cn_fields.CONTACT] = normalize_sf_id(
+                            row[cn_fields.CONTACT], CONTACT_KEY_PREFIX
+                        )
+                    except InvalidSalesforceId as e:
+                        print(f"WARNING: {e}; looking up by name instead")
+                        row[cn_fields.CONTACT] = ""
                 if not row[cn_fields.CONTACT]:
-                    if len(name_headers) > 1:
-                        full_name = _make_full_name(row, name_headers)
-                    else:
-                        full_name = row[name_headers[0]]
-                    row[cn_fields.CONTACT] = _query_for_safe_id(full_name, campus)
+                    full_name = _row_full_name(row, name_headers)
+                    row[cn_fields.CONTACT] = name_to_safe_id[full_name]
 
                 writer.writerow(row)
 
 
+def _get_full_names_to_look_up(input_filename, name_headers):
+    """Set of full names of the rows in input_filename without a (valid)
+    Contact ID.
+    """
+    full_names = set()
+    with open_file(input_filename) as infile:
+        for row in CompactDictReader(infile):
+            if row[cn_fields.CONTACT]:
+                try:
+                    normalize_sf_id(row[cn_fields.CONTACT], CONTACT_KEY_PREFIX)
+                    continue
+                except InvalidSalesforceId:
+                    pass
+            full_names.add(_row_full_name(row, name_headers))
+    return full_names
+
+
+def _search_full_names(full_names, campus, es_connection, local_index=None,
+                       batch_size=MSEARCH_BATCH_SIZE,
+                       concurrency=MSEARCH_CONCURRENCY):
+    """Dict of full_name: search hits among campus's alumni, from
+    local_index if given.
+    """
+    if local_index is not None:
+        return {
+            full_name: local_index.search(full_name)
+            for full_name in full_names
+        }
+    return multi_search(
+        es_connection,
+        {full_name: name_search(full_name) for full_name in full_names},
+        index=campus, batch_size=batch_size, concurrency=concurrency,
+    )
+
+
+def _choose_safe_ids(name_to_hits, match_review, defer_filename=None):
+    """Dict of full_name: Safe ID (or "Multiple" or "None") from each name's
+    hits. Names with one clear match (or none) are done first; the rest are
+    set aside in match_review and asked about together at the end, or saved
+    to defer_filename.
+    """
+    name_to_safe_id = {}
+    deferred_names = []
+
+    for full_name, hits in name_to_hits.items():
+        try:
+            name_to_safe_id[full_name] = _safe_id_from_hits(
+                full_name, hits, match_review
+            )
+        except MatchDeferred:
+            deferred_names.append(full_name)
+
+    match_review.finish(defer_filename)
+    for full_name in deferred_names:
+        name_to_safe_id[full_name] = _safe_id_from_hits(
+            full_name, name_to_hits[full_name], match_review
+        )
+    return name_to_safe_id
+
+
+def _cache_matches(match_cache, name_to_hits, name_to_safe_id,
+                   match_review):
+    """Add the names matched from their hits, and those someone chose none
+    of the candidates for, to match_cache.
+    """
+    for full_name, hits in name_to_hits.items():
+        if match_review.chose_none(full_name):
+            match_cache.put_no_match(full_name)
+            continue
+        safe_id = name_to_safe_id[full_name]
+        matches = [hit for hit in hits if hit['_source']['safe_id'] == safe_id]
+        if not matches: # "Multiple" or "None"
+            continue
+        strong_matches, _ = split_matches(hits)
+        match_cache.put(
+            full_name, safe_id, matches[0]['_source']['full_name'],
+            confirmed=len(strong_matches) != 1,
+        )
+
+
+def _row_full_name(row, name_headers):
+    if len(name_headers) > 1:
+        return _make_full_name(row, name_headers)
+    return row[name_headers[0]]
+
+
 def _make_full_name(row_dict, headers_list):
     """
     Helper function to put together a full name to use for Elastic query.
@@ -54,51 +218,35 @@ def _make_full_name(row_dict, headers_list):
 
 
 # TODO SF/Elastic libs
-def _query_for_safe_id(full_name, campus, es_connection=None):
+def _query_for_safe_id(full_name, campus, es_connection=None,
+                       local_index=None):
     """
     Query Elastic for alum's Safe ID, using full_name and campus (index).
-    """
-    es_connection = es_connections.create_connection(hosts=[ES_CONNECTION_KEY])
 
-    full_name_search = {
-        "min_score": MIN_SCORE_THRESHOLD,
-        "query": {
-            "bool": {
-                "must": {
-                    "match": {
-                        "full_name": {
-                            "query": full_name,
-                            "fuzziness": 2,
-                        },
-                    },
-                },
-                # can comment out this filter clause to search across all
-                # campuses in a pinch
-                "filter": { # es_scan doesn't respect aliases as faux indices
-                    "term": {
-                        "campus": campus,
-                    },
-                },
-            },
-        },
-    }
-
-    results = es_scan(es_connection, query=full_name_search,
-        scroll='1m', preserve_order=True
-    )
+    With local_index (a LocalNameIndex of the campus), search that instead.
+    """
+    if local_index is not None:
+        results = local_index.search(full_name)
+    else:
+        if es_connection is None:
+            es_connection = es_connections.create_connection(
+                hosts=[ES_CONNECTION_KEY]
+            )
+        results = search_name(es_connection, campus, full_name)
+    return _safe_id_from_hits(full_name, results)
 
-    strong_matches = [] # most likely matches, occasionally multiple
-    weak_matches = [] # < ACCEPT_MATCH_SCORE
 
-    # split results into strong matches and weak matches
-    for hit in results:
-        if hit['_score'] >= ACCEPT_MATCH_SCORE:
-            strong_matches.append(hit)
-        else:
-            weak_matches.append(hit)
+def _safe_id_from_hits(full_name, hits, match_review=None):
+    """
+    Choose full_name's Safe ID from its search hits, asking (or, with
+    match_review, deferring) when it's not clear.
+    """
+    strong_matches, weak_matches = split_matches(hits)
     if len(strong_matches) > 1: # choose correct match
-        print("Multiple strong matches found for {}.".format(full_name))
-        match_index = _elicit_match(strong_matches)
+        match_index = choose_match(
+            full_name, strong_matches, match_review,
+            heading="Multiple strong matches found for {}.".format(full_name),
+        )
         if match_index is not None: # could be 0th item
             match = strong_matches[match_index]
             matched_sf_id = match['_source']['safe_id']
@@ -119,8 +267,10 @@ def _query_for_safe_id(full_name, campus, es_connection=None):
         ))
         return matched_sf_id
     elif weak_matches: # check weak matches
-        print("Multiple weak matches found for {}.".format(full_name))
-        match_index = _elicit_match(weak_matches)
+        match_index = choose_match(
+            full_name, weak_matches, match_review,
+            heading="Multiple weak matches found for {}.".format(full_name),
+        )
         if match_index is not None: # could be 0th item
             match = weak_matches[match_index]
             matched_sf_id = match['_source']['safe_id']
@@ -137,32 +287,14 @@ def _query_for_safe_id(full_name, campus, es_connection=None):
         return "None"
 
 
-def _elicit_match(candidates):
-    """
-    Iterate through `candidates` and return the index in the iterable indicated
-    by the user, or an empty string if none indicated.
-
-    Each item in `candidates` should be a dictionary of search results, as
-    returned by elasticsearch query.
-    """
-    for i, candidate in enumerate(candidates):
-        print("{:>2}) {:<9} {:>15}, {:<15} ({}) {} ({})".format(
-            i, candidate['_score'], candidate['_source']['last_name'],
-            candidate['_source']['first_name'],
-            candidate['_source']['class_year'], candidate['_id'],
-            candidate['_index']
-        ))
-
-    match_index = input("Enter number of matched identity, or press Enter to pass on these options: ")
-    if match_index:
-        return int(match_index)
-
-
 def parse_args():
     """
     Get input file name, campus index to use for search.
 
-    Optionally can provide --nameheaders string.
+    Optionally can provide --nameheaders string, --local, or --batch-size
+    and --concurrency for the searches, --defer and --choices for names
+    with more than one likely match, and --match-cache and
+    --match-cache-days to reuse earlier matches.
     """
 
     parser = argparse.ArgumentParser(description=\
@@ -187,8 +319,58 @@ def parse_args():
               "Defaults to a single header 'Name'."
         ),
     )
+    parser.add_argument(
+        '--local',
+        action="store_true",
+        default=False,
+        help=("Read the campus's alumni from Elastic once and match names "
+              "in memory, rather than one search per name"
+        ),
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=MSEARCH_BATCH_SIZE,
+        help=f"Names per search request. Defaults to {MSEARCH_BATCH_SIZE}",
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=MSEARCH_CONCURRENCY,
+        help=f"Search requests at a time. Defaults to {MSEARCH_CONCURRENCY}",
+    )
+    parser.add_argument(
+        '--defer',
+        default=None,
+        help=("Rather than asking about names with more than one likely "
+              "match, save them to this (json) file to choose for later "
+              "with name_matching.py"
+        ),
+    )
+    parser.add_argument(
+        '--choices',
+        default=None,
+        help="File saved with --defer (and chosen in since) to take matches from",
+    )
+    parser.add_argument(
+        '--match-cache',
+        default=None,
+        help="SQLite file of matches from earlier runs to reuse and add to",
+    )
+    parser.add_argument(
+        '--match-cache-days',
+        type=int,
+        default=MATCH_CACHE_TTL_DAYS,
+        help=("Days to reuse a match for before searching again. Defaults "
+              f"to {MATCH_CACHE_TTL_DAYS}"
+        ),
+    )
     return parser.parse_args()
 
 if __name__=='__main__':
     args = parse_args()
-    write_salesforce_ids(args.infile, args.index, args.nameheaders)
+    write_salesforce_ids(
+        args.infile, args.index, args.nameheaders, args.local,
+        args.batch_size, args.concurrency, args.defer, args.choices,
+        args.match_cache, args.match_cache_days,
+    )
@@ -0,0 +1,127 @@
+"""
+json_stream.py
+
+Read a large json object incrementally, without loading the whole document.
+
+Only what's needed for the Facebook message dumps: iterate over the
+top-level keys of an object, decoding most values whole but streaming the
+items of chosen array values (eg. "messages") one at a time. Only the
+current item, plus a read-ahead buffer, is in memory at once.
+"""
+
+import json
+
+READ_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+NUMBER_CHARS = "0123456789.eE+-"
+
+_decoder = json.JSONDecoder()
+
+
+def iter_object_items(fhand, streamed_keys=(), read_size=READ_SIZE):
+    """Yield (key, value) for each top-level key of the json object in fhand.
+
+    For keys in streamed_keys, whose values must be arrays, the value is a
+    generator over the array's items instead. Whatever isn't consumed of it
+    is skipped (item by item) when the next key is requested.
+    """
+    reader = _BufferedJsonReader(fhand, read_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.decode_value()
+        reader.expect(":")
+        if key in streamed_keys:
+            items = reader.iter_array()
+            yield key, items
+            for _ in items: # drain whatever the caller didn't read
+                pass
+        else:
+            yield key, reader.decode_value()
+        char = reader.next_char()
+        if char == "}":
+            return
+        if char != ",":
+            raise ValueError(f"Expected ',' or '}}' in json, found {char!r}")
+
+
+class _BufferedJsonReader:
+    """A read-ahead buffer over fhand that can decode one value at a time."""
+
+    def __init__(self, fhand, read_size):
+        self.fhand = fhand
+        self.read_size = read_size
+        self.buffer = ""
+        self.position = 0
+        self.at_eof = False
+
+    def _fill(self):
+        """Read another chunk; return False at end of file."""
+        if self.at_eof:
+            return False
+        chunk = self.fhand.read(self.read_size)
+        if not chunk:
+            self.at_eof = True
+            return False
+        # drop what's already been consumed
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while (self.position < len(self.buffer)
+                   and self.buffer[self.position] in WHITESPACE):
+                self.position += 1
+            if self.position < len(self.buffer) or not self._fill():
+                return
+
+    def peek(self):
+        self._skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise ValueError("Unexpected end of json")
+        return self.buffer[self.position]
+
+    def next_char(self):
+        char = self.peek()
+        self.position += 1
+        return char
+
+    def expect(self, expected):
+        char = self.next_char()
+        if char != expected:
+            raise ValueError(f"Expected {expected!r} in json, found {char!r}")
+
+    def decode_value(self):
+        """Decode the next complete json value, reading more as needed."""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the next
+            # chunk (eg. '15' of '1540000000000', or '1' of '1.5')
+            if (isinstance(value, (int, float))
+                    and (end == len(self.buffer) or self.buffer[end] in NUMBER_CHARS)
+                    and self._fill()):
+                continue
+            self.position = end
+            return value
+
+    def iter_array(self):
+        """Yield the items of the array starting at the current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.decode_value()
+            char = self.next_char()
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in json, found {char!r}")
@@ -0,0 +1,111 @@
+"""
+local_days.py
+
+Convert batches of millisecond timestamps (as in Facebook message files) to
+local time, without building a datetime for each one.
+
+A timestamp's local time is its POSIX seconds plus the UTC offset in effect
+then. Offsets only change on the quarter hour, so they're looked up once per
+quarter hour seen and memoized; converting a batch is then a plain Python
+loop of integer arithmetic and dict lookups (not vectorized), with the
+results packed into an array to keep them compact. Day keys (days since
+1970-01-01, local time) compare and group like dates do.
+"""
+
+from array import array
+from datetime import date, datetime, timedelta, timezone
+import time
+
+try:
+    from zoneinfo import ZoneInfo as _get_timezone
+except ImportError: # python < 3.9
+    from pytz import timezone as _get_timezone
+
+SECONDS_PER_DAY = 24 * 60 * 60
+OFFSET_BUCKET_SECONDS = 15 * 60 # UTC offsets only change on the quarter hour
+EPOCH_DATE = date(1970, 1, 1)
+
+
+class _Offsets(dict):
+    """Quarter hour (since the epoch) -> UTC offset in seconds, looked up on
+    first use.
+    """
+
+    def __init__(self, tz):
+        super().__init__()
+        self._tz = tz
+
+    def __missing__(self, bucket):
+        seconds = bucket * OFFSET_BUCKET_SECONDS
+        if self._tz is None:
+            offset = time.localtime(seconds).tm_gmtoff
+        else:
+            utc = datetime.fromtimestamp(seconds, timezone.utc)
+            offset = int(utc.astimezone(self._tz).utcoffset().total_seconds())
+        self[bucket] = offset
+        return offset
+
+
+class LocalDays:
+    """Local time conversions for one timezone.
+
+    :param timezone_name: optional IANA timezone name (eg.
+        'America/Chicago'); defaults to this machine's local time
+    """
+
+    def __init__(self, timezone_name=None):
+        self.timezone_name = timezone_name
+        tz = None if timezone_name is None else _get_timezone(timezone_name)
+        self._offsets = _Offsets(tz)
+
+    def local_seconds(self, timestamps_ms):
+        """Array of local seconds since the epoch for timestamps_ms,
+        converted one by one.
+        """
+        offsets = self._offsets
+        seconds = [timestamp_ms // 1000 for timestamp_ms in timestamps_ms]
+        return array("q", [
+            second + offsets[second // OFFSET_BUCKET_SECONDS]
+            for second in seconds
+        ])
+
+    def to_utc_seconds(self, local_second):
+        """Inverse of local_seconds for one local time (seconds)."""
+        offsets = self._offsets
+        guess = local_second - offsets[local_second // OFFSET_BUCKET_SECONDS]
+        return local_second - offsets[guess // OFFSET_BUCKET_SECONDS]
+
+    def year_bounds(self, year):
+        """(start, end) of year as local seconds, to compare against
+        local_seconds.
+        """
+        start = (date(year, 1, 1) - EPOCH_DATE).days * SECONDS_PER_DAY
+        end = (date(year + 1, 1, 1) - EPOCH_DATE).days * SECONDS_PER_DAY
+        return start, end
+
+    def current_year(self):
+        now = int(time.time())
+        local_now = now + self._offsets[now // OFFSET_BUCKET_SECONDS]
+        return day_to_date(local_now // SECONDS_PER_DAY).year
+
+
+def day_keys(local_seconds):
+    """Array of day keys for local seconds, converted one by one."""
+    return array("l", [second // SECONDS_PER_DAY for second in local_seconds])
+
+
+def day_boundaries(keys):
+    """Indexes at which keys changes from its previous value."""
+    return [i for i in range(1, len(keys)) if keys[i] != keys[i - 1]]
+
+
+def day_to_date(day_key):
+    return EPOCH_DATE + timedelta(days=day_key)
+
+
+def format_local(local_second):
+    """'YYYY-MM-DD HH:MM:SS', as str(datetime) gives for whole seconds."""
+    day_key, second_of_day = divmod(local_second, SECONDS_PER_DAY)
+    hours, remainder = divmod(second_of_day, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{day_to_date(day_key)} {hours:02}:{minutes:02}:{seconds:02}"
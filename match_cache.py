@@ -0,0 +1,145 @@
+"""
+match_cache.py
+
+Remember which alum a name was matched to, between runs of
+fb_names_to_sf_ids, full_name_to_sf_ids and fb_notes_to_salesforce, so the
+same names don't need searching for (or choosing between) every week.
+
+Matches are kept in a SQLite file, keyed by campus and the name as
+name_matching.normalize_name gives it, with the Safe ID, the alum's
+Salesforce name and whether the match was confirmed by someone choosing it
+or made automatically (one strong match). Names someone chose none of the
+candidates for are kept too, with no Safe ID, so they aren't asked about
+again every run.
+
+A match is only used while it's younger than the cache's TTL, and is checked
+against the roster when it's read: the Safe IDs of the names asked for are
+looked up together (one search per name_matching.LOOKUP_BATCH_SIZE). A match
+whose alum is gone isn't used. One whose alum has been renamed is only used
+if it was confirmed; an automatic match was made against the old name, so
+it's made again.
+"""
+
+from collections import namedtuple
+import sqlite3
+import time
+
+from name_matching import lookup_alumni, normalize_name
+
+MATCH_CACHE_TTL_DAYS = 90 # after which matches are searched for again
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# safe_id is "" (and sf_name None) if someone chose none of the candidates
+CachedMatch = namedtuple("CachedMatch", ["safe_id", "sf_name", "confirmed"])
+
+
+def open_match_cache(filename, es_connection, campus, local_index=None,
+                     ttl_days=MATCH_CACHE_TTL_DAYS):
+    """MatchCache for campus, checking matches against local_index (a
+    name_matching.LocalNameIndex of it) if given, or else against Elastic.
+    """
+    if local_index is not None:
+        lookup = local_index.lookup_alumni
+    else:
+        def lookup(safe_ids):
+            return lookup_alumni(es_connection, campus, safe_ids)
+    return MatchCache(filename, campus, lookup, ttl_days)
+
+
+class MatchCache:
+    """Matches for one campus, kept in the SQLite file filename.
+
+    :param lookup: function taking Safe IDs and returning a dict of Safe ID:
+        full name for those still on the roster (eg. lookup_alumni)
+    :param ttl_days: age in days past which matches aren't used
+    """
+
+    def __init__(self, filename, campus, lookup,
+                 ttl_days=MATCH_CACHE_TTL_DAYS):
+        self.campus = campus
+        self.lookup = lookup
+        self.ttl_days = ttl_days
+        # used from the match thread in fb_notes_to_salesforce; only ever
+        # one thread at a time
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS matches (
+                campus TEXT,
+                name TEXT,
+                safe_id TEXT,
+                sf_name TEXT,
+                confirmed INTEGER,
+                matched_at INTEGER,
+                PRIMARY KEY (campus, name)
+            );
+        """)
+
+    def get_many(self, names):
+        """Dict of name: CachedMatch for those of names with a current
+        match, checking them all against the roster in one lookup.
+        """
+        oldest = int(time.time()) - self.ttl_days * SECONDS_PER_DAY
+        cached = {}
+        for name in names:
+            row = self._db.execute(
+                "SELECT safe_id, sf_name, confirmed FROM matches "
+                "WHERE campus = ? AND name = ? AND matched_at >= ?",
+                (self.campus, normalize_name(name), oldest),
+            ).fetchone()
+            if row is not None:
+                safe_id, sf_name, confirmed = row
+                cached[name] = CachedMatch(safe_id, sf_name, bool(confirmed))
+
+        current_names = self.lookup(
+            {match.safe_id for match in cached.values() if match.safe_id}
+        )
+        current = {}
+        for name, match in cached.items():
+            if not match.safe_id: # none of them; nothing to check
+                current[name] = match
+            elif match.safe_id not in current_names:
+                continue
+            elif current_names[match.safe_id] == match.sf_name:
+                current[name] = match
+            elif match.confirmed:
+                current[name] = match._replace(
+                    sf_name=current_names[match.safe_id]
+                )
+        return current
+
+    def get(self, name):
+        """CachedMatch for name, or None if there isn't a current one."""
+        return self.get_many([name]).get(name)
+
+    def put(self, name, safe_id, sf_name, confirmed):
+        """Remember name's match, replacing any before it.
+
+        :param confirmed: True if someone chose the match, False if it was
+            made automatically
+        """
+        self._db.execute(
+            "INSERT OR REPLACE INTO matches "
+            "(campus, name, safe_id, sf_name, confirmed, matched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                self.campus, normalize_name(name), safe_id, sf_name,
+                int(confirmed), int(time.time()),
+            ),
+        )
+
+    def put_no_match(self, name):
+        """Remember that someone chose none of name's candidates."""
+        self.put(name, "", None, confirmed=True)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,545 @@
+"""
+name_matching.py
+
+Shared pieces of matching alum names to Salesforce IDs via Elasticsearch,
+for fb_names_to_sf_ids and full_name_to_sf_ids.
+
+Both search for each name with name_search, a fuzzy `match` on `full_name`
+in the campus's index (alias) that reads only the MAX_HITS best hits and
+the SOURCE_FIELDS they need, then split the hits into strong matches
+(score >= ACCEPT_MATCH_SCORE, accepted when there's only one) and weak ones
+(to choose from). LocalNameIndex can stand in for
+the search: it reads a campus's alumni from Elastic once and answers the
+same query in memory, with hits shaped like Elastic's. Without it,
+multi_search sends the per-name searches in batched _msearch requests,
+several at once, rather than one request after another.
+
+LocalNameIndex scores like Elastic's BM25 does for a short field, so the
+thresholds keep their meaning: each query term scores the idf of the best
+matching term in the name (within FUZZINESS edits, transpositions
+counting as one), scaled down for each edit, and the name's score is the
+sum over query terms. Candidate terms are found by indexing every way of
+deleting up to FUZZINESS letters from each of the roster's terms (two terms
+within that many edits always share one), then checked with a bounded edit
+distance, so a lookup only compares against terms that could be close.
+
+Names with more than one likely match go in a MatchReview rather than
+stopping the run for someone to choose: they're asked about together at the
+end, or saved to a file to choose in later, with
+
+    python name_matching.py review.json
+
+and the file passed back to the script (as --choices) to apply them.
+"""
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import re
+
+from elasticsearch.helpers import scan as es_scan
+
+ACCEPT_MATCH_SCORE = 7.5 # score at which matches are "blindly" accepted
+MIN_SCORE_THRESHOLD = 2 # only return results from ES with this score or higher
+FUZZINESS = 2 # edits allowed per term, as in the Elastic queries
+
+MSEARCH_BATCH_SIZE = 100 # searches per _msearch request
+MSEARCH_CONCURRENCY = 4 # _msearch requests in flight at once
+MAX_HITS = 50 # best hits read per name; weak matches past this are noise
+LOOKUP_BATCH_SIZE = 1000 # Safe IDs looked up per search by lookup_alumni
+
+NAME_FIELD = "full_name"
+SOURCE_FIELDS = (
+    "full_name", "first_name", "last_name", "class_year", "safe_id", "campus",
+)
+
+# BM25 parameters, as Elastic's defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TERM_RE = re.compile(r"\w+")
+
+
+def split_matches(hits):
+    """Split hits into strong (score >= ACCEPT_MATCH_SCORE) and weak
+    matches, keeping their order.
+
+    :return: list of strong hits, list of weak hits
+    :rtype: tuple
+    """
+    strong_matches = [] # most likely matches, occasionally multiple
+    weak_matches = [] # < ACCEPT_MATCH_SCORE
+    for hit in hits:
+        if hit["_score"] >= ACCEPT_MATCH_SCORE:
+            strong_matches.append(hit)
+        else:
+            weak_matches.append(hit)
+    return strong_matches, weak_matches
+
+
+def name_search(name):
+    """Elastic search body for a fuzzy search of name's full_name."""
+    return {
+        "min_score": MIN_SCORE_THRESHOLD,
+        "size": MAX_HITS,
+        "_source": list(SOURCE_FIELDS),
+        "query": {
+            "match": {
+                NAME_FIELD: {
+                    "query": name,
+                    "fuzziness": FUZZINESS,
+                },
+            },
+        },
+    }
+
+
+def search_name(es_connection, campus, name):
+    """Hits for name among campus's alumni, best first."""
+    response = es_connection.search(index=campus, body=name_search(name))
+    return response["hits"]["hits"]
+
+
+def multi_search(es_connection, searches, index=None,
+                 batch_size=MSEARCH_BATCH_SIZE,
+                 concurrency=MSEARCH_CONCURRENCY):
+    """Run searches in _msearch requests of batch_size searches, with up to
+    concurrency requests at a time.
+
+    :param es_connection: elasticsearch.Elasticsearch (eg. from
+        elasticsearch_dsl's connections.create_connection)
+    :param searches: dict of key: search body (eg. from name_search)
+    :param index: index to search; by default, all of them
+    :return: dict of key: list of hits, best first
+    :rtype: dict
+    """
+    header = {} if index is None else {"index": index}
+    keys = list(searches)
+    batches = [
+        keys[start:start + batch_size]
+        for start in range(0, len(keys), batch_size)
+    ]
+
+    def run_batch(batch):
+        body = []
+        for key in batch:
+            body.append(header)
+            body.append(searches[key])
+        responses = es_connection.msearch(body=body)["responses"]
+        batch_hits = {}
+        for key, response in zip(batch, responses):
+            if "error" in response:
+                raise RuntimeError(
+                    f"Search for {key!r} failed: {response['error']}"
+                )
+            batch_hits[key] = response["hits"]["hits"]
+        return batch_hits
+
+    hits = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_hits in executor.map(run_batch, batches):
+            hits.update(batch_hits)
+    return hits
+
+
+def lookup_alumni(es_connection, campus, safe_ids,
+                  batch_size=LOOKUP_BATCH_SIZE):
+    """Dict of Safe ID: full name for those of safe_ids still among campus's
+    alumni, looked up batch_size at a time, one search each.
+    """
+    safe_ids = list(safe_ids)
+    names = {}
+    for start in range(0, len(safe_ids), batch_size):
+        batch = safe_ids[start:start + batch_size]
+        response = es_connection.search(index=campus, body={
+            "size": len(batch),
+            "_source": ["safe_id", NAME_FIELD],
+            "query": {"bool": {"filter": {"terms": {"safe_id": batch}}}},
+        })
+        for hit in response["hits"]["hits"]:
+            names[hit["_source"]["safe_id"]] = hit["_source"].get(NAME_FIELD)
+    return names
+
+
+def _scan_campus(es_connection, campus, fields):
+    """Every alum in campus, with only fields.
+
+    Scrolls the concrete indices behind campus's alias, filtered by the
+    campus field too, since scrolling doesn't respect the alias the way
+    searches do.
+    """
+    indices = list(es_connection.indices.get_alias(name=campus))
+    return es_scan(
+        es_connection, index=",".join(indices), scroll="1m",
+        query={
+            "_source": list(fields),
+            "query": {"bool": {"filter": {"term": {"campus": campus}}}},
+        },
+    )
+
+
+def elicit_match(candidates):
+    """
+    Iterate through `candidates` and return the index in the iterable indicated
+    by the user, or None if none indicated.
+
+    Each item in `candidates` should be a dictionary of search results, as
+    returned by elasticsearch query.
+    """
+    for i, candidate in enumerate(candidates):
+        print("{:>2}) {:<9} {:>15}, {:<15} ({}) {} ({})".format(
+            i, candidate["_score"], candidate["_source"]["last_name"],
+            candidate["_source"]["first_name"],
+            candidate["_source"]["class_year"], candidate["_id"],
+            candidate["_index"]
+        ))
+
+    match_index = input(
+        "Enter number of matched identity, or press Enter to pass on these "
+        "options: "
+    )
+    if match_index:
+        return int(match_index)
+
+
+class MatchDeferred(Exception):
+    """Raised by choose_match when a name's been set aside for review."""
+
+
+def choose_match(name, candidates, match_review=None, heading=None):
+    """Index in candidates of name's match, or None if it's none of them.
+
+    Without match_review, asks now, printing heading (eg. "Multiple strong
+    matches found for ...") first. With it, uses the choice made there, or
+    adds name to it to ask about later and raises MatchDeferred; the
+    review prints its own heading when it asks.
+    """
+    if match_review is None:
+        if heading is not None:
+            print(heading)
+        return elicit_match(candidates)
+    if name in match_review.choices:
+        choice = match_review.choices[name]
+        if choice is None:
+            return None
+        for i, candidate in enumerate(candidates):
+            if candidate["_source"]["safe_id"] == choice["safe_id"]:
+                return i
+        print(f"WARNING: chosen match {choice['safe_id']} for {name} isn't "
+              f"among its candidates anymore; choosing again")
+        del match_review.choices[name]
+    match_review.add(name, candidates)
+    raise MatchDeferred(name)
+
+
+class MatchReview:
+    """Names with more than one likely match, set aside to choose between
+    all at once.
+
+    choices holds what's been chosen so far, as name: the chosen
+    candidate's '_source', or None for none of them.
+    """
+
+    def __init__(self):
+        self.candidates = {} # name -> hits to choose from
+        self.choices = {}
+        self._passed = set() # names finish passed on without a choice
+
+    def chose_none(self, name):
+        """True if someone chose none of name's candidates, rather than it
+        being passed on for now by finish.
+        """
+        return (name in self.choices and self.choices[name] is None
+                and name not in self._passed)
+
+    def __len__(self):
+        """Number of names still to choose for."""
+        return sum(1 for name in self.candidates if name not in self.choices)
+
+    def add(self, name, candidates):
+        self.candidates[name] = list(candidates)
+
+    def review(self):
+        """Ask about each name not yet chosen for, one after another."""
+        pending = [name for name in self.candidates if name not in self.choices]
+        for count, name in enumerate(pending, start=1):
+            print(f"({count}/{len(pending)}) Which is {name}?")
+            candidates = self.candidates[name]
+            match_index = elicit_match(candidates)
+            if match_index is None:
+                self.choices[name] = None
+            else:
+                self.choices[name] = candidates[match_index]["_source"]
+
+    def finish(self, defer_filename=None):
+        """Ask about the names not yet chosen for, or with defer_filename,
+        save them there to choose for later and pass on them for now.
+        """
+        if not len(self):
+            return
+        if defer_filename is None:
+            self.review()
+            return
+        self.save(defer_filename)
+        print(f"Saved {len(self)} names to choose matches for to "
+              f"{defer_filename}")
+        for name in self.candidates:
+            if name not in self.choices:
+                self.choices[name] = None
+                self._passed.add(name)
+
+    def save(self, filename):
+        """Write the names and their candidates out as json, with each
+        name's choice as the chosen candidate's safe_id ("" for none of
+        them, null for not chosen yet).
+        """
+        names = []
+        for name, candidates in self.candidates.items():
+            choice = None
+            if name in self.choices:
+                source = self.choices[name]
+                choice = "" if source is None else source["safe_id"]
+            names.append({
+                "name": name,
+                "choice": choice,
+                "candidates": candidates,
+            })
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w", encoding="utf-8") as fhand:
+            json.dump({"names": names}, fhand, indent=2, ensure_ascii=False)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a MatchReview saved with save (and maybe chosen in since)."""
+        match_review = cls()
+        with open(filename, "r", encoding="utf-8") as fhand:
+            names = json.load(fhand)["names"]
+        for entry in names:
+            name = entry["name"]
+            match_review.add(name, entry["candidates"])
+            choice = entry.get("choice")
+            if choice is None:
+                continue
+            if choice == "":
+                match_review.choices[name] = None
+                continue
+            for candidate in entry["candidates"]:
+                if candidate["_source"]["safe_id"] == choice:
+                    match_review.choices[name] = candidate["_source"]
+                    break
+            else:
+                print(f"WARNING: {choice} isn't one of the candidates for "
+                      f"{name}; leaving it to choose again")
+        return match_review
+
+
+def name_terms(name):
+    """Lowercase word terms of name, as Elastic's standard analyzer splits
+    them.
+    """
+    return _TERM_RE.findall(name.lower())
+
+
+def normalize_name(name):
+    """name as its terms, so names that search the same compare equal."""
+    return " ".join(name_terms(name))
+
+
+class LocalNameIndex:
+    """In-memory fuzzy full_name search over one campus's alumni.
+
+    :param docs: iterable of Elastic hits (dicts with '_id', '_index' and
+        '_source'), eg. from from_elastic
+    """
+
+    def __init__(self, docs):
+        self._docs = []
+        doc_terms = [] # per doc, (term -> term frequency, number of terms)
+        postings = defaultdict(list) # term -> doc numbers
+        self._deletions = defaultdict(set) # term minus some letters -> terms
+        total_length = 0
+
+        for doc in docs:
+            doc_num = len(self._docs)
+            self._docs.append(doc)
+            term_freqs = defaultdict(int)
+            terms = name_terms(doc["_source"].get(NAME_FIELD) or "")
+            for term in terms:
+                term_freqs[term] += 1
+            doc_terms.append((term_freqs, len(terms)))
+            total_length += len(terms)
+            for term in term_freqs:
+                if term not in postings:
+                    self._index_term(term)
+                postings[term].append(doc_num)
+
+        # the BM25 term frequency part of each posting doesn't depend on the
+        # query, so it's worked out here
+        avg_length = total_length / len(self._docs) if self._docs else 0
+        self._postings = {} # term -> (idf, list of (doc number, tf norm))
+        for term, doc_nums in postings.items():
+            idf = math.log(
+                1 + (len(self._docs) - len(doc_nums) + 0.5)
+                / (len(doc_nums) + 0.5)
+            )
+            weighted = []
+            for doc_num in doc_nums:
+                term_freqs, length = doc_terms[doc_num]
+                tf = term_freqs[term]
+                weighted.append((doc_num, tf * (BM25_K1 + 1) / (tf + BM25_K1 * (
+                    1 - BM25_B + BM25_B * length / avg_length
+                ))))
+            self._postings[term] = (idf, weighted)
+
+    @classmethod
+    def from_elastic(cls, es_connection, campus):
+        """Build the index from every alum in campus, in one scan."""
+        return cls(_scan_campus(es_connection, campus, SOURCE_FIELDS))
+
+    def __len__(self):
+        return len(self._docs)
+
+    def lookup_alumni(self, safe_ids):
+        """As lookup_alumni, for the alumni indexed."""
+        safe_ids = set(safe_ids)
+        return {
+            doc["_source"]["safe_id"]: doc["_source"].get(NAME_FIELD)
+            for doc in self._docs
+            if doc["_source"].get("safe_id") in safe_ids
+        }
+
+    def search(self, full_name, min_score=MIN_SCORE_THRESHOLD):
+        """Hits for full_name with at least min_score, best first, shaped
+        like Elastic's (with '_score', '_id', '_index' and '_source').
+        """
+        doc_scores = defaultdict(float)
+        for query_term in set(name_terms(full_name)):
+            best_per_doc = {} # doc number -> best score for this query term
+            for term, edits in self._fuzzy_terms(query_term):
+                idf, weighted = self._postings[term]
+                weight = (1 - edits / min(len(query_term), len(term))) * idf
+                for doc_num, tf_norm in weighted:
+                    score = weight * tf_norm
+                    if score > best_per_doc.get(doc_num, 0):
+                        best_per_doc[doc_num] = score
+            for doc_num, score in best_per_doc.items():
+                doc_scores[doc_num] += score
+
+        hits = []
+        for doc_num, score in doc_scores.items():
+            if score < min_score:
+                continue
+            doc = self._docs[doc_num]
+            hits.append({
+                "_score": score,
+                "_id": doc["_id"],
+                "_index": doc.get("_index"),
+                "_source": doc["_source"],
+            })
+        hits.sort(key=lambda hit: hit["_score"], reverse=True)
+        return hits
+
+    def _index_term(self, term):
+        for deletion in _deletions(term, FUZZINESS):
+            self._deletions[deletion].add(term)
+
+    def _fuzzy_terms(self, query_term):
+        """(term, edits) for the roster's terms within FUZZINESS edits."""
+        candidates = set()
+        for deletion in _deletions(query_term, FUZZINESS):
+            candidates.update(self._deletions.get(deletion, ()))
+
+        for term in candidates:
+            edits = bounded_edit_distance(query_term, term, FUZZINESS)
+            if edits is not None and edits < min(len(query_term), len(term)):
+                yield term, edits
+
+
+def _deletions(term, max_deletions):
+    """term, and every string made by deleting up to max_deletions of its
+    letters.
+    """
+    deletions = {term}
+    frontier = {term}
+    for _ in range(max_deletions):
+        frontier = {
+            shorter[:i] + shorter[i + 1:]
+            for shorter in frontier
+            for i in range(len(shorter))
+        }
+        deletions |= frontier
+    return deletions
+
+
+def bounded_edit_distance(a, b, max_edits):
+    """Edit distance between a and b (insertions, deletions, substitutions
+    and adjacent transpositions each count as one), or None if it's more
+    than max_edits.
+    """
+    if abs(len(a) - len(b)) > max_edits:
+        return None
+    if a == b:
+        return 0
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(
+                previous[j] + 1, # deletion
+                current[j - 1] + 1, # insertion
+                previous[j - 1] + cost, # substitution
+            )
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                value = min(value, previous_previous[j - 2] + 1) # transposition
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > max_edits:
+            return None
+        previous_previous, previous = previous, current
+    distance = previous[len(b)]
+    return distance if distance <= max_edits else None
+
+
+def review_file(filename):
+    """Choose matches for the names in a saved MatchReview not yet chosen
+    for, saving the choices back to it.
+    """
+    match_review = MatchReview.load(filename)
+    if not len(match_review):
+        print(f"Every name in {filename} has been chosen for")
+        return
+    try:
+        match_review.review()
+    finally:
+        # keep what was chosen before stopping, eg. on ctrl-c
+        match_review.save(filename)
+    print(f"Saved choices to {filename}")
+
+
+def parse_args():
+    """
+    * review_file: json file of names to choose matches for, as saved by
+                   fb_names_to_sf_ids, full_name_to_sf_ids or
+                   fb_notes_to_salesforce with --defer
+    """
+    parser = argparse.ArgumentParser(
+        description="Choose matches for names set aside for review"
+    )
+    parser.add_argument(
+        "review_file",
+        help="json file of names and their candidates"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    review_file(args.review_file)
@@ -0,0 +1,353 @@
+"""
+near_duplicates.py
+
+Find Contact Notes whose Comments are nearly the same as another note's for
+the same contact and day, eg. a Facebook conversation that's in two ACs'
+downloads, or that was downloaded twice with a message edited or a photo
+added in between. The exact duplicate check in upload_contact_notes
+(Contact__c, Date_of_Contact__c and Subject__c) misses these when the
+subject differs, and a plain text comparison misses them when the comments
+differ at all.
+
+Comments are split into overlapping word shingles and summarized by a
+MinHash signature (one-permutation hashing, so each shingle is hashed once
+rather than once per hash function). Signatures are cut into bands and each
+band is stored in a bucket keyed by contact, day and the band's values;
+notes that share a bucket are candidates, and candidates whose signatures
+agree on at least THRESHOLD of their values are near duplicates. Checking a
+note only looks at its own buckets, so the cost doesn't grow with the number
+of notes indexed.
+
+The index can be kept in a (SQLite) file, to check new notes against ones
+uploaded before:
+
+    python near_duplicates.py notes.csv --index near_dups.sqlite --add
+
+writes 'deduped_notes.csv' without the notes that are near duplicates of
+an earlier row or of a note already in the index, then adds the rest to
+the index.
+
+Notes are indexed under their 18-character Contact ID and Salesforce
+datestring (see index_key), so the CLI and upload_contact_notes find each
+other's notes however the ID and date were written; pass --date-format if
+the input's dates aren't already Salesforce datestrings.
+"""
+
+import argparse
+from array import array
+from datetime import date
+from hashlib import blake2b
+from os import path
+import re
+import sqlite3
+
+from salesforce_utils import make_salesforce_datestr
+from salesforce_utils.constants import SALESFORCE_DATESTRING_FORMAT
+
+from common_date_formats import COMMON_DATE_FORMATS
+from salesforce_fields import contact_note as cn_fields
+from salesforce_ids import InvalidSalesforceId, normalize_sf_id
+from staging import open_reader, open_writer
+
+SHINGLE_SIZE = 3 # words per shingle
+NUM_HASHES = 128 # signature length; must be a power of two
+BANDS = 16 # NUM_HASHES / BANDS values per band; ~0.7 similarity to be a candidate
+THRESHOLD = 0.8 # estimated Jaccard similarity to count as a near duplicate
+
+_BIN_BITS = NUM_HASHES.bit_length() - 1
+_VALUE_BITS = 64 - _BIN_BITS
+_VALUE_MASK = (1 << _VALUE_BITS) - 1
+_EMPTY = _VALUE_MASK + 1 # larger than any value
+_ROWS = NUM_HASHES // BANDS
+_WORD_RE = re.compile(r"\w+")
+
+
+def shingles(text):
+    """Set of SHINGLE_SIZE-word shingles in text, ignoring case and
+    punctuation. Text shorter than a shingle is one shingle.
+    """
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {
+        " ".join(words[i:i + SHINGLE_SIZE])
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def signature(text):
+    """MinHash signature of text's shingles, as an array of NUM_HASHES
+    values, or None if text has no words.
+
+    Each shingle is hashed once; the top bits of the hash pick one of
+    NUM_HASHES bins and each bin keeps the smallest of the remaining bits.
+    Empty bins take the value of the next non-empty bin, offset by how far
+    away it is, so that short texts still compare sensibly.
+    """
+    bins = [_EMPTY] * NUM_HASHES
+    for shingle in shingles(text):
+        hashed = int.from_bytes(
+            blake2b(shingle.encode(), digest_size=8).digest(), "big"
+        )
+        index = hashed >> _VALUE_BITS
+        value = hashed & _VALUE_MASK
+        if value < bins[index]:
+            bins[index] = value
+    if all(value == _EMPTY for value in bins):
+        return None
+
+    densified = array("Q", bins)
+    for index, value in enumerate(bins):
+        distance = 0
+        while value == _EMPTY:
+            distance += 1
+            value = bins[(index + distance) % NUM_HASHES]
+        densified[index] = (value + distance * _EMPTY) & 0xFFFFFFFFFFFFFFFF
+    return densified
+
+
+def similarity(signature_a, signature_b):
+    """Estimated Jaccard similarity of the texts behind two signatures."""
+    same = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return same / NUM_HASHES
+
+
+def _band_keys(signature_values):
+    """One hash per band of the signature."""
+    for band in range(BANDS):
+        values = signature_values[band * _ROWS:(band + 1) * _ROWS]
+        yield band, int.from_bytes(
+            blake2b(values.tobytes(), digest_size=8).digest(), "big", signed=True
+        )
+
+
+class NearDuplicateIndex:
+    """LSH index of note signatures, by contact and day.
+
+    In memory unless given a filename, in which case it's kept in that
+    SQLite file between runs.
+    """
+
+    def __init__(self, filename=":memory:", threshold=THRESHOLD):
+        self.threshold = threshold
+        # opened here but used from the upload thread in
+        # fb_notes_to_salesforce; only ever one thread at a time
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (
+                id INTEGER PRIMARY KEY,
+                note_ref TEXT,
+                signature BLOB
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                contact TEXT,
+                day TEXT,
+                band INTEGER,
+                bucket INTEGER,
+                note_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS buckets_key
+                ON buckets (contact, day, band, bucket);
+        """)
+
+    def find(self, contact, day, comments):
+        """Notes in the index that are near duplicates of comments, for the
+        same contact and day.
+
+        :param contact: Contact ID, 15 or 18 characters
+        :param day: date or Salesforce (ISO) datestring
+        :return: list of (note_ref, similarity), most similar first
+        :rtype: list
+        """
+        note_signature = signature(comments)
+        if note_signature is None:
+            return []
+        return self._find(*index_key(contact, day), note_signature)
+
+    def add(self, contact, day, comments, note_ref=""):
+        """Add a note to the index. note_ref (eg. the Contact Note's Id) is
+        what find returns for it.
+        """
+        note_signature = signature(comments)
+        if note_signature is not None:
+            self._add(*index_key(contact, day), note_signature, note_ref)
+
+    def check_and_add(self, contact, day, comments, note_ref=""):
+        """find, then add the note if it isn't a near duplicate.
+
+        :return: list of (note_ref, similarity) near duplicates found
+        :rtype: list
+        """
+        note_signature = signature(comments)
+        if note_signature is None:
+            return []
+        contact, day = index_key(contact, day)
+        matches = self._find(contact, day, note_signature)
+        if not matches:
+            self._add(contact, day, note_signature, note_ref)
+        return matches
+
+    def _find(self, contact, day, note_signature):
+        candidate_ids = set()
+        for band, bucket in _band_keys(note_signature):
+            candidate_ids.update(note_id for note_id, in self._db.execute(
+                "SELECT note_id FROM buckets "
+                "WHERE contact = ? AND day = ? AND band = ? AND bucket = ?",
+                (contact, day, band, bucket),
+            ))
+
+        matches = []
+        for note_id in candidate_ids:
+            note_ref, blob = self._db.execute(
+                "SELECT note_ref, signature FROM notes WHERE id = ?",
+                (note_id,),
+            ).fetchone()
+            candidate = array("Q")
+            candidate.frombytes(blob)
+            score = similarity(note_signature, candidate)
+            if score >= self.threshold:
+                matches.append((note_ref, score))
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+    def _add(self, contact, day, note_signature, note_ref):
+        note_id = self._db.execute(
+            "INSERT INTO notes (note_ref, signature) VALUES (?, ?)",
+            (note_ref, note_signature.tobytes()),
+        ).lastrowid
+        self._db.executemany(
+            "INSERT INTO buckets VALUES (?, ?, ?, ?, ?)",
+            [
+                (contact, day, band, bucket, note_id)
+                for band, bucket in _band_keys(note_signature)
+            ],
+        )
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def index_key(contact, day):
+    """(contact, day) a note is indexed under: the 18-character form of the
+    Contact ID, and the day as a Salesforce datestring.
+
+    IDs that aren't valid are kept as they are, so they only match
+    themselves.
+
+    :param day: date or Salesforce datestring
+    """
+    contact = str(contact).strip()
+    try:
+        contact = normalize_sf_id(contact)
+    except InvalidSalesforceId:
+        pass
+    if isinstance(day, date):
+        day = day.strftime(SALESFORCE_DATESTRING_FORMAT)
+    return contact, str(day)
+
+
+def dedupe_notes(input_filename, index_filename=":memory:", add=False,
+                 threshold=THRESHOLD,
+                 source_date_format=SALESFORCE_DATESTRING_FORMAT):
+    """Save input_filename back out to deduped_<input_filename>, without
+    notes that are near duplicates of an earlier note in the file or (with
+    index_filename) of one in the index. With add, the kept notes are
+    added to the index.
+
+    :param source_date_format: format of the input's (string) dates, which
+        are converted to Salesforce datestrings to index them by
+    """
+    directory, filename = path.split(input_filename)
+    output_filename = path.join(directory, "deduped_" + filename)
+    kept_count = dropped_count = 0
+
+    # a scratch index for within the file, so add=False leaves the
+    # persistent one untouched
+    with NearDuplicateIndex(index_filename, threshold) as index, \
+            NearDuplicateIndex(threshold=threshold) as file_index:
+        with open_reader(input_filename) as reader:
+            with open_writer(output_filename, reader.fieldnames) as writer:
+                writer.writeheader()
+
+                for row_num, row in enumerate(reader, start=2):
+                    contact = row[cn_fields.CONTACT]
+                    day = row[cn_fields.DATE_OF_CONTACT]
+                    if not isinstance(day, date): # staging files have dates
+                        day = make_salesforce_datestr(day, source_date_format)
+                    comments = row[cn_fields.COMMENTS] or ""
+                    matches = index.find(contact, day, comments)
+                    matches += file_index.check_and_add(
+                        contact, day, comments, f"row {row_num}"
+                    )
+                    if matches:
+                        dropped_count += 1
+                        note_ref, score = max(matches, key=lambda m: m[1])
+                        print(f"Row {row_num} is a near duplicate of "
+                              f"{note_ref} ({score:.0%} similar)")
+                        continue
+
+                    kept_count += 1
+                    if add:
+                        index.add(contact, day, comments, f"{filename} row {row_num}")
+                    writer.writerow(row)
+
+    print(f"Kept {kept_count} notes, dropped {dropped_count}; "
+          f"saved to {output_filename}")
+    return output_filename
+
+
+def parse_args():
+    """
+    *        infile: notes csv (or staging file), with Salesforce field headers
+    *       --index: SQLite file of notes seen before. Without it, only checks
+                     within infile
+    *         --add: add the notes kept to the index
+    *   --threshold: similarity (0-1) at which notes are near duplicates
+    * --date-format: format of infile's dates, if they aren't Salesforce
+                     datestrings
+    """
+    parser = argparse.ArgumentParser(
+        description="Drop notes that are near duplicates of others"
+    )
+    parser.add_argument("infile", help="Input file (csv or staging file)")
+    parser.add_argument(
+        "--index",
+        default=":memory:",
+        help="SQLite file of notes seen before, eg. already uploaded"
+    )
+    parser.add_argument(
+        "--add",
+        action="store_true",
+        default=False,
+        help="Add the notes kept to the index"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help=f"Similarity at which notes are near duplicates. Defaults to {THRESHOLD}"
+    )
+    parser.add_argument(
+        "--date-format",
+        choices=COMMON_DATE_FORMATS,
+        default=SALESFORCE_DATESTRING_FORMAT,
+        help="Format of the input's dates, eg. '%%m/%%d/%%Y'. Defaults to"
+             " Salesforce datestrings"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    dedupe_notes(
+        args.infile, args.index, args.add, args.threshold, args.date_format
+    )
@@ -12,6 +12,8 @@ from elasticsearch_dsl.connections import connections as es_connections
 import requests
 from simple_salesforce import Salesforce
 
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 from full_name_to_sf_ids import _query_for_safe_id # TODO SF libs
 from salesforce_fields import contact_note as cn_fields
 from salesforce_fields import contact as contact_fields
@@ -29,8 +31,8 @@ def write_safe_ids(csv_filename, campus):
     """
     network_ids = []
 
-    with open(csv_filename) as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(csv_filename) as csvfile:
+        reader = CompactDictReader(csvfile)
 
         for row in reader:
             #if row['HS Class'] < '2011':
@@ -49,11 +51,11 @@ def write_safe_ids(csv_filename, campus):
         hosts=[ES_CONNECTION_KEY]
     )
 
-    with open(csv_filename, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(csv_filename, 'r') as csvfile:
+        reader = CompactDictReader(csvfile)
 
         outfile_name = "safe_ids_{}".format(csv_filename)
-        with open(outfile_name, 'w') as outfile:
+        with open_file(outfile_name, 'w') as outfile:
             fieldnames = reader.fieldnames
             writer = csv.DictWriter(outfile, fieldnames=fieldnames)
             writer.writeheader()
@@ -0,0 +1,170 @@
+"""
+parallel_csv.py
+
+Split a large csv into chunks that can be transformed on several cores.
+
+Comments (and Facebook transcripts especially) contain newlines inside
+quoted fields, so a chunk can't just end at any newline. A newline is only a
+record boundary when an even number of quote characters precede it, so the
+boundaries are found by counting quotes in the memory-mapped file, which
+never decodes or parses the rows in the parent process.
+
+Each chunk is handed to a process pool as a byte range, transformed by the
+pipeline stages (see pipeline.py), and written back out in input order. Only
+PENDING_CHUNKS_PER_PROCESS chunks per worker are handed out ahead of the
+one being written, so a slow output file doesn't let transformed chunks
+pile up in memory.
+"""
+
+from collections import deque
+import csv
+import io
+import mmap
+from multiprocessing import Pool
+import os
+
+from compressed_files import is_compressed, open_file
+from pipeline import build_pipeline
+
+CHUNK_SIZE = 16 * 1024 * 1024 # target bytes per chunk
+PENDING_CHUNKS_PER_PROCESS = 2 # chunks handed out ahead of the writer
+QUOTE = b'"'
+NEWLINE = b"\n"
+
+# set in each worker process by _init_worker
+_worker_state = {}
+
+
+def find_record_boundaries(mapped, start=0, chunk_size=CHUNK_SIZE):
+    """Return a list of byte offsets, beginning with `start` and ending with
+    the length of `mapped`, where each offset is the start of a csv record.
+
+    :param mapped: bytes-like (eg. mmap.mmap) contents of the csv file
+    :param start: offset of the first record (ie. just after the header)
+    :param chunk_size: approximate number of bytes between boundaries
+    """
+    end = len(mapped)
+    boundaries = [start]
+
+    while boundaries[-1] + chunk_size < end:
+        target = boundaries[-1] + chunk_size
+        # quotes between the last boundary and target; mmap has no count()
+        quote_count = mapped[boundaries[-1]:target].count(QUOTE)
+        position = next_record_start(mapped, target, quote_count)
+        if position >= end:
+            break
+        boundaries.append(position)
+
+    boundaries.append(end)
+    return boundaries
+
+
+def next_record_start(mapped, position, quote_count=0):
+    """Return the offset just past the first newline at or after `position`
+    that ends a record, or the length of `mapped` if there isn't one.
+
+    :param quote_count: number of quotes between the start of the current
+        record and `position`
+    """
+    while True:
+        newline = mapped.find(NEWLINE, position)
+        if newline == -1:
+            return len(mapped)
+        quote_count += mapped[position:newline].count(QUOTE)
+        position = newline + 1
+        if quote_count % 2 == 0:
+            return position
+
+
+def read_header(mapped, encoding):
+    """Return (list of headers, offset of the first record) from `mapped`."""
+    header_end = next_record_start(mapped, 0)
+    header_text = mapped[:header_end].decode(encoding)
+    if header_text.startswith("\ufeff"):
+        header_text = header_text[1:]
+    headers = next(csv.reader(io.StringIO(header_text, newline="")))
+    return headers, header_end
+
+
+def run_parallel(stage_specs, input_filename, output_filename,
+                 processes=None, encoding="utf-8", chunk_size=CHUNK_SIZE):
+    """Transform input_filename with the pipeline stage_specs on a pool of
+    `processes` workers, writing rows to output_filename in input order.
+
+    :return: tuple of (number of input rows, number of output rows)
+    :rtype: tuple
+    """
+    if is_compressed(input_filename):
+        raise ValueError(
+            f"Can't split compressed {input_filename} into chunks; "
+            "decompress it or run in a single process"
+        )
+    if os.path.getsize(input_filename) == 0:
+        # mmap can't map an empty file
+        raise ValueError(f"{input_filename} is empty; there's no header row")
+    input_count = output_count = 0
+
+    with open(input_filename, "rb") as infile, \
+            mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        input_headers, first_record = read_header(mapped, encoding)
+        boundaries = find_record_boundaries(mapped, first_record, chunk_size)
+    byte_ranges = list(zip(boundaries[:-1], boundaries[1:]))
+
+    output_headers, _ = build_pipeline(input_headers, stage_specs)
+    with open_file(output_filename, "w", newline="", encoding=encoding) as outfile:
+        csv.writer(outfile).writerow(output_headers)
+
+        init_args = (input_filename, encoding, input_headers, stage_specs)
+        max_pending = (processes or os.cpu_count()) * PENDING_CHUNKS_PER_PROCESS
+        with Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+            results = _imap_bounded(
+                pool, _transform_chunk, byte_ranges, max_pending
+            )
+            for chunk_in, chunk_out, text in results:
+                input_count += chunk_in
+                output_count += chunk_out
+                outfile.write(text)
+
+    return input_count, output_count
+
+
+def _imap_bounded(pool, func, items, max_pending):
+    """Like pool.imap(func, items), but with at most max_pending items
+    handed out whose results haven't been taken yet.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _init_worker(input_filename, encoding, headers, stage_specs):
+    """Open and map the input file once per worker, and build the stages."""
+    infile = open(input_filename, "rb")
+    _worker_state["file"] = infile
+    _worker_state["mapped"] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker_state["encoding"] = encoding
+    _, _worker_state["transform"] = build_pipeline(headers, stage_specs)
+
+
+def _transform_chunk(byte_range):
+    """Transform the records in byte_range; return (number of input rows,
+    number of output rows, csv text of the output rows).
+    """
+    start, end = byte_range
+    text = _worker_state["mapped"][start:end].decode(_worker_state["encoding"])
+    transform = _worker_state["transform"]
+
+    output = io.StringIO(newline="")
+    writer = csv.writer(output)
+    input_count = output_count = 0
+    for row in csv.reader(io.StringIO(text, newline="")):
+        input_count += 1
+        for output_row in transform(row):
+            writer.writerow(output_row)
+            output_count += 1
+
+    return input_count, output_count, output.getvalue()
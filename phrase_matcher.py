@@ -0,0 +1,64 @@
+"""
+phrase_matcher.py
+
+Match text against a list of phrases in one pass.
+
+The phrases are folded into a trie and compiled into a single regular
+expression, so every phrase shares the work of its common prefixes; eg.
+"sent you an invite" and "sent an attachment" are tried as
+"sent (?:you an invite| an attachment)". Matching cost grows with the
+length of the text rather than with the number of phrases, so phrase lists
+can run to hundreds of entries.
+
+Phrase files have one phrase per line. Blank lines and lines starting with
+'#' are skipped, and phrases are matched case-insensitively (text and
+phrases are both lowercased).
+"""
+
+import re
+
+COMMENT_PREFIX = "#"
+_END = "" # trie key marking the end of a phrase
+
+
+def load_phrases(filename):
+    """Return a tuple of the lowercase phrases in filename."""
+    phrases = []
+    with open(filename, "r", encoding="utf-8") as fhand:
+        for line in fhand:
+            phrase = line.strip()
+            if phrase and not phrase.startswith(COMMENT_PREFIX):
+                phrases.append(phrase.lower())
+    return tuple(phrases)
+
+
+def compile_phrases(phrases):
+    """Compile phrases into one regex that finds any of them.
+
+    Use `.search(text.lower())`. An empty list compiles to a regex that
+    never matches.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase.lower():
+            node = node.setdefault(char, {})
+        node[_END] = True
+    if not trie:
+        return re.compile(r"(?!)")
+    return re.compile(_trie_pattern(trie))
+
+
+def _trie_pattern(node):
+    """Regex for the phrases below node, factoring out shared prefixes."""
+    if node.get(_END):
+        # a phrase ends here, so any longer phrase through this node can only
+        # match where this one already has
+        return ""
+    branches = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+    ]
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")"
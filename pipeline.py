@@ -0,0 +1,170 @@
+"""
+pipeline.py
+
+Run several of the csv prep scripts over a file in one pass, instead of
+chaining the scripts and their intermediate files (prepped_*, stripped_*,
+with_fullnames_*, summarized_*, merged_*). The input is read once and the
+output written once; each row goes through every stage in memory.
+
+Stages are listed, in order, in a json spec file, eg.
+
+    {
+        "stages": [
+            {"name": "strip_salesforce_url", "url_column": 0},
+            {"name": "prep_headers"},
+            {"name": "break_contact_notes"}
+        ]
+    }
+
+Any other keys on a stage are passed to that stage as keyword arguments.
+Saves to 'pipelined_<input filename>' unless an output file is given.
+
+With --processes, the file is split into chunks on record boundaries and
+transformed on a pool of worker processes (see parallel_csv.py).
+"""
+
+import argparse
+import csv
+import json
+from os import path
+
+from break_contact_notes import break_notes_stage
+from compressed_files import is_compressed, open_file
+from prep_headers import prep_headers_stage
+from salesforce_ids import normalize_ids_stage
+from split_names import full_name_stage
+from strip_salesforce_url import strip_url_stage
+from summarize_contact_notes import summarize_stage
+
+ENCODING = "utf-8" # of input and output files, in either mode
+# reading with this also drops a byte order mark, as parallel_csv does
+INPUT_ENCODING = "utf-8-sig"
+
+# stage name in spec file: function(headers, **params) returning a tuple of
+# (output headers, function(row) returning an iterable of output rows)
+STAGES = {
+    "prep_headers": prep_headers_stage,
+    "strip_salesforce_url": strip_url_stage,
+    "split_names": full_name_stage,
+    "summarize_contact_notes": summarize_stage,
+    "break_contact_notes": break_notes_stage,
+    "normalize_salesforce_ids": normalize_ids_stage,
+}
+
+
+def run_pipeline(spec_file, input_filename, output_filename=None,
+                 processes=None):
+    """Read input_filename once, pass every row through the stages in
+    spec_file, and write the results to output_filename.
+
+    If `processes` is given, transform chunks of the file in that many
+    worker processes instead.
+    """
+    if output_filename is None:
+        output_filename = "pipelined_" + path.split(input_filename)[1]
+    stage_specs = load_spec(spec_file)
+
+    if processes and is_compressed(input_filename):
+        print(f"{input_filename} is compressed; running in a single process")
+    elif processes:
+        # imported here; parallel_csv imports build_pipeline from this module
+        from parallel_csv import run_parallel
+        input_count, output_count = run_parallel(
+            stage_specs, input_filename, output_filename, processes=processes,
+            encoding=ENCODING,
+        )
+        print(f"Read {input_count} rows, wrote {output_count} to {output_filename}")
+        return output_filename
+
+    input_count = output_count = 0
+
+    with open_file(
+        input_filename, "r", newline="", encoding=INPUT_ENCODING
+    ) as infile:
+        reader = csv.reader(infile)
+        headers, transform = build_pipeline(next(reader), stage_specs)
+
+        with open_file(
+            output_filename, "w", newline="", encoding=ENCODING
+        ) as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(headers)
+
+            for row in reader:
+                input_count += 1
+                for output_row in transform(row):
+                    writer.writerow(output_row)
+                    output_count += 1
+
+    print(f"Read {input_count} rows, wrote {output_count} to {output_filename}")
+    return output_filename
+
+
+def load_spec(spec_file):
+    """Return the list of stage specs (dicts) from spec_file, checking that
+    each one names a known stage.
+    """
+    with open(spec_file, "r") as fhand:
+        stage_specs = json.load(fhand)["stages"]
+
+    for stage_spec in stage_specs:
+        if stage_spec.get("name") not in STAGES:
+            raise ValueError(
+                f"Unknown stage {stage_spec.get('name')!r}; "
+                f"expected one of {sorted(STAGES)}"
+            )
+    return stage_specs
+
+
+def build_pipeline(headers, stage_specs):
+    """Compose the stages in stage_specs.
+
+    :param headers: list of str headers from the input file
+    :param stage_specs: list of dicts, as returned by load_spec
+    :return: tuple of (output headers, function(row) returning a list of
+        output rows)
+    :rtype: tuple
+    """
+    row_functions = []
+    for stage_spec in stage_specs:
+        params = {k: v for k, v in stage_spec.items() if k != "name"}
+        headers, row_function = STAGES[stage_spec["name"]](headers, **params)
+        row_functions.append(row_function)
+
+    def transform(row):
+        rows = [row]
+        for row_function in row_functions:
+            rows = [out_row for in_row in rows for out_row in row_function(in_row)]
+        return rows
+
+    return headers, transform
+
+
+def parse_args():
+    """
+    *      spec: json file listing the stages to run
+    *    infile: input csv file
+    * --outfile: output csv file. Defaults to pipelined_<infile>
+    * --processes: number of worker processes; runs in this process if absent
+    """
+
+    parser = argparse.ArgumentParser(description="Specify spec and input file")
+    parser.add_argument("spec", help="Pipeline spec (json) file")
+    parser.add_argument("infile", help="Input file (in csv format)")
+    parser.add_argument(
+        "--outfile",
+        default=None,
+        help="Output file. Defaults to pipelined_<infile>"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worker processes to split the file across"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_pipeline(args.spec, args.infile, args.outfile, args.processes)
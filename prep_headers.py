@@ -12,6 +12,7 @@ import argparse
 import csv
 from os import path
 
+from compressed_files import open_file
 from header_mappings import HEADER_MAPPINGS
 
 
@@ -22,25 +23,36 @@ def clean_headers(source_file):
     source_filename = path.split(source_file)[1]
     output_filename = 'prepped_' + source_filename
 
-    with open(source_file, 'r') as source_csv:
-        reader = csv.DictReader(source_csv)
-        source_headers = [f.strip() for f in reader.fieldnames]
-        target_headers = list(map(
-            lambda x: HEADER_MAPPINGS.get(x.lower(), x), source_headers
-        ))
-        reader.fieldnames = target_headers # else it can't map back out
+    with open_file(source_file, 'r', newline='') as source_csv:
+        reader = csv.reader(source_csv)
+        target_headers, prep_row = prep_headers_stage(next(reader))
 
-        with open(output_filename, 'w', newline='') as output_csv:
-            writer = csv.DictWriter(output_csv, target_headers)
-            writer.writeheader()
+        with open_file(output_filename, 'w', newline='') as output_csv:
+            writer = csv.writer(output_csv)
+            writer.writerow(target_headers)
 
             for row in reader:
-                writer.writerow(row)
+                writer.writerows(prep_row(row))
 
     print("Created {}".format(output_filename))
     return output_filename
 
 
+def prep_headers_stage(headers):
+    """
+    Pipeline stage (see pipeline.py): map headers to Salesforce field names;
+    rows pass through untouched.
+    """
+    target_headers = [
+        HEADER_MAPPINGS.get(h.strip().lower(), h.strip()) for h in headers
+    ]
+    return target_headers, _pass_row
+
+
+def _pass_row(row):
+    return (row,)
+
+
 def parse_args():
     """
     infile: name of input csv file. Assumes the following headers in input:
@@ -0,0 +1,158 @@
+"""
+salesforce_ids.py
+
+Normalize and validate Salesforce IDs locally, before spending API calls on
+them.
+
+Accepts bare 15- or 18-character IDs, or classic
+(https://na1.salesforce.com/0031a00000AbCdE) and lightning
+(https://x.lightning.force.com/lightning/r/Contact/0031a00000AbCdEAAV/view)
+record URLs, including ones with query strings. Returns the 18-character
+form, computing the case-safe checksum suffix for 15-character IDs and
+checking it on 18-character ones. An 18-character ID whose first 15
+characters are all one case (eg. uppercased in a spreadsheet) has lost its
+case, so that's restored from its suffix instead.
+"""
+
+import re
+from urllib.parse import parse_qsl, urlsplit
+
+CONTACT_KEY_PREFIX = "003"
+
+CHECKSUM_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ012345"
+ID_RE = re.compile(r"[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?")
+
+
+class InvalidSalesforceId(ValueError):
+    pass
+
+
+def normalize_sf_id(value, key_prefix=None):
+    """Return the 18-character Salesforce ID in value (an ID or record URL).
+
+    :param value: str ID or URL
+    :param key_prefix: optional str 3-character key prefix the ID must start
+        with, eg. CONTACT_KEY_PREFIX
+    :raises InvalidSalesforceId: if no valid ID is found
+    """
+    value = value.strip()
+    sf_id = value if ID_RE.fullmatch(value) else _id_from_url(value)
+    if sf_id is None:
+        raise InvalidSalesforceId(f"No Salesforce ID found in {value!r}")
+
+    if len(sf_id) == 18:
+        sf_id = _check_suffix(sf_id)
+    else:
+        sf_id = sf_id + checksum_suffix(sf_id)
+
+    if key_prefix is not None and not sf_id.startswith(key_prefix):
+        raise InvalidSalesforceId(
+            f"{sf_id!r} isn't a {key_prefix}* ID"
+        )
+    return sf_id
+
+
+def normalize_sf_ids(values, key_prefix=None, seen=None):
+    """normalize_sf_id over an iterable of values, only doing the work once
+    for each distinct value.
+
+    :param seen: optional dict to remember results in, to share them across
+        calls (eg. for a column passed a row at a time)
+    :return: tuple of (list of 18-character IDs, with None for invalid
+        values; dict of index: error message for the invalid values)
+    :rtype: tuple
+    """
+    if seen is None:
+        seen = {}
+    normalized = []
+    errors = {}
+    for i, value in enumerate(values):
+        if value not in seen:
+            try:
+                seen[value] = (normalize_sf_id(value, key_prefix), None)
+            except InvalidSalesforceId as e:
+                seen[value] = (None, str(e))
+        sf_id, error = seen[value]
+        normalized.append(sf_id)
+        if error is not None:
+            errors[i] = error
+    return normalized, errors
+
+
+def checksum_suffix(sf_id_15):
+    """The 3 characters that make a 15-character ID case-insensitive.
+
+    Each 5-character chunk of the ID gives one character: a bitmask of which
+    of its characters are uppercase letters, indexed into CHECKSUM_CHARS.
+    """
+    suffix = []
+    for chunk_start in range(0, 15, 5):
+        bits = 0
+        for i, char in enumerate(sf_id_15[chunk_start:chunk_start + 5]):
+            if "A" <= char <= "Z":
+                bits |= 1 << i
+        suffix.append(CHECKSUM_CHARS[bits])
+    return "".join(suffix)
+
+
+def _check_suffix(sf_id_18):
+    """The 18-character ID, with its suffix checked against its first 15
+    characters, or if they're all one case, with their case restored from
+    the suffix.
+
+    :raises InvalidSalesforceId: if the suffix doesn't match
+    """
+    body, suffix = sf_id_18[:15], sf_id_18[15:].upper()
+    if body.isupper() or body.islower():
+        body = _restore_case(body, suffix)
+    if suffix != checksum_suffix(body):
+        raise InvalidSalesforceId(
+            f"Checksum of {sf_id_18!r} doesn't match; expected "
+            f"{body + checksum_suffix(body)!r}"
+        )
+    return body + suffix
+
+
+def _restore_case(sf_id_15, suffix):
+    """sf_id_15 with the case of its letters set by the checksum suffix."""
+    restored = []
+    for chunk_start, suffix_char in zip(range(0, 15, 5), suffix):
+        bits = CHECKSUM_CHARS.find(suffix_char)
+        for i, char in enumerate(sf_id_15[chunk_start:chunk_start + 5]):
+            if bits & (1 << i):
+                restored.append(char.upper())
+            else:
+                restored.append(char.lower())
+    return "".join(restored)
+
+
+def _id_from_url(url):
+    """Return the last path segment (or else query value) of url that looks
+    like an ID, or None.
+    """
+    parts = urlsplit(url)
+    for segment in reversed(parts.path.split("/")):
+        if ID_RE.fullmatch(segment):
+            return segment
+    for _, query_value in parse_qsl(parts.query):
+        if ID_RE.fullmatch(query_value):
+            return query_value
+    return None
+
+
+def normalize_ids_stage(headers, column="Contact__c", key_prefix=None):
+    """Pipeline stage (see pipeline.py): normalize the IDs in `column`,
+    blanking (with a warning) any that aren't valid.
+    """
+    column_i = list(headers).index(column)
+
+    def normalize_row(row):
+        if row[column_i]:
+            try:
+                row[column_i] = normalize_sf_id(row[column_i], key_prefix)
+            except InvalidSalesforceId as e:
+                print(f"WARNING: {e}; blanking it")
+                row[column_i] = ""
+        return (row,)
+
+    return headers, normalize_row
@@ -4,12 +4,14 @@ split_names.py
 For those times when the 'Last' name column contains 'LastName, FirstName',
 despite there also being a 'First' name column, which is also (sparingly) used.
 
-Write back out to csv; assumes a 'Full Name' column has been added already.
+Write back out to csv; adds a 'Full Name' column if there isn't one already.
 """
 
 import argparse
 import csv
 
+from compressed_files import open_file
+
 # TODO parameterize
 FIRST_NAME_HEADER = 'First Name'
 LAST_NAME_HEADER = 'Last Name'
@@ -20,28 +22,46 @@ def write_full_name(input_filename):
 
     output_filename = "with_fullnames_{}".format(input_filename)
 
-    with open(input_filename) as infile:
-        reader = csv.DictReader(infile)
+    with open_file(input_filename, newline='') as infile:
+        reader = csv.reader(infile)
+        fieldnames, full_name_row = full_name_stage(next(reader))
 
-        with open(output_filename, 'w') as outfile:
-            fieldnames = reader.fieldnames
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-            writer.writeheader()
+        with open_file(output_filename, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(fieldnames)
 
             for row in reader:
-                if not row[FIRST_NAME_HEADER]:
-                    # Last name col contains full name; split it
-                    last_name, first_name = row[LAST_NAME_HEADER].split(',')
-                    first_name = first_name.strip()
-                    row[LAST_NAME_HEADER] = last_name
-                    row[FIRST_NAME_HEADER] = first_name
-                    row[FULL_NAME_HEADER] = " ".join((first_name, last_name))
-                else:
-                    first_name = row[FIRST_NAME_HEADER]
-                    last_name = row[LAST_NAME_HEADER]
-                    row[FULL_NAME_HEADER] = " ".join((first_name, last_name))
-
-                writer.writerow(row)
+                writer.writerows(full_name_row(row))
+
+
+def full_name_stage(headers, first_name_header=FIRST_NAME_HEADER,
+                    last_name_header=LAST_NAME_HEADER,
+                    full_name_header=FULL_NAME_HEADER):
+    """Pipeline stage (see pipeline.py): fill in the full name column,
+    splitting 'LastName, FirstName' out of the last name column when the
+    first name column is empty.
+    """
+    headers = list(headers)
+    if full_name_header not in headers:
+        headers.append(full_name_header)
+    first_i = headers.index(first_name_header)
+    last_i = headers.index(last_name_header)
+    full_i = headers.index(full_name_header)
+    width = len(headers)
+
+    def full_name_row(row):
+        if len(row) < width:
+            row.extend([''] * (width - len(row)))
+        if not row[first_i]:
+            # Last name col contains full name; split it
+            last_name, first_name = row[last_i].split(',')
+            first_name = first_name.strip()
+            row[last_i] = last_name
+            row[first_i] = first_name
+        row[full_i] = " ".join((row[first_i], row[last_i]))
+        return (row,)
+
+    return headers, full_name_row
 
 
 def parse_args():
@@ -0,0 +1,324 @@
+"""
+stage_graph.py
+
+A make-like runner for multi-script workflows, eg. the Facebook notes chain
+(fb_messages_to_csv, check_fb_ignores, fb_names_to_sf_ids, add_owner_ids,
+upload_contact_notes).
+
+Stages are declared in a json spec file:
+
+    {
+        "params": {"campus": "Muchin", "messages_dir": "messages"},
+        "stages": {
+            "fb_messages": {
+                "command": ["python", "fb_messages_to_csv.py",
+                            "{messages_dir}", "--outfile", "fb_messages.csv"],
+                "inputs": ["{messages_dir}"],
+                "outputs": ["fb_messages.csv"]
+            },
+            "fb_ids": {
+                "command": ["python", "fb_names_to_sf_ids.py",
+                            "fb_messages.csv", "fb_ids.csv", "{campus}"],
+                "inputs": ["fb_messages.csv"],
+                "outputs": ["fb_ids.csv"],
+                "interactive": true
+            }
+        }
+    }
+
+A stage depends on whichever stages produce its inputs. Each stage's key is
+a hash of its command, params, the contents of its inputs and of any .py
+files in its command. After a stage runs, its outputs are copied into the
+cache under that key; on later runs a stage is skipped when its outputs
+already match the cached ones for the current key, or restored from the
+cache when it has seen that key before. Stages whose dependencies are done
+run concurrently, except that interactive stages (those that prompt) run
+one at a time.
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+
+CACHE_DIR = ".stage_cache"
+MANIFEST_FILENAME = "manifest.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def run_graph(spec_file, targets=None, force=(), params=None, jobs=4):
+    """Run the stages in spec_file needed for `targets` (all stages if
+    None), skipping those that are up to date.
+
+    :param force: stage names to run even if they're up to date
+    :param params: dict of params overriding those in the spec file
+    :param jobs: max number of stages to run at once
+    :return: dict of stage name: 'ran', 'skipped', 'restored', 'failed' or
+        'blocked' (an upstream stage failed)
+    :rtype: dict
+    """
+    stages, spec_params = load_spec(spec_file)
+    spec_params.update(params or {})
+    stages = {
+        name: _format_stage(stage, spec_params) for name, stage in stages.items()
+    }
+    dependencies = _find_dependencies(stages)
+    wanted = _with_upstream(targets or list(stages), dependencies)
+
+    results = {}
+    interactive_lock = threading.Lock()
+    pending = set(wanted)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                upstream = dependencies[name]
+                if any(results.get(u) in ("failed", "blocked") for u in upstream):
+                    results[name] = "blocked"
+                    print(f"[{name}] blocked by failed upstream stage")
+                    pending.discard(name)
+                elif all(u in results for u in upstream):
+                    future = executor.submit(
+                        _run_stage, name, stages[name], spec_params,
+                        name in force, interactive_lock,
+                    )
+                    running[future] = name
+                    pending.discard(name)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"[{name}] failed: {e}")
+                    results[name] = "failed"
+
+    return results
+
+
+def load_spec(spec_file):
+    """Return (dict of stage name: stage dict, dict of params) from the
+    spec file, filling in stage defaults.
+    """
+    with open(spec_file, "r") as fhand:
+        spec = json.load(fhand)
+
+    stages = {}
+    for name, stage in spec["stages"].items():
+        if "command" not in stage:
+            raise ValueError(f"Stage {name!r} has no command")
+        stages[name] = {
+            "command": list(stage["command"]),
+            "inputs": list(stage.get("inputs", ())),
+            "outputs": list(stage.get("outputs", ())),
+            "interactive": bool(stage.get("interactive", False)),
+        }
+    return stages, dict(spec.get("params", {}))
+
+
+def _format_stage(stage, params):
+    """Substitute {param}s into a stage's command, inputs and outputs."""
+    formatted = dict(stage)
+    for key in ("command", "inputs", "outputs"):
+        formatted[key] = [item.format(**params) for item in stage[key]]
+    return formatted
+
+
+def _find_dependencies(stages):
+    """Return dict of stage name: set of names of the stages it depends on."""
+    producers = {}
+    for name, stage in stages.items():
+        for output in stage["outputs"]:
+            if output in producers:
+                raise ValueError(
+                    f"{output} is produced by both {producers[output]} and {name}"
+                )
+            producers[output] = name
+
+    dependencies = {
+        name: {producers[i] for i in stage["inputs"] if i in producers} - {name}
+        for name, stage in stages.items()
+    }
+    _check_for_cycles(dependencies)
+    return dependencies
+
+
+def _check_for_cycles(dependencies):
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage graph has a cycle through {name!r}")
+        visiting.add(name)
+        for upstream in dependencies[name]:
+            visit(upstream)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in dependencies:
+        visit(name)
+
+
+def _with_upstream(targets, dependencies):
+    """Return the set of targets plus everything upstream of them."""
+    wanted = set()
+    to_visit = list(targets)
+    while to_visit:
+        name = to_visit.pop()
+        if name not in dependencies:
+            raise ValueError(f"Unknown stage {name!r}")
+        if name not in wanted:
+            wanted.add(name)
+            to_visit.extend(dependencies[name])
+    return wanted
+
+
+def _run_stage(name, stage, params, force, interactive_lock):
+    """Run (or skip, or restore) a single stage; return what was done."""
+    key = stage_key(stage, params)
+    cached_dir = os.path.join(CACHE_DIR, name, key)
+    manifest = _read_manifest(cached_dir)
+
+    if manifest is not None and not force:
+        if _outputs_match(manifest):
+            print(f"[{name}] up to date")
+            return "skipped"
+        cached_outputs = [
+            (os.path.join(cached_dir, _cache_name(output)), output)
+            for output in stage["outputs"]
+        ]
+        # eg. cached under an older naming scheme; run the stage instead
+        if all(os.path.exists(cached) for cached, _ in cached_outputs):
+            for cached, output in cached_outputs:
+                shutil.copyfile(cached, output)
+            print(f"[{name}] restored outputs from cache")
+            return "restored"
+
+    print(f"[{name}] running: {' '.join(stage['command'])}")
+    if stage["interactive"]:
+        with interactive_lock:
+            subprocess.run(stage["command"], check=True)
+    else:
+        subprocess.run(stage["command"], check=True, stdin=subprocess.DEVNULL)
+
+    _store_outputs(cached_dir, stage["outputs"])
+    return "ran"
+
+
+def stage_key(stage, params):
+    """Hash of everything that determines a stage's outputs."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(
+        [stage["command"], sorted(params.items())], sort_keys=True
+    ).encode())
+    scripts = [arg for arg in stage["command"] if arg.endswith(".py")]
+    for path in stage["inputs"] + scripts:
+        digest.update(path.encode())
+        digest.update(hash_path(path).encode())
+    return digest.hexdigest()
+
+
+def hash_path(path):
+    """sha256 of a file's contents, or of every file under a directory
+    (with their relative paths). Missing paths hash as 'missing'.
+    """
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                filepath = os.path.join(root, filename)
+                digest.update(os.path.relpath(filepath, path).encode())
+                digest.update(hash_path(filepath).encode())
+        return digest.hexdigest()
+    if not os.path.exists(path):
+        return "missing"
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as fhand:
+        for block in iter(lambda: fhand.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _store_outputs(cached_dir, outputs):
+    os.makedirs(cached_dir, exist_ok=True)
+    manifest = {}
+    for output in outputs:
+        if not os.path.exists(output):
+            raise FileNotFoundError(f"Stage didn't produce {output}")
+        shutil.copyfile(output, os.path.join(cached_dir, _cache_name(output)))
+        manifest[output] = hash_path(output)
+    with open(os.path.join(cached_dir, MANIFEST_FILENAME), "w") as fhand:
+        json.dump(manifest, fhand, indent=2)
+
+
+def _read_manifest(cached_dir):
+    try:
+        with open(os.path.join(cached_dir, MANIFEST_FILENAME), "r") as fhand:
+            return json.load(fhand)
+    except FileNotFoundError:
+        return None
+
+
+def _outputs_match(manifest):
+    return all(hash_path(output) == h for output, h in manifest.items())
+
+
+def _cache_name(output):
+    """A filename in the cache dir for an output path: a hash of the whole
+    path (so different paths never share one), then its basename to read by.
+    """
+    path_hash = hashlib.sha256(output.encode()).hexdigest()[:16]
+    return f"{path_hash}_{os.path.basename(output)}"
+
+
+def parse_args():
+    """
+    *      spec: json file declaring the stages
+    *   targets: stages to bring up to date (with everything upstream of
+                 them). Defaults to all stages
+    *   --force: stage(s) to re-run even if up to date
+    *   --param: key=value, overriding params in the spec file
+    *    --jobs: max number of stages to run at once
+    """
+
+    parser = argparse.ArgumentParser(description="Specify stage graph spec")
+    parser.add_argument("spec", help="Stage graph spec (json) file")
+    parser.add_argument("targets", nargs="*", help="Stages to run")
+    parser.add_argument("--force", nargs="+", default=(), help="Stages to re-run")
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="key=value param, overriding the spec file's",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Max number of stages to run at once. Defaults to 4"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    params = dict(param.split("=", 1) for param in args.param)
+    results = run_graph(
+        args.spec, targets=args.targets, force=set(args.force),
+        params=params, jobs=args.jobs,
+    )
+    for name, result in sorted(results.items()):
+        print(f"{name}: {result}")
+    if any(r in ("failed", "blocked") for r in results.values()):
+        raise SystemExit(1)
@@ -0,0 +1,258 @@
+"""
+staging.py
+
+An optional SQLite staging format for passing notes between scripts,
+in place of csv.
+
+A csv written by one step has to be parsed again by the next, and values
+like Initiated_by_alum__c ('True'/'False') and dates re-coerced every time.
+A staging file (any filename ending in .sqlite or .db) stores one table of
+typed columns instead: booleans come back as bools and ISO dates as
+datetime.date, and readers can ask for only the columns they need.
+
+open_reader/open_writer pick the format from the filename, so scripts that
+use them take either. To get a csv for humans (or back into staging):
+
+    python staging.py export fb_notes.sqlite fb_notes.csv
+    python staging.py import fb_notes.csv fb_notes.sqlite
+"""
+
+import argparse
+from contextlib import contextmanager
+import csv
+from datetime import date, datetime
+import sqlite3
+
+from compact_rows import CompactDictReader, Row
+from compressed_files import open_file
+from salesforce_fields import contact_note as cn_fields
+
+STAGING_EXTENSIONS = (".sqlite", ".db")
+TABLE_NAME = "rows"
+INSERT_BATCH_SIZE = 1000
+ISO_DATE_FORMAT = "%Y-%m-%d"
+
+# declared column types. sqlite3's converters are global to the process, so
+# these are named so as not to replace its own (eg. for DATE) for other
+# connections, like match_cache's and near_duplicates'
+BOOLEAN = "STAGED_BOOLEAN"
+DATE = "STAGED_DATE"
+TEXT = "TEXT"
+
+BOOLEAN_STRINGS = {"true": 1, "false": 0, "1": 1, "0": 0}
+
+# declared type for known columns; anything else is stored as TEXT
+COLUMN_TYPES = {
+    cn_fields.INITIATED_BY_ALUM: BOOLEAN,
+    "initiated_by_alum": BOOLEAN,
+    cn_fields.DATE_OF_CONTACT: DATE,
+    "date_of_contact": DATE,
+}
+
+
+def _convert_boolean(value):
+    """BOOLEAN columns only hold 1, 0 or NULL (which isn't converted)."""
+    if value == b"1":
+        return True
+    if value == b"0":
+        return False
+    raise ValueError(f"Invalid boolean {value!r} in staging file")
+
+
+def _convert_date(value):
+    """DATE columns can also hold dates in other formats (eg. '10/15/18')
+    that haven't been converted yet; those come back as str.
+    """
+    value = value.decode()
+    try:
+        return datetime.strptime(value, ISO_DATE_FORMAT).date()
+    except ValueError:
+        return value
+
+
+sqlite3.register_converter(BOOLEAN, _convert_boolean)
+sqlite3.register_converter(DATE, _convert_date)
+
+
+def is_staging_file(filename):
+    return filename.lower().endswith(STAGING_EXTENSIONS)
+
+
+@contextmanager
+def open_reader(filename, columns=None, encoding=None):
+    """Yield a reader for filename (staging or csv) with a .fieldnames
+    attribute, iterating over Rows.
+
+    :param columns: optional iterable of the column names to read; only
+        applies to staging files, which can skip the other columns entirely
+    :param encoding: encoding of a csv file
+    """
+    if is_staging_file(filename):
+        reader = StagingReader(filename, columns=columns)
+        try:
+            yield reader
+        finally:
+            reader.close()
+    else:
+        with open_file(filename, "r", newline="", encoding=encoding) as infile:
+            yield CompactDictReader(infile)
+
+
+@contextmanager
+def open_writer(filename, fieldnames, encoding=None, **kwargs):
+    """Yield a writer for filename (staging or csv), with the csv.DictWriter
+    methods writeheader, writerow and writerows. `encoding` and any extra
+    kwargs only apply to csv files; the latter go to csv.DictWriter.
+    """
+    if is_staging_file(filename):
+        writer = StagingWriter(filename, fieldnames)
+        try:
+            yield writer
+        finally:
+            writer.close()
+    else:
+        with open_file(filename, "w", newline="", encoding=encoding) as outfile:
+            yield csv.DictWriter(outfile, fieldnames=fieldnames, **kwargs)
+
+
+class StagingReader:
+    """Iterate over the rows of a staging file as Rows."""
+
+    def __init__(self, filename, columns=None):
+        self.connection = sqlite3.connect(
+            filename, detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        if columns is None:
+            cursor = self.connection.execute(
+                f"SELECT * FROM {TABLE_NAME} LIMIT 0"
+            )
+            columns = [d[0] for d in cursor.description]
+        self.fieldnames = list(columns)
+        self._index = {name: i for i, name in enumerate(self.fieldnames)}
+        column_list = ", ".join(_quote(c) for c in self.fieldnames)
+        self._cursor = self.connection.execute(
+            f"SELECT {column_list} FROM {TABLE_NAME} ORDER BY rowid"
+        )
+
+    def __iter__(self):
+        index = self._index
+        for values in self._cursor:
+            yield Row(index, list(values))
+
+    def close(self):
+        self.connection.close()
+
+
+class StagingWriter:
+    """Write rows (mappings) to a new staging file, replacing its table."""
+
+    def __init__(self, filename, fieldnames):
+        self.connection = sqlite3.connect(filename)
+        self.fieldnames = list(fieldnames)
+        self._types = [COLUMN_TYPES.get(f, TEXT) for f in self.fieldnames]
+        self._batch = []
+        self._insert = "INSERT INTO {} ({}) VALUES ({})".format(
+            TABLE_NAME,
+            ", ".join(_quote(f) for f in self.fieldnames),
+            ", ".join("?" for _ in self.fieldnames),
+        )
+
+    def writeheader(self):
+        columns = ", ".join(
+            f"{_quote(f)} {t}" for f, t in zip(self.fieldnames, self._types)
+        )
+        self.connection.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+        self.connection.execute(f"CREATE TABLE {TABLE_NAME} ({columns})")
+
+    def writerow(self, row):
+        self._batch.append(tuple(
+            _to_sqlite(row.get(f), t) for f, t in zip(self.fieldnames, self._types)
+        ))
+        if len(self._batch) >= INSERT_BATCH_SIZE:
+            self._flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _flush(self):
+        if self._batch:
+            self.connection.executemany(self._insert, self._batch)
+            self._batch = []
+
+    def close(self):
+        self._flush()
+        self.connection.commit()
+        self.connection.close()
+
+
+def _to_sqlite(value, column_type):
+    """Coerce a value (usually a str from csv) for a column of column_type."""
+    if column_type == TEXT or value is None:
+        return value
+    if value == "":
+        return None
+    if column_type == BOOLEAN:
+        if isinstance(value, str):
+            try:
+                return BOOLEAN_STRINGS[value.strip().lower()]
+            except KeyError:
+                raise ValueError(f"Can't stage {value!r} as a boolean")
+        return int(bool(value))
+    if column_type == DATE and isinstance(value, date):
+        return value.strftime(ISO_DATE_FORMAT)
+    return value
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def to_csv_value(value):
+    """Format a value read from a staging file the way it'd appear in csv."""
+    if value is None:
+        return ""
+    if isinstance(value, date):
+        return value.strftime(ISO_DATE_FORMAT)
+    return value
+
+
+def export_csv(staging_filename, csv_filename):
+    """Write the table in staging_filename out to csv_filename."""
+    with open_reader(staging_filename) as reader, \
+            open_file(csv_filename, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(reader.fieldnames)
+        for row in reader:
+            writer.writerow([to_csv_value(v) for v in row.values()])
+    print(f"Saved to {csv_filename}")
+
+
+def import_csv(csv_filename, staging_filename):
+    """Load csv_filename into a new table in staging_filename."""
+    with open_reader(csv_filename) as reader, \
+            open_writer(staging_filename, reader.fieldnames) as writer:
+        writer.writeheader()
+        writer.writerows(reader)
+    print(f"Saved to {staging_filename}")
+
+
+def parse_args():
+    """
+    * action: 'export' (staging to csv) or 'import' (csv to staging)
+    * infile, outfile
+    """
+
+    parser = argparse.ArgumentParser(description="Convert staging files")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("infile", help="File to convert")
+    parser.add_argument("outfile", help="File to write")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.action == "export":
+        export_csv(args.infile, args.outfile)
+    else:
+        import_csv(args.infile, args.outfile)
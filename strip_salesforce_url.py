@@ -2,12 +2,19 @@
 strip_salesforce_url.py
 
 Clean a row of data containing full Salesforce URLs, replacing them with
-only the Salesforce ID; eg. https://salesforce.com/0AA123 --> 0AA123
+only the (18-character) Salesforce ID;
+eg. https://na1.salesforce.com/001A0000006Vm9r --> 001A0000006Vm9rIAC
+
+Classic and lightning URLs are both handled (see salesforce_ids.py). URLs
+without a valid ID are blanked, with a warning.
 """
 
 import argparse
 import csv
 
+from compressed_files import open_file
+from salesforce_ids import normalize_sf_ids
+
 URL_COLUMN = 0
 
 
@@ -16,26 +23,47 @@ def strip_url(input_filename):
     save back to stripped_<input_filename>.
     """
 
-    with open(input_filename, "r") as infile:
+    with open_file(input_filename, "r", newline="") as infile:
         reader = csv.reader(infile)
-        headers = next(reader)
+        headers, strip_row = strip_url_stage(next(reader))
 
         output_filename = f"stripped_{input_filename}"
 
-        with open(output_filename, "w") as outfile:
+        with open_file(output_filename, "w", newline="") as outfile:
             writer = csv.writer(outfile)
-            headers[URL_COLUMN] = "Salesforce ID"
             writer.writerow(headers)
 
             for row in reader:
-                url = row[URL_COLUMN]
-                sf_id = url.split("/")[-1].strip()
-                row[URL_COLUMN] = sf_id
-                writer.writerow(row)
+                writer.writerows(strip_row(row))
 
     print(f"Saved to {output_filename}.")
 
 
+def strip_url_stage(headers, url_column=URL_COLUMN, key_prefix=None):
+    """Pipeline stage (see pipeline.py): replace the URL in url_column with
+    the bare Salesforce ID, optionally checking its key_prefix (eg. '003'
+    for Contacts).
+
+    Each distinct URL is only normalized once for the whole column (see
+    normalize_sf_ids), since the same few often repeat down it.
+    """
+    headers = list(headers)
+    headers[url_column] = "Salesforce ID"
+    seen_urls = {}
+
+    def strip_row(row):
+        (sf_id,), errors = normalize_sf_ids(
+            (row[url_column],), key_prefix, seen_urls
+        )
+        if errors:
+            print(f"WARNING: {errors[0]}; blanking it")
+            sf_id = ""
+        row[url_column] = sf_id
+        return (row,)
+
+    return headers, strip_row
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Input csv file")
     parser.add_argument("infile", help="Input (csv) filename")
@@ -5,25 +5,57 @@ Combine data from multiple cells in a csv into one for Contact Note Comments
 field.
 """
 
+import argparse
 import csv
 
-INPUT_FILENAME = "PUT_FILENAME_HERE"
+from compressed_files import open_file
+
 # will range(FIRST_COL.., LAST_COL..+1)
 FIRST_COL_TO_SUMMARIZE = 4 # 0-indexed
 LAST_COL_TO_SUMMARIZE = 10 # "
 
-with open(INPUT_FILENAME, "r") as infile:
-    reader = csv.reader(infile)
-    headers = next(reader)
-
-    with open("summarized_"+INPUT_FILENAME, "w") as outfile:
-        writer = csv.writer(outfile)
-        writer.writerow(headers)
-
-        for row in reader:
-            comments = []
-            for i in range(FIRST_COL_TO_SUMMARIZE, LAST_COL_TO_SUMMARIZE+1):
-                comments.append(f"{headers[i]}\n{row[i]}")
-            comments_blob = "\n\n".join(comments)
-            row[LAST_COL_TO_SUMMARIZE+1] = comments_blob
-            writer.writerow(row)
+
+def summarize_notes(input_filename):
+    """Save input_filename back out to summarized_<input_filename>, with the
+    summarized columns combined into the column that follows them.
+    """
+    with open_file(input_filename, "r", newline="") as infile:
+        reader = csv.reader(infile)
+        headers, summarize_row = summarize_stage(next(reader))
+
+        with open_file("summarized_"+input_filename, "w", newline="") as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(headers)
+
+            for row in reader:
+                writer.writerows(summarize_row(row))
+
+
+def summarize_stage(headers, first_col=FIRST_COL_TO_SUMMARIZE,
+                    last_col=LAST_COL_TO_SUMMARIZE):
+    """Pipeline stage (see pipeline.py): write '<header>\\n<value>' for each
+    of columns first_col..last_col into column last_col+1.
+    """
+    headers = list(headers)
+    summarized_headers = headers[first_col:last_col+1]
+
+    def summarize_row(row):
+        comments = []
+        for header, value in zip(summarized_headers, row[first_col:last_col+1]):
+            comments.append(f"{header}\n{value}")
+        row[last_col+1] = "\n\n".join(comments)
+        return (row,)
+
+    return headers, summarize_row
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Input csv file")
+    parser.add_argument("infile", help="Input (csv) filename")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summarize_notes(args.infile)
@@ -7,10 +7,11 @@ Takes a csv as input, using Safe_Id__c column for alum identity.
 """
 
 import argparse
-import csv
 from datetime import datetime
 from os import path
 
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 from noble_logging_utils.papertrail_logger import (
     get_logger,
     SF_LOG_SANDBOX,
@@ -36,8 +37,8 @@ def update_contact_info(input_file, sf_connection):
 
     num_updated = 0
 
-    with open(input_file, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(input_file, 'r') as csvfile:
+        reader = CompactDictReader(csvfile)
 
         for row in reader:
             alum_safe_id = row[contact_fields.SAFE_ID]
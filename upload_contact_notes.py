@@ -1,16 +1,18 @@
 """
 upload_contact_notes.py
 
-Upload contact notes to Salesforce from a csv.
+Upload contact notes to Salesforce from a csv (or staging file; see
+staging.py).
 
 Checks for duplicates using Subject__c, Date_of_Contact__c and
-Mode_of_Communication__c fields.
+Mode_of_Communication__c fields, and optionally for near duplicates (see
+near_duplicates.py).
 
 TODO Refactor with noble-salesforce-utils; confirm ID and name against Elastic.
 """
 
 import argparse
-import csv
+from datetime import date
 from os import path
 
 from common_date_formats import COMMON_DATE_FORMATS
@@ -18,18 +20,32 @@ from salesforce_utils import (
     get_salesforce_connection,
     make_salesforce_datestr,
 )
+from salesforce_utils.constants import SALESFORCE_DATESTRING_FORMAT
 from header_mappings import HEADER_MAPPINGS
+from near_duplicates import NearDuplicateIndex
 from noble_logging_utils.papertrail_struct_logger import (
     get_logger,
     SF_LOG_LIVE,
     SF_LOG_SANDBOX,
 )
 from salesforce_fields import contact_note as cn_fields
+from salesforce_ids import (
+    CONTACT_KEY_PREFIX,
+    InvalidSalesforceId,
+    normalize_sf_id,
+)
+from staging import open_reader
 
 SF_OBJECT_ACTION = "CREATE" # TODO make part of logging package?
 
-def upload_contact_notes(input_file, source_date_format):
-    """Upload Contact Notes to Salesforce."""
+def upload_contact_notes(input_file, source_date_format,
+                         near_duplicates_filename=None):
+    """Upload Contact Notes to Salesforce.
+
+    With near_duplicates_filename (a near_duplicates index), notes nearly
+    the same as one in the index are skipped, and uploaded notes are added
+    to it.
+    """
 
     COUNT_CONTACT_NOTES_QUERY = "SELECT COUNT() FROM Contact_Note__c"
     pre_uploads_count = \
@@ -37,19 +53,33 @@ def upload_contact_notes(input_file, source_date_format):
 
     skipped_count = created_count = 0
 
-    with open(input_file, "r") as csvfile:
-        reader = csv.DictReader(csvfile)
+    near_duplicates = None
+    if near_duplicates_filename is not None:
+        near_duplicates = NearDuplicateIndex(near_duplicates_filename)
 
+    with open_reader(input_file) as reader:
         for row in reader:
-            # Date_of_Contact__c
-            datestring = make_salesforce_datestr(
-                row[cn_fields.DATE_OF_CONTACT], source_date_format
-            )
+            # Date_of_Contact__c; already a date if read from a staging file
+            source_date = row[cn_fields.DATE_OF_CONTACT]
+            if isinstance(source_date, date):
+                datestring = source_date.strftime(SALESFORCE_DATESTRING_FORMAT)
+            else:
+                datestring = make_salesforce_datestr(
+                    source_date, source_date_format
+                )
             row[cn_fields.DATE_OF_CONTACT] = datestring
 
-            # Contact__c
+            # Contact__c; caught here rather than as a failed upload
             # TODO handle in a way that allows easy retried of any failed
-            safe_id = row[cn_fields.CONTACT]
+            try:
+                safe_id = normalize_sf_id(
+                    row[cn_fields.CONTACT] or "", CONTACT_KEY_PREFIX
+                )
+            except InvalidSalesforceId as e:
+                skipped_count += 1
+                logger.warn(success=False, error=str(e), **row)
+                continue
+            row[cn_fields.CONTACT] = safe_id
 
             possible_dupe = check_for_existing_contact_note(
                 datestring, safe_id, row[cn_fields.SUBJECT]
@@ -59,6 +89,18 @@ def upload_contact_notes(input_file, source_date_format):
                 logger.warn(success=False, duplicate_id=possible_dupe, **row)
                 continue
 
+            if near_duplicates is not None:
+                near_matches = near_duplicates.find(
+                    safe_id, datestring, row[cn_fields.COMMENTS] or ""
+                )
+                if near_matches:
+                    skipped_count += 1
+                    logger.warn(
+                        success=False, near_duplicate_id=near_matches[0][0],
+                        **row
+                    )
+                    continue
+
             # Initiated_by_alum__c; typical of Facebook note uploads
             try:
                 row[cn_fields.INITIATED_BY_ALUM] = \
@@ -71,9 +113,17 @@ def upload_contact_notes(input_file, source_date_format):
             for field_name, value in row.items():
                 if field_name in HEADER_MAPPINGS.values():
                     contact_note_data[field_name] = value
-            was_successful = _upload_note(contact_note_data)
-            if was_successful:
+            note_id = _upload_note(contact_note_data)
+            if note_id:
                 created_count += 1
+                if near_duplicates is not None:
+                    near_duplicates.add(
+                        safe_id, datestring, row[cn_fields.COMMENTS] or "",
+                        note_id,
+                    )
+
+    if near_duplicates is not None:
+        near_duplicates.close()
 
     logger.info(num_created=created_count, num_skipped=skipped_count)
 
@@ -87,19 +137,24 @@ def _upload_note(args_dict):
     Upload the note. Assumes the following minimum kwargs:
     * ...
     ...
-    Returns success status as a bool.
+    Returns the new note's Id, or None if it wasn't created.
     """
 
     response = sf_connection.Contact_Note__c.create(args_dict)
     if response["success"]:
         logger.info(success=True, object_id=response["id"])
-    else:
-        logger.warn(success=False, error=response["errors"], attempted=args_dict)
-    return response["success"]
+        return response["id"]
+    logger.warn(success=False, error=response["errors"], attempted=args_dict)
+    return None
 
 
 def _string_to_bool(boolstring):
-    """Convert string 'True'/'False' to python bool for Salesforce API call."""
+    """Convert string 'True'/'False' to python bool for Salesforce API call.
+
+    Values read from a staging file are already bools (or None).
+    """
+    if boolstring is None or isinstance(boolstring, bool):
+        return boolstring
     boolstring = boolstring.lower()
     if boolstring == "true":
         return True
@@ -155,6 +210,7 @@ def parse_args():
     *    infile: input csv file, formatted and ready to upload to Salesforce
     * --sandbox: if present, connects to the sandbox Salesforce instance.
                  Otherwise, connects to live
+    * --near-duplicates: near_duplicates index to skip near duplicates with
     """
 
     parser = argparse.ArgumentParser(description="Specify input csv file")
@@ -168,6 +224,12 @@ def parse_args():
         default=False,
         help="If True, uses the sandbox Salesforce instance. Defaults to False"
     )
+    parser.add_argument(
+        "--near-duplicates",
+        default=None,
+        help="near_duplicates index (SQLite) file. If given, notes nearly the"
+             " same as one in it are skipped, and uploaded notes are added"
+    )
     return parser.parse_args()
 
 
@@ -191,5 +253,5 @@ if __name__=="__main__":
     logger._logger.setLevel("INFO")
 
     sf_connection = get_salesforce_connection(sandbox=args.sandbox)
-    upload_contact_notes(args.infile, source_date_format)
+    upload_contact_notes(args.infile, source_date_format, args.near_duplicates)
 
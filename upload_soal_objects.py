@@ -5,7 +5,6 @@ Upload SoaL data to Salesforce from a csv.
 """
 
 import argparse
-import csv
 
 import sys
 from os import pardir, path
@@ -14,6 +13,8 @@ parent_dir = path.abspath(path.join(filepath, pardir))
 package_dir = path.abspath(path.join(parent_dir, pardir))
 sys.path.insert(0, package_dir)
 
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 from salesforce_fields import account, contact, program
 from salesforce_utils.get_connection import get_salesforce_connection
 from loggers.papertrail_logger import get_logger, SF_LOG_LIVE, SF_LOG_SANDBOX
@@ -36,8 +37,8 @@ def upload_program_objects(input_filename):
 
     alumni_sf_ids, college_sf_ids = _make_safe_id_lookups(input_filename)
 
-    with open(input_filename, "r") as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(input_filename, "r") as csvfile:
+        reader = CompactDictReader(csvfile)
 
         for row in reader:
 
@@ -110,8 +111,8 @@ def _make_safe_id_lookups(input_filename):
     college_lookup = dict()
     network_ids = set()
     nces_ids = set()
-    with open(input_filename, "r") as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(input_filename, "r") as csvfile:
+        reader = CompactDictReader(csvfile)
         for row in reader:
             # assumed...
             network_ids.add(row["Network_ID"])
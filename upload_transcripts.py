@@ -6,12 +6,13 @@ Upload (transcript) documents to a Contact object in Salesforce.
 
 import argparse
 import base64
-import csv
 import json
 from os import path
 
 import requests
 
+from compact_rows import CompactDictReader
+from compressed_files import open_file
 from salesforce_fields import account, contact, program
 from salesforce_utils.get_connection import get_salesforce_connection
 from noble_logging_utils.papertrail_logger import (
@@ -32,8 +33,8 @@ def upload_transcripts(input_filename, sf_connection):
     #logger.info("Starting Attachment uploads..")
     print("Starting Attachment uploads..")
 
-    with open(input_filename, "r") as csvfile:
-        reader = csv.DictReader(csvfile)
+    with open_file(input_filename, "r") as csvfile:
+        reader = CompactDictReader(csvfile)
 
         for row in reader:
             alum_sf_id = row[SF_ID_HEADER]